@@ -14,6 +14,13 @@ Usage examples:
   # HPC resume mode (per tile and timepoint range)
   python -m scripts.batch_fuse_plate --config configs/config.yaml \
       --xml /path/to/dataset_WellB6_registered.xml --well B6 --tile 3 --tp-start 80 --tp-end 115
+
+  # Plate mode: all registered wells in output_path as 8 balanced macro batches on 8 Fiji workers
+  python -m scripts.batch_fuse_plate --config configs/config.yaml --plate --batches 8
+
+  # Plate mode on a Slurm array: each task runs one batch of the same saved plan (rerun to resume)
+  python -m scripts.batch_fuse_plate --config configs/config.yaml --plate --batches 8 \
+      --batch-index ${SLURM_ARRAY_TASK_ID}
 """
 
 import argparse
@@ -21,28 +28,74 @@ import os
 import sys
 import yaml
 from src.dopm.fusion import FusionProcessor
+from src.dopm.fusion_planner import find_well_xmls
+from src.dopm.native_fusion import NativeFusionProcessor
+
+
+def fuse_plate(args, config):
+    """Plate mode: plan (or reload) balanced fusion batches and run the pending items."""
+    output_path = config["data"]["output_path"]
+    fusion_settings = config["fusion_settings"]
+    if fusion_settings.get("engine", "fiji") != "fiji":
+        sys.exit(" Error: --plate batches Fiji macros and needs fusion_settings.engine 'fiji'")
+
+    well_xmls = find_well_xmls(output_path, args.wells)
+    if not well_xmls:
+        sys.exit(f" Error: No registered well datasets found in {output_path}")
+
+    print("\n--- Plate Fusion ---")
+    print(f"Config file    : {args.config}")
+    print(f"Wells          : {', '.join(well_xmls)}")
+    print(f"Batches        : {args.batches or 'fusion_settings.fiji_workers'}"
+          + (f" (running batch {args.batch_index})" if args.batch_index is not None else ""))
+
+    if args.batch_index is None:
+        # all batches on this node: one persistent Fiji worker per batch
+        fusion_settings = dict(fusion_settings, fiji_workers=args.batches or fusion_settings.get("fiji_workers") or 1)
+    processor = FusionProcessor(config.get("fiji_executable_path"), fusion_settings)
+    try:
+        remaining = processor.fuse_plate(
+            well_xmls, output_path, batches=args.batches, batch_index=args.batch_index,
+            tp_start=args.tp_start, tp_end=args.tp_end, tp_chunk=args.tp_chunk, replan=args.replan,
+        )
+    finally:
+        processor.close()
+    if remaining:
+        sys.exit(1)
 
 
 def main():
     parser = argparse.ArgumentParser(
-        description="Run fusion on registered datasets (per well or per tile)."
+        description="Run fusion on registered datasets (per well, per tile, or plate-wide in batches)."
     )
     parser.add_argument("--config", required=True, help="Path to YAML config file")
-    parser.add_argument("--well", required=True, help="Well ID (e.g. B6)")
+    parser.add_argument("--well", help="Well ID (e.g. B6)")
     parser.add_argument("--tile", type=int, help="Tile index (optional, for HPC mode)")
     parser.add_argument("--xml", help="Explicit XML path (for HPC mode)")
     parser.add_argument("--output-prefix", help="Optional prefix for fused output", default=None)
     parser.add_argument("--tp-start", type=int, help="Starting timepoint (optional, for resume)")
     parser.add_argument("--tp-end", type=int, help="Ending timepoint (optional, for resume)")
+    parser.add_argument("--plate", action="store_true", help="Fuse many wells in balanced, resumable macro batches")
+    parser.add_argument("--wells", nargs="+", help="Plate mode: wells to fuse (default: all registered wells)")
+    parser.add_argument("--batches", type=int, help="Plate mode: number of batches (default: fusion_settings.fiji_workers)")
+    parser.add_argument("--batch-index", type=int, help="Plate mode: run only this batch (e.g. SLURM_ARRAY_TASK_ID)")
+    parser.add_argument("--tp-chunk", type=int, help="Plate mode: timepoints per resumable item (default: all)")
+    parser.add_argument("--replan", action="store_true", help="Plate mode: discard the saved plan and plan again")
 
     args = parser.parse_args()
+    if not args.plate and not args.well:
+        parser.error("--well is required unless --plate is given")
 
     # --- Load config ---
     with open(args.config, "r") as f:
         config = yaml.safe_load(f)
 
+    if args.plate:
+        fuse_plate(args, config)
+        return
+
     output_path = config["data"]["output_path"]
-    fiji_path = config["fiji_executable_path"]
+    fiji_path = config.get("fiji_executable_path")
     fusion_settings = config["fusion_settings"]
 
     # --- Determine XML path ---
@@ -81,38 +134,45 @@ def main():
     else:
         print("Timepoints     : All")
 
-    # --- Initialize FusionProcessor ---
-    processor = FusionProcessor(fiji_path, fusion_settings)
+    # --- Initialize FusionProcessor (BigStitcher in Fiji, or the native Python engine) ---
+    if fusion_settings.get("engine", "fiji") == "python":
+        print("Fusion engine  : native Python")
+        processor = NativeFusionProcessor(fusion_settings)
+    else:
+        processor = FusionProcessor(fiji_path, fusion_settings)
 
     # --- Choose fusion mode ---
-    if args.tp_start is not None and args.tp_end is not None:
-        #  Resume/requeue mode — process a single tile and a specific TP range
-        print(f"Running range-based fusion for tile {tile_id}, timepoints {args.tp_start}-{args.tp_end}")
-        processor.fuse_single_tile_range(
-            xml_path=input_xml,
-            output_path=output_path,
-            well_id=f"Well{args.well}",
-            tile_id=tile_id,
-            tp_start=args.tp_start,
-            tp_end=args.tp_end,
-        )
-
-    elif args.tile is not None:
-        #  HPC mode — one tile, all timepoints
-        print(f"Running single-tile full fusion for tile {tile_id}")
-        processor.fuse_volumes(
-            input_xml,
-            output_prefix=output_prefix,
-            single_tile=args.tile
-        )
-
-    else:
-        #  Workstation mode — all tiles, all timepoints
-        print("Running full fusion for all tiles and timepoints")
-        processor.fuse_volumes(
-            input_xml,
-            output_prefix=output_prefix
-        )
+    try:
+        if args.tp_start is not None and args.tp_end is not None:
+            #  Resume/requeue mode — process a single tile and a specific TP range
+            print(f"Running range-based fusion for tile {tile_id}, timepoints {args.tp_start}-{args.tp_end}")
+            processor.fuse_single_tile_range(
+                xml_path=input_xml,
+                output_path=output_path,
+                well_id=f"Well{args.well}",
+                tile_id=tile_id,
+                tp_start=args.tp_start,
+                tp_end=args.tp_end,
+            )
+
+        elif args.tile is not None:
+            #  HPC mode — one tile, all timepoints
+            print(f"Running single-tile full fusion for tile {tile_id}")
+            processor.fuse_volumes(
+                input_xml,
+                output_prefix=output_prefix,
+                single_tile=args.tile
+            )
+
+        else:
+            #  Workstation mode — all tiles, all timepoints
+            print("Running full fusion for all tiles and timepoints")
+            processor.fuse_volumes(
+                input_xml,
+                output_prefix=output_prefix
+            )
+    finally:
+        processor.close()
 
     print(f"\n Fusion complete for Well {args.well}"
           + (f" (Tile {args.tile})" if args.tile is not None else "")
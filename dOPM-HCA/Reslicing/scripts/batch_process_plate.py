@@ -6,6 +6,13 @@ Usage:
     python scripts/batch_process_plate.py \
         --config configs/new_config.yaml \
         --well B2
+
+    # Shard mode: one job per tile (and optionally time point), then link the shards
+    python scripts/batch_process_plate.py --config configs/new_config.yaml --well B2 --tile 3
+    python scripts/batch_process_plate.py --config configs/new_config.yaml --well B2 --assemble
+
+    # Resume a well (or shard) whose job was killed: only views missing from its progress manifest are converted
+    python scripts/batch_process_plate.py --config configs/new_config.yaml --well B2 --resume
 """
 
 import argparse
@@ -23,6 +30,19 @@ def main():
     parser.add_argument(
         "--well", required=True, help="Well ID to process, e.g. B2"
     )
+    parser.add_argument(
+        "--tile", type=int, help="Tile index: only convert this tile into a shard (optional)"
+    )
+    parser.add_argument(
+        "--time", type=int, help="Time index: only convert this time point into a shard (optional)"
+    )
+    parser.add_argument(
+        "--resume", action="store_true",
+        help="Keep the views an interrupted run already converted and convert only the missing ones"
+    )
+    parser.add_argument(
+        "--assemble", action="store_true", help="Link the finished shards of the well into one BDV XML/H5"
+    )
     args = parser.parse_args()
 
     # Load config
@@ -38,11 +58,21 @@ def main():
     print(f"Config file       : {args.config}")
     print(f"Well              : {args.well}")
     print(f"Bead registration : {bead_xml_path}")
+    if args.tile is not None or args.time is not None:
+        print(f"Shard             : tile={args.tile}, time={args.time}")
+
+    if args.assemble:
+        sample_converter.assemble_well(well=args.well, registered=True)
+        print("\n Shards assembled for well:", args.well)
+        return
 
-    # Process this well across all tiles and times
+    # Process this well across all tiles and times (or one shard of it)
     sample_converter.process_well_with_registration(
         well=args.well,
         bead_xml_path=bead_xml_path,
+        tile=args.tile,
+        time=args.time,
+        resume=args.resume or None,
     )
 
     print("\n HPC job complete for well:", args.well)
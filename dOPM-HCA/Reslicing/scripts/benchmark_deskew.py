@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+Benchmark the stage-scan shear deskew fast path against full affine resampling
+on a synthetic bead view.
+
+ - accuracy: the shear fast path is compared with scipy's trilinear affine_transform
+   of the same shear onto the same grid;
+ - speed: both are timed, next to the full world-grid deskew (`deskew: affine`),
+   which also resamples the rotation the shear path leaves to the XML.
+
+Usage:
+    python -m scripts.benchmark_deskew
+    python -m scripts.benchmark_deskew --planes 200 --size 512 --z-step 1.0 --repeats 3
+"""
+
+import argparse
+import math
+import tempfile
+import time
+
+import numpy as np
+import scipy.ndimage as ndi
+
+from src.dopm.data_converter import DataConverter
+from src.dopm.deskew import (deskew_view, iter_sheared_chunks, shear_output_shape, shear_transform,
+                             index_mapping)
+
+
+def time_call(func, repeats):
+    """Return the best wall time of `repeats` calls, in ms, and the last result."""
+    best, result = float("inf"), None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return best * 1000, result
+
+
+def bead_view(planes, size, n_beads=300, seed=0):
+    """Raw (z, y, x) uint16 view with blurred point sources on a camera offset."""
+    rng = np.random.default_rng(seed)
+    view = np.zeros((planes, size, size), dtype=np.float32)
+    view[rng.integers(0, planes, n_beads), rng.integers(0, size, n_beads), rng.integers(0, size, n_beads)] = 6e4
+    view = ndi.gaussian_filter(view, (1.0, 1.5, 1.5)) + 100
+    return np.clip(view, 0, 65535).astype(np.uint16)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare stage-scan shear deskew with full affine resampling.")
+    parser.add_argument("--planes", type=int, default=100, help="Raw Z-planes per view")
+    parser.add_argument("--size", type=int, default=512, help="Plane size in pixels (Y = X)")
+    parser.add_argument("--z-step", type=float, default=1.0, help="Stage step in um")
+    parser.add_argument("--pix-x", type=float, default=0.35, help="Pixel size in um")
+    parser.add_argument("--mirror-tilt", type=float, default=17.5, help="Mirror tilt in degrees")
+    parser.add_argument("--repeats", type=int, default=3, help="Timed repeats per case (best is reported)")
+    args = parser.parse_args()
+
+    converter = DataConverter({
+        "type": "stage_scanning", "input_path": ".", "output_path": tempfile.mkdtemp(),
+        "hardcoded_vars": {"pix_x": args.pix_x, "mirror_tilt": args.mirror_tilt},
+    })
+    view = bead_view(args.planes, args.size)
+    dims = {"X": args.size, "Y": args.size, "Z": args.planes}
+    calibration_z = args.z_step * math.cos(math.pi / 2 - 2 * math.radians(args.mirror_tilt)) / args.pix_x
+    affines = converter._calculate_stage_scan_affines(dims)
+
+    print(f"view {view.shape}, {view.nbytes / 2 ** 20:.0f} MiB")
+    print(f"{'view':<6}{'shear [px/plane]':>18}{'shear path [ms]':>17}{'trilinear shear [ms]':>22}"
+          f"{'full affine [ms]':>18}{'max |diff|':>12}{'mean |diff|':>13}")
+    for angle, (shear_y_px, flip_y) in enumerate(converter._calculate_stage_scan_shears()):
+        shear_px = shear_y_px * calibration_z
+        out_shape = shear_output_shape(view.shape, shear_px)
+        matrix, offset = index_mapping(shear_transform(view.shape, shear_px, flip_y), (0, 0, 0))
+
+        t_shear, sheared = time_call(
+            lambda: np.concatenate([c for _, c in iter_sheared_chunks(view, shear_px, flip_y)]), args.repeats)
+        t_trilinear, reference = time_call(
+            lambda: ndi.affine_transform(view, matrix, offset=offset, output_shape=out_shape, output=np.uint16,
+                                         order=1, prefilter=False, mode="grid-constant"), args.repeats)
+        t_full, _ = time_call(lambda: deskew_view(view, affines[angle], (1, 1, calibration_z)), args.repeats)
+
+        diff = np.abs(sheared.astype(np.int32) - reference)
+        print(f"{angle:<6}{shear_px:>18.3f}{t_shear:>17.1f}{t_trilinear:>22.1f}{t_full:>18.1f}"
+              f"{diff.max():>12d}{diff.mean():>13.4f}")
+
+
+if __name__ == "__main__":
+    main()
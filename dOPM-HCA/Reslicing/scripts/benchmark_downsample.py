@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+"""
+Benchmark the integer block-mean downsampler against skimage's downscale_local_mean
+on dOPM-sized planes and stacks.
+
+Usage:
+    python -m scripts.benchmark_downsample
+    python -m scripts.benchmark_downsample --size 2048 --planes 64 --repeats 5
+"""
+
+import argparse
+import time
+
+import numpy as np
+import skimage.transform
+
+from src.dopm.npy2bdv import block_mean_downsample
+
+
+def time_call(func, repeats):
+    """Return the best wall time of `repeats` calls, in ms."""
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare BDV pyramid downsamplers.")
+    parser.add_argument("--size", type=int, default=2048, help="Plane size in pixels (Y = X)")
+    parser.add_argument("--planes", type=int, default=32, help="Z-planes in the 3D benchmark stack")
+    parser.add_argument("--repeats", type=int, default=5, help="Timed repeats per case (best is reported)")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    plane = rng.integers(100, 4000, size=(args.size, args.size), dtype=np.uint16)
+    stack = rng.integers(100, 4000, size=(args.planes, args.size, args.size), dtype=np.uint16)
+
+    cases = [("plane", plane, f) for f in ((2, 2), (4, 4), (8, 8))] + \
+            [("stack", stack, f) for f in ((1, 2, 2), (2, 4, 4), (4, 8, 8))]
+
+    print(f"{'data':<8}{'factors':<12}{'skimage [ms]':>14}{'block mean [ms]':>17}{'speed-up':>10}  identical")
+    for name, data, factors in cases:
+        reference = skimage.transform.downscale_local_mean(data, factors).astype(np.uint16)
+        out = np.empty_like(reference)
+        t_ref = time_call(lambda: skimage.transform.downscale_local_mean(data, factors).astype(np.uint16),
+                          args.repeats)
+        t_new = time_call(lambda: block_mean_downsample(data, factors, out=out), args.repeats)
+        identical = np.array_equal(reference, block_mean_downsample(data, factors))
+        print(f"{name:<8}{str(factors):<12}{t_ref:>14.1f}{t_new:>17.1f}{t_ref / t_new:>9.1f}x  {identical}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""
+schedule_plate.py
+Balanced conversion of a whole plate: (well, tile, time point range) units packed into
+tasks of similar ND2 size, run as a Slurm array or in a local process pool.
+
+Usage examples:
+  # Plan 40 tasks and write output_path/conversion_plan/submit_slurm.sh (array + assembly job)
+  python -m scripts.schedule_plate --config configs/config.yaml --tasks 40 --tp-chunk 20
+  bash <output_path>/conversion_plan/submit_slurm.sh
+
+  # What each array task runs (see slurm_convert_plate.sh)
+  python -m scripts.schedule_plate --config configs/config.yaml --task-index ${SLURM_ARRAY_TASK_ID}
+  python -m scripts.schedule_plate --config configs/config.yaml --assemble
+
+  # Workstation: same units in 6 worker processes, wells assembled as they finish
+  python -m scripts.schedule_plate --config configs/config.yaml --local 6
+"""
+
+import argparse
+import sys
+import yaml
+from src.dopm.data_converter import DataConverter
+from src.dopm.plate_scheduler import plan_plate, load_plan, write_slurm_submit, run_task, assemble_wells, run_local
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Plan and run balanced ND2 -> BDV conversion tasks for a whole plate"
+    )
+    parser.add_argument("--config", required=True, help="Path to YAML config file")
+    parser.add_argument("--tasks", type=int, help="Number of tasks to plan (default: one per well)")
+    parser.add_argument("--wells", nargs="+", help="Wells to convert (default: all wells in input_path)")
+    parser.add_argument("--tp-chunk", type=int, help="Time points per unit (default: all)")
+    parser.add_argument("--replan", action="store_true", help="Discard the saved plan and plan again")
+    parser.add_argument("--task-index", type=int, help="Run one task of the saved plan (e.g. SLURM_ARRAY_TASK_ID)")
+    parser.add_argument("--assemble", action="store_true", help="Link the shards of every finished well")
+    parser.add_argument("--local", type=int, metavar="PROCESSES", help="Run all tasks in a local process pool")
+    parser.add_argument("--job-script", default="slurm_convert_plate.sh", help="Slurm script used by the submit script")
+    args = parser.parse_args()
+
+    # Load config
+    with open(args.config, "r") as f:
+        config = yaml.safe_load(f)
+
+    bead_xml_path = config["pipeline_settings"]["registered_bead_xml_path"]
+    converter = DataConverter(config["data"])
+
+    print("\n--- Plate Conversion Scheduler ---")
+    print(f"Config file       : {args.config}")
+    print(f"Bead registration : {bead_xml_path}")
+
+    if args.task_index is not None or args.assemble:
+        tasks = load_plan(converter.output_path)
+        if tasks is None:
+            sys.exit(f" Error: No conversion plan in {converter.output_path}, run without --task-index first")
+        if args.assemble:
+            incomplete = assemble_wells(converter, tasks, registered=bool(bead_xml_path))
+            sys.exit(1 if incomplete else 0)
+        if args.task_index >= len(tasks):
+            print(f"Task index {args.task_index} out of range (only {len(tasks)} tasks).")
+            return
+        failed = run_task(converter, tasks[args.task_index], bead_xml_path)
+        print(f"\n Task {args.task_index} complete" + (f", {len(failed)} units failed" if failed else ""))
+        sys.exit(1 if failed else 0)
+
+    n_tasks = args.tasks or args.local or len(args.wells or converter.nd2_index.wells())
+    tasks = plan_plate(converter, n_tasks, wells=args.wells, tp_chunk=args.tp_chunk, replan=args.replan)
+
+    if args.local:
+        failed, failed_wells = run_local(config["data"], tasks, args.local, bead_xml_path)
+        print("\n Plate conversion complete" + (f", {len(failed)} units failed: {failed}" if failed else "")
+              + (f", wells not assembled: {failed_wells}" if failed_wells else ""))
+        sys.exit(1 if failed or failed_wells else 0)
+
+    submit = write_slurm_submit(converter.output_path, len(tasks), args.config, args.job_script)
+    print(f"\n Submit the {len(tasks)} tasks and the assembly job with: bash {submit}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""
+Summarise the Fiji progress/timing events (fiji_events_*.jsonl) written by FijiBridge
+and FijiWorkerPool, e.g. across all tasks of a plate fusion array job.
+
+Usage:
+    python -m scripts.summarize_fiji_logs logs/
+    python -m scripts.summarize_fiji_logs logs/fiji_events_123456_*.jsonl --top 20
+"""
+
+import argparse
+import glob
+import json
+import os
+from collections import defaultdict
+
+
+def read_events(paths):
+    files = []
+    for path in paths:
+        files += sorted(glob.glob(os.path.join(path, "fiji_events_*.jsonl"))) if os.path.isdir(path) else glob.glob(path)
+    events = []
+    for file_path in files:
+        with open(file_path, "r") as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    events.append(json.loads(line))
+    return files, events
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarise Fiji JSON-lines event logs.")
+    parser.add_argument("paths", nargs="+", help="Log directories and/or fiji_events_*.jsonl files")
+    parser.add_argument("--top", type=int, default=10, help="Number of slowest items to list")
+    args = parser.parse_args()
+
+    files, events = read_events(args.paths)
+    if not events:
+        print(" No events found.")
+        return
+    print(f" {len(events)} events from {len(files)} log files")
+
+    macros = [e for e in events if e["event"] == "macro_end"]
+    startups = [e["elapsed_s"] for e in events if e["event"] == "worker_ready"]
+    items = [e for e in events if e["event"] == "item_end"]
+    errors = [e for e in events if e["event"] == "error"]
+
+    macro_time = sum(e["elapsed_s"] or 0 for e in macros)
+    item_time = sum(e["elapsed_s"] or 0 for e in items)
+    failed = [e for e in macros if e["status"] != "ok"]
+    print(f"\nMacros          : {len(macros)} ({len(failed)} failed), {macro_time / 3600:.2f} h")
+    print(f"Fused items     : {len(items)}, {item_time / 3600:.2f} h"
+          + (f" (mean {item_time / len(items):.1f} s)" if items else ""))
+    if startups:
+        print(f"Worker startups : {len(startups)}, mean {sum(startups) / len(startups):.1f} s")
+    # time inside macros that is not spent fusing items: JVM/plugin startup, XML loading, ...
+    print(f"Overhead        : {max(0.0, macro_time - item_time) / 3600:.2f} h outside fused items")
+
+    per_well = defaultdict(lambda: [0, 0.0])
+    for e in items:
+        key = e.get("well") or e.get("label") or "?"
+        per_well[key][0] += 1
+        per_well[key][1] += e["elapsed_s"] or 0
+    print(f"\n{'well / macro':<40}{'items':>8}{'time [min]':>12}")
+    for key, (count, seconds) in sorted(per_well.items(), key=lambda kv: -kv[1][1]):
+        print(f"{key:<40}{count:>8}{seconds / 60:>12.1f}")
+
+    print(f"\nSlowest {min(args.top, len(items))} items:")
+    for e in sorted(items, key=lambda e: -(e["elapsed_s"] or 0))[:args.top]:
+        where = f"Well{e['well']} " if e.get("well") else f"{e.get('label')} "
+        tps = f" tp {e['tp_start']}-{e['tp_end']}" if "tp_start" in e else ""
+        print(f"   {where}tile {e.get('tile')}{tps}: {e['elapsed_s']:.1f} s ({e['status']}, {e['host']})")
+
+    if errors or failed:
+        print(f"\n{len(errors)} error lines, {len(failed)} failed macros:")
+        for e in failed:
+            print(f"   {e['time']} {e.get('label')}: {e['status']}")
+        for e in errors[:args.top]:
+            print(f"   {e['time']} {e.get('label')}: {e['message']}")
+
+
+if __name__ == "__main__":
+    main()
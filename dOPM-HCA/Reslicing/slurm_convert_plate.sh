@@ -0,0 +1,44 @@
+#!/bin/bash
+#SBATCH --job-name=convert_plate
+#SBATCH --output=logs/convert_plate_%A_%a.out
+#SBATCH --error=logs/convert_plate_%A_%a.err
+#SBATCH --time=12:00:00
+#SBATCH --mem=32G
+#SBATCH --cpus-per-task=8
+
+# Balanced plate conversion, planned by scripts/schedule_plate.py.
+# Usage (normally via the generated <output_path>/conversion_plan/submit_slurm.sh):
+# python -m scripts.schedule_plate --config configs/config.yaml --tasks 40
+# sbatch --array=0-39 slurm_convert_plate.sh configs/config.yaml task
+# sbatch --dependency=afterok:<array job id> slurm_convert_plate.sh configs/config.yaml assemble
+
+CONFIG=$1
+MODE=${2:-task}
+
+if [ -z "$CONFIG" ]; then
+    echo " Error: No config file provided."
+    echo "Usage: sbatch --array=0-N $0 configs/my_config.yaml [task|assemble]"
+    exit 1
+fi
+
+PYTHON=/nemo/lab/frenchp/data/CALM/dOPM/conda_envs/dopm_processing/bin/python
+if [ ! -x "$PYTHON" ]; then
+    echo " Error: Python not found at $PYTHON"
+    exit 1
+fi
+
+cd /nemo/lab/frenchp/data/CALM/dOPM/projects/software/dopm_processing
+export PYTHONPATH=$PWD/src:$PYTHONPATH
+
+if [ "$MODE" = "assemble" ]; then
+    $PYTHON -m scripts.schedule_plate --config "${CONFIG}" --assemble
+elif [ -n "$SLURM_ARRAY_TASK_ID" ]; then
+    $PYTHON -m scripts.schedule_plate --config "${CONFIG}" --task-index "${SLURM_ARRAY_TASK_ID}"
+else
+    echo " No SLURM_ARRAY_TASK_ID found; submit with --array."
+    exit 1
+fi
+EXITCODE=$?
+
+echo "[DONE] $(date) | Mode=${MODE} | Task=${SLURM_ARRAY_TASK_ID} | Exit code: ${EXITCODE}"
+exit $EXITCODE
@@ -0,0 +1,118 @@
+# src/dopm/chunking.py
+
+"""
+Chunk-shape planning for BDV/HDF5 datasets.
+
+A chunk is the unit HDF5 reads, decompresses and caches, so its shape should
+follow how the data is consumed downstream:
+
+ - 'plane':  plane-wise reads such as MIPs or slice viewing; chunks span whole
+             (or large parts of) YX planes and few Z-planes.
+ - 'block':  block-wise reads such as fusion or BigStitcher resampling; chunks
+             are close to cubic.
+
+Chunk sides are powers of two, clipped to the dataset shape, and grown until
+the chunk reaches a byte budget that depends on whether it is compressed.
+"""
+
+import math
+import numpy as np
+
+ACCESS_PATTERNS = ("block", "plane")
+
+# Uncompressed chunk budget; compressed chunks can be larger since they shrink on disk.
+TARGET_BYTES_UNCOMPRESSED = 512 * 1024
+TARGET_BYTES_COMPRESSED = 2 * 1024 * 1024
+
+
+def plan_chunk(shape: tuple, dtype="uint16", access: str = "block", target_bytes: int = None,
+               compressed: bool = False) -> tuple:
+    """
+    Pick a (z, y, x) chunk shape for a dataset of `shape`.
+
+    Parameters:
+    -----------
+        shape: tuple of 3 ints
+            Dataset shape in (z, y, x) order.
+        dtype: numpy dtype or str
+        access: str
+            'block' (fusion, resampling) or 'plane' (MIPs, slice reads).
+        target_bytes: int, optional
+            Chunk byte budget. Default 512 KiB, or 2 MiB when `compressed`.
+        compressed: bool
+            Whether the dataset is written with a compression filter.
+
+    Returns:
+    --------
+        tuple of 3 ints, the chunk shape in (z, y, x) order.
+    """
+    assert access in ACCESS_PATTERNS, f"Unknown access pattern {access}, must be one of {ACCESS_PATTERNS}"
+    assert len(shape) == 3, f"Expected a (z, y, x) shape, got {shape}"
+    if target_bytes is None:
+        target_bytes = TARGET_BYTES_COMPRESSED if compressed else TARGET_BYTES_UNCOMPRESSED
+    itemsize = np.dtype(dtype).itemsize
+    max_elements = max(1, target_bytes // itemsize)
+    # Axis growth order: 'plane' fills x, then y, then z; 'block' grows the smallest side first.
+    chunk = [1, 1, 1]
+
+    def can_grow(axis):
+        return chunk[axis] < shape[axis] and math.prod(chunk) * 2 <= max_elements
+
+    while True:
+        if access == "plane":
+            growable = [axis for axis in (2, 1, 0) if can_grow(axis)]
+        else:
+            growable = sorted((axis for axis in (0, 1, 2) if can_grow(axis)), key=lambda a: (chunk[a], -a))
+        if not growable:
+            break
+        chunk[growable[0]] *= 2
+
+    return tuple(min(c, n) for c, n in zip(chunk, shape))
+
+
+def plan_pyramid_chunks(view_shape: tuple, subsamp, dtype="uint16", access: str = "block",
+                        compression=None, target_bytes: int = None) -> list:
+    """
+    Plan chunk shapes for every pyramid level of a view.
+
+    Parameters:
+    -----------
+        view_shape: tuple of 3 ints
+            Full-resolution view shape in (z, y, x) order.
+        subsamp: sequence of (z, y, x) subsampling factors, one per level (first is usually (1, 1, 1)).
+        dtype, access, target_bytes:
+            See `plan_chunk`.
+        compression: None, str, dict or list
+            The compression spec given to BdvWriter; a list gives one entry per level.
+
+    Returns:
+    --------
+        list of dicts, one per level, with keys
+        'level', 'shape', 'chunk', 'chunk_bytes', 'n_chunks'.
+    """
+    plan = []
+    itemsize = np.dtype(dtype).itemsize
+    for ilevel, factors in enumerate(subsamp):
+        level_shape = tuple(int(math.ceil(n / f)) for n, f in zip(view_shape, factors))
+        if isinstance(compression, (list, tuple)):
+            level_compression = compression[min(ilevel, len(compression) - 1)] if compression else None
+        else:
+            level_compression = compression
+        chunk = plan_chunk(level_shape, dtype, access, target_bytes, compressed=level_compression is not None)
+        plan.append({
+            "level": ilevel,
+            "shape": level_shape,
+            "chunk": chunk,
+            "chunk_bytes": math.prod(chunk) * itemsize,
+            "n_chunks": math.prod(int(math.ceil(n / c)) for n, c in zip(level_shape, chunk)),
+        })
+    return plan
+
+
+def format_chunk_plan(plan: list) -> str:
+    """Human-readable table of a `plan_pyramid_chunks` result."""
+    lines = [f"    {'level':<6}{'shape (z,y,x)':<22}{'chunk (z,y,x)':<20}{'chunk size':>12}{'chunks':>10}"]
+    for entry in plan:
+        lines.append(f"    {entry['level']:<6}{str(entry['shape']):<22}{str(entry['chunk']):<20}"
+                     f"{entry['chunk_bytes'] / 1024:>9.0f} KiB{entry['n_chunks']:>10}")
+    return "\n".join(lines)
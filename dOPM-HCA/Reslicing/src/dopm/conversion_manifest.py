@@ -0,0 +1,157 @@
+# src/dopm/conversion_manifest.py
+
+"""
+Progress manifest of a well conversion, for resuming after the job was killed.
+
+Every finished (time, tile, angle) job is appended as one JSON line next to the
+dataset XML (`<dataset>.progress.jsonl`), after its views were flushed to the H5 file
+(or zarr store). Each line holds what the writer needs to describe the job's channel
+views in the XML: shape, affine, calibration, voxel size and exposure. These are taken
+from the job's own `append_view` calls (see `ViewRecorder`), not from the writer's
+per-setup state, which other time points of the same setup overwrite when jobs run
+in parallel.
+
+With `conversion.resume: true`, the writer reopens the existing output instead of
+deleting it, the recorded views are restored into it, and only the missing jobs are
+converted. The first line is a fingerprint of the output settings; if it does not
+match the current run, the manifest and the old output are discarded.
+"""
+
+import inspect
+import json
+import os
+import threading
+
+import numpy as np
+
+from src.dopm.npy2bdv import BdvWriter
+
+MANIFEST_VERSION = 1
+_APPEND_VIEW = inspect.signature(BdvWriter.append_view)
+
+
+def manifest_path(xml_path: str) -> str:
+    return os.path.splitext(xml_path)[0] + ".progress.jsonl"
+
+
+class ConversionManifest:
+    def __init__(self, path: str, fingerprint: dict):
+        """
+        Parameters:
+        -----------
+            path: str
+                JSON-lines manifest file.
+            fingerprint: dict
+                Output settings (format, channels, tiles, chunks, ...) the recorded views were written with.
+        """
+        self.path = path
+        self.fingerprint = json.loads(json.dumps(fingerprint, default=_to_json))
+        self.completed = {}  # (time, tile, angle) -> list of per-channel view records
+        self._lock = threading.Lock()
+
+    def load(self) -> bool:
+        """Read the completed jobs; False (and nothing loaded) if the file is missing or from other settings."""
+        self.completed = {}
+        try:
+            with open(self.path, "r") as f:
+                lines = f.readlines()
+        except OSError:
+            return False
+        try:
+            header = json.loads(lines[0]) if lines else {}
+        except ValueError:
+            return False
+        if header.get("version") != MANIFEST_VERSION or header.get("fingerprint") != self.fingerprint:
+            print(f" WARNING: {self.path} was written with other conversion settings, ignoring it.")
+            return False
+        for line in lines[1:]:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                break  # last line cut short by the kill
+            self.completed[(entry["time"], entry["tile"], entry["angle"])] = entry["views"]
+        return True
+
+    def reset(self):
+        """Start an empty manifest for a fresh conversion."""
+        self.completed = {}
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with open(self.path, "w") as f:
+            f.write(json.dumps({"version": MANIFEST_VERSION, "fingerprint": self.fingerprint}) + "\n")
+
+    def is_done(self, time: int, tile: int, angle: int) -> bool:
+        return (time, tile, angle) in self.completed
+
+    def restore(self, bdv_writer):
+        """Register the recorded views with a reopened writer, so `write_xml` lists them again."""
+        for (time, tile, angle), views in self.completed.items():
+            for view in views:
+                isetup = bdv_writer._determine_setup_id(0, view["channel"], tile, angle)
+                bdv_writer._update_setup_id_present(isetup, time)
+                bdv_writer.ntimes = max(bdv_writer.ntimes, time + 1)
+                bdv_writer.stack_shapes[isetup] = tuple(view["shape"])
+                if view["affine"] is not None:
+                    bdv_writer.affine_matrices[isetup] = np.asarray(view["affine"])
+                    bdv_writer.affine_names[isetup] = view["name_affine"]
+                bdv_writer.calibrations[isetup] = tuple(view["calibration"])
+                bdv_writer.voxel_size_xyz[isetup] = tuple(view["voxel_size_xyz"])
+                bdv_writer.voxel_units[isetup] = view["voxel_units"]
+                bdv_writer.exposure_time[isetup] = view["exposure_time"]
+                bdv_writer.exposure_units[isetup] = view["exposure_units"]
+
+    def record(self, bdv_writer, time: int, tile: int, angle: int, views: list):
+        """
+        Flush the writer and append the job's views (as collected by a `ViewRecorder`) to the
+        manifest (thread-safe). Call only once all writes of the job are done, e.g. on the
+        writer thread after its queued writes.
+        """
+        bdv_writer.flush()
+        views = sorted(views, key=lambda view: view["channel"])
+        line = json.dumps({"time": time, "tile": tile, "angle": angle, "views": views}, default=_to_json)
+        with self._lock:
+            with open(self.path, "a") as f:
+                f.write(line + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            self.completed[(time, tile, angle)] = json.loads(line)["views"]
+
+
+class ViewRecorder:
+    """
+    Pass-through for a writer (BdvWriter, OmeZarrWriter or BdvWriterThread) that records the views
+    one job writes, as manifest view records, from the arguments of its `append_view` calls.
+    """
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.views = []
+
+    def append_view(self, **kwargs):
+        arguments = _APPEND_VIEW.bind(None, **kwargs)  # fills in BdvWriter.append_view's defaults
+        arguments.apply_defaults()
+        view = arguments.arguments
+        shape = view["stack"].shape if view["stack"] is not None else view["virtual_stack_dim"]
+        affine = view["m_affine"]
+        self.views.append({
+            "channel": view["channel"],
+            "shape": tuple(int(n) for n in shape),
+            "affine": None if affine is None else np.array(affine, dtype=float),
+            "name_affine": view["name_affine"] if affine is not None else None,
+            "calibration": tuple(view["calibration"]),
+            "voxel_size_xyz": tuple(view["voxel_size_xyz"]),
+            "voxel_units": view["voxel_units"],
+            "exposure_time": view["exposure_time"],
+            "exposure_units": view["exposure_units"],
+        })
+        self.writer.append_view(**kwargs)
+
+    def append_substack(self, substack, z_start, **kwargs):
+        self.writer.append_substack(substack, z_start, **kwargs)
+
+
+def _to_json(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"Cannot store {type(value)} in the conversion manifest")
@@ -3,12 +3,21 @@
 import os
 import math
 import numpy as np
-import re
 import nd2
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from src.dopm.metadata import Metadata
+from src.dopm.nd2_index import ND2Index
 from src.dopm.npy2bdv import BdvWriter, BdvEditor
 from src.dopm.fiji_bridge import FijiBridge
+from src.dopm.writer_thread import BdvWriterThread
+from src.dopm.conversion_manifest import ConversionManifest, ViewRecorder, manifest_path
+from src.dopm.plane_repair import repair_even_planes, merge_repair_reports
+from src.dopm.chunking import plan_pyramid_chunks, format_chunk_plan
+from src.dopm.ome_zarr_writer import OmeZarrWriter
+from src.dopm.shard_assembly import shard_xml_path, find_shards, assemble_shards
+from src.dopm.deskew import (iter_deskewed_chunks, output_grid, view_transform, translation_affine,
+                             iter_sheared_chunks, shear_transform, shear_output_shape, residual_affine)
 
 
 class DataConverter:
@@ -19,9 +28,58 @@ class DataConverter:
         self.output_path = config["output_path"]
         self.hardcoded_vars = config["hardcoded_vars"]
 
+        # --- Conversion options (all optional) ---
+        conversion = config.get("conversion") or {}
+        self.streaming = conversion.get("streaming", False)
+        # Keep chunks an even number of planes so the even-plane fix never straddles two chunks
+        self.stream_chunk_planes = max(2, int(conversion.get("chunk_planes", 64)) // 2 * 2)
+        self.workers = self._resolve_workers(conversion.get("workers", 1))
+        self.queue_size = int(conversion.get("queue_size", 2 * self.workers))
+        # HDF5 compression: a name ('gzip', 'lzf', 'blosc-lz4', 'blosc-zstd', ...), a {name, level} dict,
+        # or a list with one entry per pyramid level
+        self.compression = conversion.get("compression")
+        # Optional multi-resolution levels, (z,y,x) factors relative to full resolution, e.g. [[1, 2, 2], [2, 4, 4]]
+        self.pyramid_subsamp = [tuple(level) for level in conversion.get("pyramids", [])]
+        self.pyramid_blockdim = [tuple(b) for b in conversion.get("pyramid_blockdim", [])]
+        # HDF5 chunk shape: None keeps (64, 64, 64), "auto" plans per level from the view shape, or an explicit [z, y, x]
+        self.chunks = conversion.get("chunks")
+        self.access_pattern = conversion.get("access_pattern", "block")
+        # Output backend: "bdv" (BDV HDF5) or "ome-zarr" (one NGFF multiscale image per view, plus BDV XML)
+        self.output_format = conversion.get("format", "bdv")
+        self.ngff_version = str(conversion.get("ngff_version", "0.4"))
+        assert self.output_format in ("bdv", "ome-zarr"), \
+            f"Unknown output format '{self.output_format}', must be 'bdv' or 'ome-zarr'"
+        # Native deskew: resample every view onto the isotropic world grid in Python instead of leaving it to Fiji
+        # "affine" (or true) resamples the full view transform; "shear" (stage scanning only) applies just the
+        # leading Y shear plane by plane and keeps the remaining rotation in the XML
+        self.deskew = "affine" if conversion.get("deskew") is True else conversion.get("deskew") or False
+        assert self.deskew in (False, "affine", "shear"), \
+            f"Unknown deskew mode '{self.deskew}', must be false, 'affine' or 'shear'"
+        assert self.deskew != "shear" or self.scan_type == "stage_scanning", \
+            "deskew: shear is only available for type: stage_scanning"
+        self.deskew_interpolation = conversion.get("deskew_interpolation", "linear")
+        self.deskew_chunk_planes = int(conversion.get("deskew_chunk_planes", 32))
+        # ND2 filename index, saved as JSON and reused while the input folder is unchanged (false: keep in memory)
+        nd2_index = conversion.get("nd2_index")
+        self.nd2_index_path = os.path.join(self.output_path, "nd2_index.json") if nd2_index is None else nd2_index or None
+        # ND2 header metadata cache keyed by path/size/mtime (null: <output_path>/nd2_metadata_cache, false disables)
+        metadata_cache = conversion.get("metadata_cache")
+        self.metadata_cache_dir = (os.path.join(self.output_path, "nd2_metadata_cache") if metadata_cache is None
+                                   else metadata_cache or None)
+        # Resume an interrupted well: keep the existing output and convert only views missing from its manifest
+        self.resume = bool(conversion.get("resume", False))
+
         os.makedirs(self.output_path, exist_ok=True)
         print(" DataConverter initialized.")
 
+    @staticmethod
+    def _resolve_workers(workers) -> int:
+        """Number of decode workers; 'auto' leaves one of the allocated CPUs for the HDF5 writer thread."""
+        if workers == "auto":
+            cpus = int(os.environ.get("SLURM_CPUS_PER_TASK", os.cpu_count() or 1))
+            return max(1, cpus - 1)
+        return max(1, int(workers))
+
     # --- ND2 channel-safe extraction ---
     # def _extract_channel_stack(self, file_path: str, channel_index: int) -> np.ndarray:
         # """
@@ -44,40 +102,333 @@ class DataConverter:
         Open an ND2 file and return the stack for a given channel index,
         handling arbitrary axis order using nd2.ND2File.sizes.
         Optionally fixes corrupted even Z-planes by backfilling.
+
+        Prefer `_iter_channel_stacks` when every channel of a file is needed,
+        as this method decodes the whole ND2 file for a single channel.
+        """
+        for index, stack in self._iter_channel_stacks(file_path):
+            if index == channel_index:
+                return stack
+        raise IndexError(f"Channel {channel_index} not found in {os.path.basename(file_path)}")
+
+    def _iter_channel_stacks(self, file_path: str):
+        """
+        Decode an ND2 file once and yield (channel_index, stack) for every channel.
+
+        The full T/Z/C/Y/X array is read a single time; each channel stack is
+        then taken from that in-memory array, so a multi-channel view is no
+        longer decoded once per channel.
         """
         with nd2.ND2File(file_path) as ndfile:
             sizes = ndfile.sizes  # ordered dict, e.g. {'T': 3, 'Z': 5, 'C': 2, 'Y': 512, 'X': 512}
             arr = ndfile.asarray()  # ndarray, order matches sizes
 
+        for channel_index, stack, channel_sizes in self._split_channels(arr, sizes):
+            stack, _ = self._fix_corrupt_even_planes(stack, channel_sizes, file_path)
+            yield channel_index, stack
+
+    @staticmethod
+    def _split_channels(arr, sizes: dict):
+        """Yield (channel_index, stack, sizes_without_C) for an array ordered as `sizes`."""
         if "C" not in sizes:
-            stack = arr
+            yield 0, arr, dict(sizes)
+            return
+
+        channel_axis = list(sizes.keys()).index("C")
+        channel_sizes = {k: v for k, v in sizes.items() if k != "C"}
+        for channel_index in range(sizes["C"]):
+            yield channel_index, np.take(arr, channel_index, axis=channel_axis), channel_sizes
+
+    # --- Writing views ---
+    def _append_views_from_file(self, bdv_writer, file_path: str, time: int, tile: int, angle: int,
+                                channel_affines: list, view_kwargs: dict):
+        """
+        Write every channel of one ND2 file as a BDV view.
+        `bdv_writer` is a BdvWriter or a BdvWriterThread feeding one.
+        `channel_affines[c]` is the (3,4) affine for channel c; `view_kwargs` are passed to append_view.
+        """
+        if self.deskew:
+            self._deskew_views_from_file(bdv_writer, file_path, time, tile, angle, channel_affines, view_kwargs)
+            return
+        if self.streaming:
+            self._stream_views_from_file(bdv_writer, file_path, time, tile, angle, channel_affines, view_kwargs)
+            return
+
+        for channel_index, channel_stack in self._iter_channel_stacks(file_path):
+            bdv_writer.append_view(
+                stack=channel_stack,
+                time=time,
+                tile=tile,
+                channel=channel_index,
+                angle=angle,
+                m_affine=channel_affines[channel_index],
+                **view_kwargs,
+            )
+
+    def _stream_views_from_file(self, bdv_writer, file_path: str, time: int, tile: int, angle: int,
+                                channel_affines: list, view_kwargs: dict):
+        """
+        Lazily read an ND2 file in Z-chunks and write them into virtual stacks.
+
+        Each channel's lazy view from `_iter_channel_sources` is read `stream_chunk_planes`
+        planes at a time and repaired per block, so peak memory is a few chunks rather
+        than the full view.
+        """
+        for channel_index, stack, preprocess in self._iter_channel_sources(file_path):
+            view = dict(time=time, tile=tile, channel=channel_index, angle=angle)
+            if preprocess is None:  # decoded in memory (no Z axis)
+                bdv_writer.append_view(stack=stack, m_affine=channel_affines[channel_index], **view, **view_kwargs)
+                continue
+            bdv_writer.append_view(
+                stack=None,
+                virtual_stack_dim=tuple(stack.shape),
+                m_affine=channel_affines[channel_index],
+                **view, **view_kwargs,
+            )
+            for z_start in range(0, stack.shape[0], self.stream_chunk_planes):
+                block = preprocess(np.asarray(stack[z_start:z_start + self.stream_chunk_planes]), z_start)
+                bdv_writer.append_substack(block, z_start, **view)
+
+    def _iter_channel_sources(self, file_path: str):
+        """
+        Yield (channel_index, stack, preprocess) for every channel of an ND2 file. When streaming,
+        `stack` is a lazy (Z, Y, X) dask view and `preprocess(block, z_start)` repairs each block read from it
+        (the repairs of each channel are reported once the file is done); otherwise, or if the file has no Z
+        axis, `stack` is the decoded, already repaired array and `preprocess` is None.
+        """
+        if not self.streaming:
+            for channel_index, stack in self._iter_channel_stacks(file_path):
+                yield channel_index, stack, None
+            return
+
+        repair_reports = {}
+        with nd2.ND2File(file_path) as ndfile:
+            sizes = dict(ndfile.sizes)
+            if "Z" not in sizes:
+                print("️ Streaming requested, but no Z axis found. Falling back to in-memory conversion.")
+                for channel_index, stack, channel_sizes in self._split_channels(ndfile.asarray(), sizes):
+                    yield channel_index, self._fix_corrupt_even_planes(stack, channel_sizes, file_path)[0], None
+                return
+
+            channel_sizes = {k: v for k, v in sizes.items() if k != "C"}
+            assert list(channel_sizes.keys()) == ["Z", "Y", "X"], \
+                f"Streaming conversion expects (Z, Y, X) views, got axes {list(sizes.keys())}"
+
+            def repair_for(channel_index):
+                def preprocess(block, z_start):
+                    block, report = self._fix_corrupt_even_planes(block, channel_sizes, file_path, z_offset=z_start,
+                                                                  verbose=False)
+                    if report is not None:
+                        repair_reports.setdefault(channel_index, []).append(report)
+                    return block
+                return preprocess
+
+            lazy_arr = ndfile.to_dask()
+            for channel_index, stack, _ in self._split_channels(lazy_arr, sizes):
+                yield channel_index, stack, repair_for(channel_index)
+
+        for channel_index, reports in sorted(repair_reports.items()):
+            self._print_repair_report(merge_repair_reports(reports), file_path)
+
+    def _deskew_views_from_file(self, bdv_writer, file_path: str, time: int, tile: int, angle: int,
+                                channel_affines: list, view_kwargs: dict):
+        """
+        Resample every channel of one ND2 file (see src/dopm/deskew.py) and write it chunk by chunk.
+
+        'affine' mode writes the full world grid with isotropic pix_x voxels, placed by a translation only.
+        'shear' mode writes the sheared grid of a stage-scan view, placed by the rest of the view transform.
+        """
+        calibration = view_kwargs.get("calibration", (1, 1, 1))
+        pix_x = self.hardcoded_vars["pix_x"]
+        if self.deskew == "shear":
+            shear_y_px, flip_y = self._calculate_stage_scan_shears()[angle]
+            shear_px = shear_y_px * calibration[2]  # the shear acts on calibrated Z
+            deskewed_kwargs = dict(view_kwargs, calibration=(1, 1, 1))
         else:
-            channel_axis = list(sizes.keys()).index("C")
-            stack = np.take(arr, channel_index, axis=channel_axis)
+            deskewed_kwargs = dict(view_kwargs, calibration=(1, 1, 1), voxel_size_xyz=(pix_x, pix_x, pix_x))
+        # Resample with all CPUs when views are converted one at a time, otherwise one thread per decode worker
+        threads = int(os.environ.get("SLURM_CPUS_PER_TASK", os.cpu_count() or 1)) if self.workers <= 1 else 1
+
+        for channel_index, stack, preprocess in self._iter_channel_sources(file_path):
+            affine = channel_affines[channel_index]
+            if self.deskew == "shear":
+                out_shape = shear_output_shape(stack.shape, shear_px)
+                m_affine = residual_affine(affine, calibration, shear_transform(stack.shape, shear_px, flip_y))
+                name_affine = "view transform after shear deskew"
+                chunks = iter_sheared_chunks(stack, shear_px, flip_y, interpolation=self.deskew_interpolation,
+                                             chunk_planes=self.deskew_chunk_planes, preprocess=preprocess)
+            else:
+                origin_xyz, out_shape = output_grid(stack.shape, view_transform(affine, calibration))
+                m_affine, name_affine = translation_affine(origin_xyz), "deskewed view origin"
+                chunks = iter_deskewed_chunks(stack, affine, calibration, interpolation=self.deskew_interpolation,
+                                              chunk_planes=self.deskew_chunk_planes, workers=threads,
+                                              preprocess=preprocess, z_align=2)
+            bdv_writer.append_view(
+                stack=None,
+                virtual_stack_dim=out_shape,
+                time=time, tile=tile, channel=channel_index, angle=angle,
+                m_affine=m_affine, name_affine=name_affine,
+                **deskewed_kwargs,
+            )
+            for z_start, chunk in chunks:
+                bdv_writer.append_substack(chunk, z_start, time=time, tile=tile, channel=channel_index, angle=angle)
+
+    def _convert_views(self, bdv_writer: BdvWriter, jobs: list, view_kwargs: dict,
+                       manifest: ConversionManifest = None):
+        """
+        Convert a list of (file_path, time, tile, angle, channel_affines) jobs into BDV views.
 
-        # --- Hardcoded artefact fix toggle ---
-        if self.hardcoded_vars.get("fix_corrupt_even_planes", False):
-            if "Z" in sizes:
-                z_axis = list(sizes.keys()).index("Z")
-                stack = np.copy(stack)
-                count_fixed = 0
-                for z in range(1, stack.shape[z_axis], 2):
-                    # Replace even-indexed plane with previous one
-                    slicer_prev = [slice(None)] * stack.ndim
-                    slicer_curr = [slice(None)] * stack.ndim
-                    slicer_prev[z_axis] = z - 1
-                    slicer_curr[z_axis] = z
-                    stack[tuple(slicer_curr)] = stack[tuple(slicer_prev)]
-                    count_fixed += 1
-                print(f" Fixed {count_fixed} corrupted even Z-planes in {os.path.basename(file_path)}")
+        With `workers > 1`, a thread pool decodes ND2 files (and applies the even-plane fix)
+        while a single BdvWriterThread owns the H5 handle and drains a bounded queue, so
+        decoding, transforming and writing overlap. Writers with `concurrent_writes` (OME-Zarr)
+        are written to directly from the pool.
+
+        With a `manifest`, jobs it already records are skipped and every finished job is
+        recorded once its writes are flushed.
+        """
+        if manifest is not None:
+            pending = [job for job in jobs if not manifest.is_done(*job[1:4])]
+            if len(pending) < len(jobs):
+                print(f"  - Resuming: {len(jobs) - len(pending)} of {len(jobs)} views already converted")
+            jobs = pending
+
+        def convert_job(writer, job):
+            file_path, time, tile, angle, channel_affines = job
+            print(f"   - Processing: {os.path.basename(file_path)}")
+            if manifest is None:
+                self._append_views_from_file(writer, file_path, time, tile, angle, channel_affines, view_kwargs)
+                return
+            # Record the views from this job's own append_view arguments, not the shared per-setup writer state
+            recorder = ViewRecorder(writer)
+            self._append_views_from_file(recorder, file_path, time, tile, angle, channel_affines, view_kwargs)
+            if isinstance(writer, BdvWriterThread):
+                writer.call(manifest.record, bdv_writer, time, tile, angle, recorder.views)  # after the job's writes
             else:
-                print("️ fix_corrupt_even_planes enabled, but no Z axis found in this ND2 file.")
+                manifest.record(bdv_writer, time, tile, angle, recorder.views)
+
+        if self.workers <= 1:
+            for job in jobs:
+                convert_job(bdv_writer, job)
+            return
+
+        print(f"  - Converting {len(jobs)} views with {self.workers} decode workers")
+
+        def run_pool(writer):
+            with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="nd2-decode") as pool:
+                futures = [pool.submit(convert_job, writer, job) for job in jobs]
+                try:
+                    for future in as_completed(futures):
+                        future.result()
+                except Exception:
+                    for future in futures:
+                        future.cancel()
+                    raise
+
+        if getattr(bdv_writer, "concurrent_writes", False):
+            run_pool(bdv_writer)  # e.g. OME-Zarr: each view is its own array, no single-writer thread needed
+            return
+        with BdvWriterThread(bdv_writer, max_queue=self.queue_size) as writer_thread:
+            run_pool(writer_thread)
+
+    def _create_writer(self, xml_path: str, num_channels: int, num_angles: int, num_tiles: int,
+                       blockdim: tuple, append: bool = False) -> BdvWriter:
+        """
+        Open the configured output backend for one well; both share the BdvWriter interface.
+        With `append`, existing output is reopened instead of deleted.
+        """
+        writer_kwargs = dict(
+            subsamp=((1, 1, 1),),
+            blockdim=blockdim,
+            compression=self.compression,
+            nchannels=num_channels,
+            nangles=num_angles,
+            ntiles=num_tiles,
+            nilluminations=1,
+            overwrite=not append,
+        )
+        if self.output_format == "ome-zarr":
+            return OmeZarrWriter(xml_path, ngff_version=self.ngff_version, **writer_kwargs)
+        return BdvWriter(xml_path, append=append, **writer_kwargs)
 
-        return stack
+    def _open_well_writer(self, xml_path: str, num_channels: int, num_angles: int, num_tiles: int,
+                          blockdim: tuple, resume: bool, source: str = None) -> tuple:
+        """
+        Return (writer, manifest) for one well dataset. The manifest records finished views;
+        with `resume`, the existing output is reopened and the views it records are restored,
+        otherwise (or if it does not match the current settings) the output is started afresh.
+        """
+        fingerprint = dict(format=self.output_format, ngff_version=self.ngff_version, scan_type=self.scan_type,
+                           channels=num_channels, angles=num_angles, tiles=num_tiles, blockdim=blockdim,
+                           compression=self.compression, pyramids=self.pyramid_subsamp, deskew=self.deskew,
+                           source=source)
+        manifest = ConversionManifest(manifest_path(xml_path), fingerprint)
+        storage = os.path.splitext(xml_path)[0] + (".ome.zarr" if self.output_format == "ome-zarr" else ".h5")
+        if resume and os.path.exists(storage) and manifest.load():
+            try:
+                bdv_writer = self._create_writer(xml_path, num_channels, num_angles, num_tiles, blockdim, append=True)
+                manifest.restore(bdv_writer)
+                return bdv_writer, manifest
+            except OSError as e:
+                print(f" WARNING: could not reopen the output of {xml_path} ({e}), converting the well from scratch.")
+        manifest.reset()
+        return self._create_writer(xml_path, num_channels, num_angles, num_tiles, blockdim), manifest
+
+    def _plan_blockdims(self, stack_dims: dict) -> tuple:
+        """
+        Return (blockdim, pyramid_blockdim): the full-resolution chunk shape for BdvWriter and
+        the chunk shapes of the configured pyramid levels, planned from the view shape if chunks == "auto".
+        """
+        pyramid_blockdim = self.pyramid_blockdim or [(8, 128, 128)] * len(self.pyramid_subsamp)
+        if self.chunks is None:
+            return ((64, 64, 64),), pyramid_blockdim
+        if self.chunks != "auto":
+            return (tuple(self.chunks),), pyramid_blockdim
+
+        view_shape = (stack_dims["Z"], stack_dims["Y"], stack_dims["X"])
+        plan = plan_pyramid_chunks(view_shape, [(1, 1, 1)] + self.pyramid_subsamp, dtype="uint16",
+                                   access=self.access_pattern, compression=self.compression)
+        print(f"  - Chunk plan for {self.access_pattern} access:\n{format_chunk_plan(plan)}")
+        planned = [entry["chunk"] for entry in plan]
+        return (planned[0],), self.pyramid_blockdim or planned[1:]
+
+    def _create_pyramids(self, bdv_writer: BdvWriter, pyramid_blockdim: list):
+        """Add the configured downsampled levels to a finished well, using every allocated CPU."""
+        if not self.pyramid_subsamp:
+            return
+        print(f"  - Building {len(self.pyramid_subsamp)} pyramid levels: {self.pyramid_subsamp}")
+        cpus = int(os.environ.get("SLURM_CPUS_PER_TASK", os.cpu_count() or 1))
+        bdv_writer.create_pyramids(subsamp=tuple(self.pyramid_subsamp), blockdim=tuple(pyramid_blockdim),
+                                   workers=cpus)
+
+    def _fix_corrupt_even_planes(self, stack: np.ndarray, sizes: dict, file_path: str,
+                                 z_offset: int = 0, verbose: bool = True) -> tuple:
+        """
+        Backfill corrupted even Z-planes in place if enabled in hardcoded_vars.
+        Returns (stack, report), where report is None when the fix is disabled or not applicable.
+        """
+        # --- Hardcoded artefact fix toggle ---
+        if not self.hardcoded_vars.get("fix_corrupt_even_planes", False):
+            return stack, None
+        if "Z" not in sizes:
+            print("️ fix_corrupt_even_planes enabled, but no Z axis found in this ND2 file.")
+            return stack, None
+
+        report = repair_even_planes(stack, z_axis=list(sizes.keys()).index("Z"), z_offset=z_offset)
+        if verbose:
+            self._print_repair_report(report, file_path)
+        return stack, report
+
+    @staticmethod
+    def _print_repair_report(report: dict, file_path: str):
+        print(f" Fixed {len(report['repaired_planes'])} corrupted even Z-planes in {os.path.basename(file_path)}"
+              f" ({report['seconds'] * 1000:.1f} ms)")
+        if report["skipped_planes"]:
+            print(f"️ Could not fix Z-planes {report['skipped_planes']} (no preceding plane in chunk)")
 
 
     # --- Registration ---
-    def register_dataset(self, xml_path: str, fiji_path: str):
+    def register_dataset(self, xml_path: str, fiji_path: str, bridge=None):
+        """Bead registration in BigStitcher. `bridge` may be a running FijiWorkerPool to skip the Fiji startup."""
         print(f" Registering dataset: {xml_path}")
         sanitized_xml_path = xml_path.replace("\\", "/")
 
@@ -96,14 +447,52 @@ class DataConverter:
         transformation=Affine regularize_model model_to_regularize_with=Rigid lamba=0.10 redundancy=0 significance=10 allowed_error_for_ransac=5 number_of_ransac_iterations=Normal");
         """
 
-        bridge = FijiBridge(fiji_path)
-        bridge.run_macro(macro_code, timeout_seconds=600)
+        bridge = bridge or FijiBridge(fiji_path)
+        bridge.run_macro(macro_code, timeout_seconds=600, label=f"register {os.path.basename(xml_path)}")
         print(f" Registration complete. File '{xml_path}' has been updated.")
 
     # --- Processing wells ---
-    def process_well(self, well: str) -> str:
+    def _dataset_name(self, well: str, registered: bool = False) -> str:
+        return f"dataset_Well{well}" + ("_registered" if registered else "") + ("_deskewed" if self.deskew else "")
+
+    def _well_xml_path(self, dataset_name: str, tile: int = None, time=None) -> str:
+        """
+        XML path of a well dataset, or of one of its shards when a tile and/or time index
+        (or inclusive (first, last) range of time indices) is given.
+        """
+        if tile is None and time is None:
+            return os.path.join(self.output_path, f"{dataset_name}.xml")
+        assert self.output_format == "bdv", "Shard conversion is only needed (and supported) for BDV HDF5 output"
+        os.makedirs(os.path.dirname(shard_xml_path(self.output_path, dataset_name)), exist_ok=True)
+        return shard_xml_path(self.output_path, dataset_name, time=time, tile=tile)
+
+    @staticmethod
+    def _select_jobs(jobs: list, tile: int = None, time=None) -> list:
+        """Keep the (file_path, time, tile, angle, affines) jobs of one shard."""
+        first, last = (time, time) if isinstance(time, int) else time or (None, None)
+        return [job for job in jobs if (first is None or first <= job[1] <= last) and (tile is None or job[2] == tile)]
+
+    def assemble_well(self, well: str, registered: bool = False) -> str:
+        """
+        Link all shards written by `process_well(..., tile=, time=)` (or the registered variant)
+        into the well's BDV XML/H5 without copying data.
+        """
+        dataset_name = self._dataset_name(well, registered)
+        shards = find_shards(self.output_path, dataset_name)
+        if not shards:
+            raise FileNotFoundError(f"No shards found for {dataset_name} in {self.output_path}")
+        return assemble_shards(os.path.join(self.output_path, f"{dataset_name}.xml"), shards)
+
+    def process_well(self, well: str, tile: int = None, time=None, resume: bool = None) -> str:
+        """
+        Convert all views of a well into one dataset. With a `tile` and/or `time` index (or an inclusive
+        (first, last) pair of time indices), only those views are written, into a shard that
+        `assemble_well` later links into the well dataset.
+        With `resume` (default: `conversion.resume`), views finished by an earlier, interrupted
+        run of the same dataset are kept and only the missing ones are converted.
+        """
         print(f" Processing all datasets for well '{well}'...")
-        dataset_dims = Metadata.get_dataset_dimensions_from_filenames(self.input_path, well)
+        dataset_dims = self.nd2_index.dimensions(well)
         if not dataset_dims:
             raise FileNotFoundError(f"No datasets found for well '{well}' in {self.input_path}")
 
@@ -113,8 +502,7 @@ class DataConverter:
         print(f"  - Discovered dimensions: {len(times)} Times, {len(tiles)} Tiles, {len(angles)} Angles")
 
         sample_file_path = self._find_sample_file(well, times[0], tiles[0])
-        meta = Metadata(sample_file_path)
-        all_meta = meta.get_all_metadata()
+        all_meta = Metadata.get_all_metadata_cached(sample_file_path, self.metadata_cache_dir)
         num_channels = len(all_meta["channel_names"])
         z_step = all_meta["z_step"]
 
@@ -128,62 +516,52 @@ class DataConverter:
         else:
             raise ValueError(f"Scan type '{self.scan_type}' is not supported.")
 
-        xml_path = os.path.join(self.output_path, f"dataset_Well{well}.xml")
-        bdv_writer = BdvWriter(
-            xml_path,
-            subsamp=((1, 1, 1),),
-            blockdim=((64, 64, 64),),
-            nchannels=num_channels,
-            nangles=len(angles),
-            ntiles=len(tiles),
-            nilluminations=1,
-            overwrite=True,
-        )
+        xml_path = self._well_xml_path(self._dataset_name(well), tile=tile, time=time)
+        blockdim, pyramid_blockdim = self._plan_blockdims(all_meta["stack_dimensions"])
+        bdv_writer, manifest = self._open_well_writer(
+            xml_path, num_channels, len(angles), len(tiles), blockdim,
+            resume=self.resume if resume is None else resume)
         bdv_writer.set_attribute_labels("angle", tuple(map(str, angles)))
         bdv_writer.set_attribute_labels("channel", tuple(all_meta["channel_names"]))
 
+        view_kwargs = dict(
+            voxel_size_xyz=(self.hardcoded_vars["pix_x"], self.hardcoded_vars["pix_x"], z_step),
+            voxel_units="um",
+            calibration=(1, 1, calibration_z),
+            exposure_time=10,
+            exposure_units="ms",
+        )
+
+        jobs = []
         for time_index, time_val in enumerate(times):
             for tile_index, tile_val in enumerate(tiles):
                 for angle_index, angle_val in enumerate(angles):
                     file_path = self._find_specific_file(well, time_val, tile_val, angle_val)
                     if not file_path:
                         continue
-                    print(f"   - Processing: {os.path.basename(file_path)}")
-
-                    for channel_index in range(num_channels):
-                        channel_stack = self._extract_channel_stack(file_path, channel_index)
-
-                        bdv_writer.append_view(
-                            stack=channel_stack,
-                            time=time_index,
-                            tile=tile_index,
-                            channel=channel_index,
-                            angle=angle_index,
-                            m_affine=affine_matrices[angle_index],
-                            voxel_size_xyz=(self.hardcoded_vars["pix_x"],
-                                            self.hardcoded_vars["pix_x"],
-                                            z_step),
-                            voxel_units="um",
-                            calibration=(1, 1, calibration_z),
-                            exposure_time=10,
-                            exposure_units="ms",
-                        )
+                    channel_affines = [affine_matrices[angle_index]] * num_channels
+                    jobs.append((file_path, time_index, tile_index, angle_index, channel_affines))
+
+        self._convert_views(bdv_writer, self._select_jobs(jobs, tile=tile, time=time), view_kwargs, manifest)
+        self._create_pyramids(bdv_writer, pyramid_blockdim)
 
         bdv_writer.write_xml()
         bdv_writer.close()
-        print(f" BDV dataset for well '{well}' created successfully at: {xml_path}")
+        print(f" {self.output_format.upper()} dataset for well '{well}' created successfully at: {xml_path}")
         return xml_path
 
-    def process_well_with_registration(self, well: str, bead_xml_path: str) -> str:
+    def process_well_with_registration(self, well: str, bead_xml_path: str, tile: int = None,
+                                       time=None, resume: bool = None) -> str:
+        """As `process_well`, using the registered affines of a bead dataset for every view."""
         print(f" Processing well '{well}' using registrations from '{bead_xml_path}'...")
         affine_transformations = self._read_registration_affines(bead_xml_path)
-        dataset_dims = Metadata.get_dataset_dimensions_from_filenames(self.input_path, well)
+        dataset_dims = self.nd2_index.dimensions(well)
         times = dataset_dims.get("times", [0])
         tiles = dataset_dims.get("tiles", [0])
         angles = dataset_dims.get("angles", [])
 
         sample_file_path = self._find_sample_file(well, times[0], tiles[0])
-        all_meta_sample = Metadata(sample_file_path).get_all_metadata()
+        all_meta_sample = Metadata.get_all_metadata_cached(sample_file_path, self.metadata_cache_dir)
         num_channels = len(all_meta_sample["channel_names"])
         z_step = all_meta_sample["z_step"]
 
@@ -195,63 +573,41 @@ class DataConverter:
         else:
             raise ValueError(f"Scan type '{self.scan_type}' is not supported.")
 
-        xml_path = os.path.join(self.output_path, f"dataset_Well{well}_registered.xml")
-        bdv_writer = BdvWriter(
-            xml_path,
-            subsamp=((1, 1, 1),),
-            blockdim=((64, 64, 64),),
-            nchannels=num_channels,
-            nangles=len(angles),
-            ntiles=len(tiles),
-            nilluminations=1,
-            overwrite=True,
-        )
+        xml_path = self._well_xml_path(self._dataset_name(well, registered=True), tile=tile, time=time)
+        blockdim, pyramid_blockdim = self._plan_blockdims(all_meta_sample["stack_dimensions"])
+        bdv_writer, manifest = self._open_well_writer(
+            xml_path, num_channels, len(angles), len(tiles), blockdim,
+            resume=self.resume if resume is None else resume, source=os.path.abspath(bead_xml_path))
         bdv_writer.set_attribute_labels("angle", tuple(map(str, angles)))
         bdv_writer.set_attribute_labels("channel", tuple(all_meta_sample["channel_names"]))
 
+        view_kwargs = dict(
+            voxel_size_xyz=(self.hardcoded_vars["pix_x"], self.hardcoded_vars["pix_x"], z_step),
+            voxel_units="um",
+            calibration=(1, 1, calibration_z),
+            exposure_time=10,
+            exposure_units="ms",
+        )
+
+        jobs = []
         for time_index, time_val in enumerate(times):
             for tile_index, tile_val in enumerate(tiles):
                 for angle_index, angle_val in enumerate(angles):
                     file_path = self._find_specific_file(well, time_val, tile_val, angle_val)
                     if not file_path:
                         continue
-                    print(f"   - Processing: {os.path.basename(file_path)}")
-
-                    for channel_index in range(num_channels):
-                        channel_stack = self._extract_channel_stack(file_path, channel_index)
-                        
-                        # --- THIS IS THE CORRECTED LOGIC ---
-                        # Directly use the final transform from the bead file.
-                        angle_key = f'angle_{angle_index}'
-                        # if len(tiles) > 1:
-                        #     view_key = (channel_index, angle_index, tile_index)
-                        # else:
-                        #     view_key = (channel_index, angle_index)
-                            
-                        view_key = (channel_index, angle_index)
-                        
-                        final_affine = affine_transformations[angle_key][view_key]
-                        
-
-                        bdv_writer.append_view(
-                            stack=channel_stack,
-                            time=time_index,
-                            tile=tile_index,
-                            channel=channel_index,
-                            angle=angle_index,
-                            m_affine=final_affine[:3, :4],
-                            voxel_size_xyz=(self.hardcoded_vars["pix_x"],
-                                            self.hardcoded_vars["pix_x"],
-                                            z_step),
-                            voxel_units="um",
-                            calibration=(1, 1, calibration_z),
-                            exposure_time=10,
-                            exposure_units="ms",
-                        )
+                    # Directly use the final transform from the bead file.
+                    angle_key = f'angle_{angle_index}'
+                    channel_affines = [affine_transformations[angle_key][(channel_index, angle_index)][:3, :4]
+                                       for channel_index in range(num_channels)]
+                    jobs.append((file_path, time_index, tile_index, angle_index, channel_affines))
+
+        self._convert_views(bdv_writer, self._select_jobs(jobs, tile=tile, time=time), view_kwargs, manifest)
+        self._create_pyramids(bdv_writer, pyramid_blockdim)
 
         bdv_writer.write_xml()
         bdv_writer.close()
-        print(f" Registered BDV dataset for well '{well}' created at: {xml_path}")
+        print(f" Registered {self.output_format.upper()} dataset for well '{well}' created at: {xml_path}")
         return xml_path
 
     # --- Helper methods ---
@@ -275,19 +631,19 @@ class DataConverter:
         bdv_editor.finalize(); print("   Successfully read registration transforms.")
         return affine_transformations
 
+    @property
+    def nd2_index(self) -> ND2Index:
+        """(well, time, tile, angle) -> ND2 path index of the input folder, scanned once and shared."""
+        return ND2Index.for_directory(self.input_path, self.nd2_index_path)
+
     def _find_sample_file(self, well: str, time: int, tile: int) -> str:
-        pattern = re.compile(rf".*?_Time{time:04d}_Tile{tile:04d}_angle(\d+)_{{1,2}}Well{well}.*\.nd2")
-        for filename in os.listdir(self.input_path):
-            if pattern.match(filename):
-                return os.path.join(self.input_path, filename)
-        raise FileNotFoundError(f"Could not find a sample file for well {well}")
+        file_path = self.nd2_index.find_any_angle(well, time, tile)
+        if file_path is None:
+            raise FileNotFoundError(f"Could not find a sample file for well {well}")
+        return file_path
 
     def _find_specific_file(self, well: str, time: int, tile: int, angle: int) -> str | None:
-        pattern = re.compile(rf".*?_Time{time:04d}_Tile{tile:04d}_angle{angle}_{{1,2}}Well{well}.*\.nd2")
-        for filename in os.listdir(self.input_path):
-            if pattern.match(filename):
-                return os.path.join(self.input_path, filename)
-        return None
+        return self.nd2_index.find(well, time, tile, angle)
 
     def _calculate_stage_scan_affines(self, stack_dims: dict) -> list:
         Y = stack_dims["Y"]
@@ -322,6 +678,15 @@ class DataConverter:
         combined_matrix_view2 = np.linalg.multi_dot([affine_matrix_7, affine_matrix_6, affine_matrix_5])
         return [combined_matrix_view1[:3, :4], combined_matrix_view2[:3, :4]]
 
+    def _calculate_stage_scan_shears(self) -> list:
+        """
+        (shear_y_px, flip_y) of the Y shear each stage-scan view starts with, per angle, matching
+        `_calculate_stage_scan_affines`: view 1 flips Y then shears by +shear_y_px, view 2 shears by -shear_y_px.
+        The shear is in pixels per calibrated Z pixel.
+        """
+        shear_y_px = 1 / math.tan(2 * math.radians(self.hardcoded_vars["mirror_tilt"]))
+        return [(shear_y_px, True), (-shear_y_px, False)]
+
     def _calculate_remote_scan_affines(self, stack_dims: dict, z_step: float) -> list:
         X, Y, Z = stack_dims["X"], stack_dims["Y"], stack_dims["Z"]
         mirror_tilt = self.hardcoded_vars["mirror_tilt"]
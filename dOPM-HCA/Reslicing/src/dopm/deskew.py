@@ -0,0 +1,254 @@
+# src/dopm/deskew.py
+
+"""
+Native deskewing of dOPM views with NumPy/SciPy.
+
+The shear/rotate/flip geometry that `DataConverter` writes into the BDV XML
+(one (3,4) affine per view, followed by the (1, 1, calibration_z) calibration)
+maps voxel (x, y, z) of a raw view to world coordinates in units of pix_x.
+This module resamples a raw (z, y, x) view onto the isotropic world grid
+covering its bounding box, so deskewed volumes can be produced without Fiji.
+
+The output is computed in chunks of Z-planes on a thread pool. For every
+output chunk only the input region it maps back to is read, so a lazy input
+(e.g. nd2's dask array) is decoded piecewise and peak memory is a few chunks.
+"""
+
+import numpy as np
+import scipy.ndimage as ndi
+from concurrent.futures import ThreadPoolExecutor
+
+INTERPOLATION_ORDERS = {"nearest": 0, "linear": 1}
+SHEAR_TOLERANCE = 1e-6  # shifts within this of an integer row count as that row (float round-off)
+
+
+def view_transform(m_affine, calibration=(1, 1, 1)) -> np.ndarray:
+    """4x4 world-from-voxel transform in (x, y, z) order: the view affine applied after the calibration."""
+    affine = np.vstack([np.asarray(m_affine, dtype=float).reshape(3, 4), [0, 0, 0, 1]])
+    return affine @ np.diag([calibration[0], calibration[1], calibration[2], 1.0])
+
+
+def output_grid(shape_zyx, transform) -> tuple:
+    """
+    Bounding box of a transformed view on the integer world grid.
+
+    Returns:
+    --------
+        (origin_xyz, shape_zyx): world coordinates of output voxel (0, 0, 0) and the output shape.
+    """
+    nz, ny, nx = shape_zyx
+    corners = np.array([[x, y, z, 1.0] for z in (0, nz - 1) for y in (0, ny - 1) for x in (0, nx - 1)])
+    world = (transform @ corners.T)[:3]
+    lower = np.floor(world.min(axis=1) + 1e-6)
+    upper = np.ceil(world.max(axis=1) - 1e-6)
+    origin_xyz = lower.astype(int)
+    size_xyz = (upper - lower).astype(int) + 1
+    return tuple(int(v) for v in origin_xyz), tuple(int(v) for v in size_xyz[::-1])
+
+
+def index_mapping(transform, origin_xyz):
+    """(matrix, offset) mapping output (z, y, x) indices to input (z, y, x) indices."""
+    flip = np.eye(3)[::-1]  # (x, y, z) <-> (z, y, x)
+    inverse = np.linalg.inv(transform)
+    matrix = flip @ inverse[:3, :3] @ flip
+    offset = flip @ (inverse[:3, :3] @ np.asarray(origin_xyz, dtype=float) + inverse[:3, 3])
+    return matrix, offset
+
+
+def input_region(matrix, offset, out_start, out_stop, in_shape, order):
+    """Input (z, y, x) slices needed for the output box [out_start, out_stop), with an interpolation margin."""
+    corners = np.array([[z, y, x] for z in (out_start[0], out_stop[0] - 1)
+                        for y in (out_start[1], out_stop[1] - 1) for x in (out_start[2], out_stop[2] - 1)], dtype=float)
+    mapped = corners @ matrix.T + offset
+    margin = 1 + order
+    lower = np.maximum(np.floor(mapped.min(axis=0)).astype(int) - margin, 0)
+    upper = np.minimum(np.ceil(mapped.max(axis=0)).astype(int) + margin + 1, in_shape)
+    return tuple(slice(int(lo), int(max(lo, up))) for lo, up in zip(lower, upper))
+
+
+def iter_deskewed_chunks(stack, m_affine, calibration=(1, 1, 1), interpolation="linear", chunk_planes=32,
+                         workers=None, preprocess=None, z_align=1):
+    """
+    Resample a raw view onto its deskewed world grid, chunk by chunk.
+
+    Parameters:
+    -----------
+        stack: array-like (z, y, x)
+            Raw view; numpy, or any lazily sliceable array such as nd2's dask view.
+        m_affine: (3, 4) array
+            View affine as written into the BDV XML (translation in the last column, (x, y, z) order).
+        calibration: tuple of 3 floats
+            (x, y, z) calibration applied before the affine, e.g. (1, 1, z_step / pix_x).
+        interpolation: str
+            'linear' or 'nearest'.
+        chunk_planes: int
+            Output Z-planes per chunk.
+        workers: int, optional
+            Resampling threads. Default 1.
+        preprocess: callable(block, z_start) -> block, optional
+            Applied to each input region after reading, e.g. the even-plane repair.
+        z_align: int
+            Start every input region on a multiple of this many planes (2 keeps the even-plane repair exact).
+
+    Yields:
+    -------
+        (z_start, chunk): output Z offset and a uint16 (z, y, x) chunk, in Z order.
+        The output shape and origin are given by `output_grid(stack.shape, view_transform(...))`.
+    """
+    assert interpolation in INTERPOLATION_ORDERS, \
+        f"Unknown interpolation {interpolation}, must be one of {tuple(INTERPOLATION_ORDERS)}"
+    order = INTERPOLATION_ORDERS[interpolation]
+    transform = view_transform(m_affine, calibration)
+    origin_xyz, out_shape = output_grid(stack.shape, transform)
+    matrix, offset = index_mapping(transform, origin_xyz)
+
+    def resample(z_start):
+        z_stop = min(z_start + chunk_planes, out_shape[0])
+        region = input_region(matrix, offset, (z_start, 0, 0), (z_stop, out_shape[1], out_shape[2]),
+                               stack.shape, order)
+        region = (slice(region[0].start // z_align * z_align, region[0].stop),) + region[1:]
+        chunk_shape = (z_stop - z_start,) + tuple(out_shape[1:])
+        if any(s.stop <= s.start for s in region):
+            return np.zeros(chunk_shape, dtype=np.uint16)
+        block = np.asarray(stack[region])
+        if preprocess is not None:
+            block = preprocess(block, region[0].start)
+        # shift the mapping to the chunk's output origin and to the input region's corner
+        chunk_offset = offset + matrix @ np.array([z_start, 0, 0]) - np.array([s.start for s in region])
+        return ndi.affine_transform(block, matrix, offset=chunk_offset, output_shape=chunk_shape,
+                                    output=np.uint16, order=order, mode="constant", cval=0, prefilter=False)
+
+    starts = list(range(0, out_shape[0], chunk_planes))
+    workers = max(1, workers or 1)
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="deskew") as pool:
+        # keep at most 2 * workers chunks in flight so memory stays bounded
+        pending = [pool.submit(resample, z) for z in starts[:2 * workers]]
+        for index, z_start in enumerate(starts):
+            chunk = pending[index].result()
+            pending[index] = None
+            if index + 2 * workers < len(starts):
+                pending.append(pool.submit(resample, starts[index + 2 * workers]))
+            yield z_start, chunk
+
+
+def deskew_view(stack, m_affine, calibration=(1, 1, 1), interpolation="linear", chunk_planes=32, workers=None):
+    """
+    Deskew a whole view into memory.
+
+    Returns:
+    --------
+        (volume, origin_xyz): uint16 (z, y, x) volume and the world coordinates of its first voxel.
+    """
+    origin_xyz, out_shape = output_grid(stack.shape, view_transform(m_affine, calibration))
+    volume = np.empty(out_shape, dtype=np.uint16)
+    for z_start, chunk in iter_deskewed_chunks(stack, m_affine, calibration, interpolation, chunk_planes, workers):
+        volume[z_start:z_start + chunk.shape[0]] = chunk
+    return volume, origin_xyz
+
+
+def translation_affine(origin_xyz) -> np.ndarray:
+    """(3, 4) affine placing a deskewed volume at `origin_xyz` in world coordinates."""
+    affine = np.zeros((3, 4))
+    affine[:, :3] = np.eye(3)
+    affine[:, 3] = origin_xyz
+    return affine
+
+
+# --- Shear-only fast path (stage scanning) ---
+# A stage-scan view starts with an optional Y flip followed by a pure Y shear proportional to Z.
+# Resampling only that step keeps every raw plane a plane of the output: each plane is shifted by a
+# whole number of rows plus a sub-pixel linear blend, so the cost and memory are O(plane). The rest of
+# the view transform stays an affine in the XML, see `residual_affine`.
+
+def shear_transform(shape_zyx, shear_px, flip_y=False) -> np.ndarray:
+    """
+    4x4 (x, y, z) transform from raw voxels to the sheared grid:
+    y_out = (flipped) y + shear_px * z + y_shift, with y_shift keeping y_out >= 0.
+    """
+    nz, ny, _ = shape_zyx
+    y_shift = -min(0.0, shear_px * (nz - 1))
+    transform = np.eye(4)
+    transform[1, 2] = shear_px
+    if flip_y:
+        transform[1, 1] = -1.0
+        transform[1, 3] = (ny - 1) + y_shift
+    else:
+        transform[1, 3] = y_shift
+    return transform
+
+
+def shear_output_shape(shape_zyx, shear_px) -> tuple:
+    """(z, y, x) shape of the sheared grid."""
+    nz, ny, nx = shape_zyx
+    return nz, ny + int(np.ceil(abs(shear_px) * (nz - 1) - SHEAR_TOLERANCE)), nx
+
+
+def residual_affine(m_affine, calibration, shear) -> np.ndarray:
+    """(3, 4) affine placing the sheared grid in world coordinates: the view transform with the shear factored out."""
+    return (view_transform(m_affine, calibration) @ np.linalg.inv(shear))[:3, :]
+
+
+def _shear_plane(plane, shift, out_rows, order):
+    """Shift a (y, x) plane down by `shift` rows (float) into an array of `out_rows` rows."""
+    ny = plane.shape[0]
+    out = np.zeros((out_rows, plane.shape[1]), dtype=np.float32 if order else plane.dtype)
+    if order == 0:
+        row = int(np.floor(shift + 0.5))
+        out[row:row + ny] = plane
+        return out
+    # Snap near-integer shifts with the same tolerance as `shear_output_shape`, so the second
+    # (fractional) row write never runs past `out_rows`
+    row = int(np.floor(shift + SHEAR_TOLERANCE))
+    frac = shift - row
+    if frac <= SHEAR_TOLERANCE:
+        frac = 0.0
+    assert 0 <= row and row + ny + (frac > 0) <= out_rows, \
+        f"Shift {shift} does not fit a plane of {ny} rows into {out_rows} rows"
+    frac = np.float32(frac)
+    out[row:row + ny] += (1 - frac) * plane
+    if frac > 0:
+        out[row + 1:row + 1 + ny] += frac * plane
+    return out
+
+
+def iter_sheared_chunks(stack, shear_px, flip_y=False, interpolation="linear", chunk_planes=32, preprocess=None):
+    """
+    Apply `shear_transform` plane by plane.
+
+    Parameters:
+    -----------
+        stack: array-like (z, y, x)
+            Raw view; numpy or a lazily sliceable array.
+        shear_px: float
+            Y shift in pixels per raw Z-plane (signed).
+        flip_y: bool
+            Flip Y before shearing.
+        interpolation: str
+            'linear' or 'nearest' along Y; X and Z are never resampled.
+        chunk_planes: int
+            Raw planes read and returned per chunk, rounded down to an even number (at least 2).
+        preprocess: callable(block, z_start) -> block, optional
+            Applied to each block of raw planes after reading, e.g. the even-plane repair.
+
+    Yields:
+    -------
+        (z_start, chunk): Z offset and a uint16 (z, y, x) chunk of the sheared volume, in Z order.
+    """
+    assert interpolation in INTERPOLATION_ORDERS, \
+        f"Unknown interpolation {interpolation}, must be one of {tuple(INTERPOLATION_ORDERS)}"
+    order = INTERPOLATION_ORDERS[interpolation]
+    nz, out_rows, nx = shear_output_shape(stack.shape, shear_px)
+    y_shift = shear_transform(stack.shape, shear_px, flip_y)[1, 3] - (stack.shape[1] - 1 if flip_y else 0)
+    chunk_planes = max(2, chunk_planes // 2 * 2)
+
+    for z_start in range(0, nz, chunk_planes):
+        block = np.asarray(stack[z_start:z_start + chunk_planes])
+        if preprocess is not None:
+            block = preprocess(block, z_start)
+        chunk = np.empty((block.shape[0], out_rows, nx), dtype=np.uint16)
+        for iz, plane in enumerate(block):
+            if flip_y:
+                plane = plane[::-1]
+            sheared = _shear_plane(plane, shear_px * (z_start + iz) + y_shift, out_rows, order)
+            chunk[iz] = np.rint(sheared) if order else sheared
+        yield z_start, chunk
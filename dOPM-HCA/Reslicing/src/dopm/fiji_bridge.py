@@ -5,18 +5,23 @@ import os
 import tempfile
 import sys
 
+from src.dopm.fiji_log import EventLog, FijiOutputParser, pump_output
+
 class FijiBridge:
-    def __init__(self, fiji_path: str):
+    def __init__(self, fiji_path: str, log_path: str = None):
         if not os.path.exists(fiji_path):
             raise FileNotFoundError(f"Fiji executable not found at: {fiji_path}")
         self.fiji_path = fiji_path
-        # The __init__ only runs once, so we don't need the print statement here anymore.
+        # Fiji output is parsed into progress/timing events, appended to `log_path` (JSON lines) if given
+        self.event_log = EventLog(log_path)
 
-    def run_macro(self, macro_code: str, headless: bool = True, timeout_seconds: int = 3600):
+    def run_macro(self, macro_code: str, headless: bool = True, timeout_seconds: int = 3600, label: str = None):
         temp_macro_file = tempfile.NamedTemporaryFile(mode='w', suffix='.ijm', delete=False)
         temp_macro_path = temp_macro_file.name
         process = None
-        
+        parser = None
+        status = "failed"
+
         try:
             temp_macro_file.write(macro_code)
             temp_macro_file.close()
@@ -27,14 +32,26 @@ class FijiBridge:
             command.extend(['--run', temp_macro_path])
             
             print(" Launching Fiji subprocess...")
-            process = subprocess.Popen(command)
+            process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                       text=True, bufsize=1, errors="replace")
+            parser = FijiOutputParser(self.event_log, pid=process.pid)
+            parser.start_macro(label)
+            reader = pump_output(process.stdout, parser)
             process.wait(timeout=timeout_seconds)
+            reader.join(timeout=10)
+            status = "ok" if process.returncode == 0 else f"exit code {process.returncode}"
             print(" Fiji subprocess finished waiting.")
 
+        except subprocess.TimeoutExpired:
+            status = "timeout"
+            print(f" Fiji did not finish within {timeout_seconds} s")
+            raise
         except Exception as e:
             print(f" An error occurred during Fiji execution: {e}")
             raise
         finally:
+            if parser is not None:
+                parser.end_macro(status)
             # --- AGGRESSIVE CLEANUP ---
             print("--- Starting post-task cleanup ---")
             if process and process.poll() is None:
@@ -51,4 +68,8 @@ class FijiBridge:
             
             if os.path.exists(temp_macro_path):
                 os.remove(temp_macro_path)
-            print("--- Cleanup complete ---")
\ No newline at end of file
+            print("--- Cleanup complete ---")
+
+    def close(self):
+        """Nothing to release: every macro runs in its own Fiji process (see FijiWorkerPool for persistent workers)."""
+        pass
@@ -0,0 +1,144 @@
+# src/dopm/fiji_log.py
+
+"""
+Structured capture of Fiji console output.
+
+Fiji's stdout/stderr are read line by line, echoed to the console as before, and
+parsed into events that are appended to a JSON-lines log:
+
+    macro_start / macro_end   one per macro, with elapsed_s and status
+    item_start / item_end     one per fused tile or plate item, from the progress lines the
+                              generated macros print ("Fusing tile 3...", "Fusing item 2/5: ...")
+    error                     Java exceptions and error lines
+    worker_ready              startup time of a persistent Fiji worker
+
+`scripts/summarize_fiji_logs.py` aggregates these logs across an array job.
+"""
+
+import json
+import os
+import re
+import socket
+import threading
+import time
+from datetime import datetime
+
+# Progress lines printed by the macros in fusion.py
+_ITEM_PATTERNS = [
+    re.compile(r"Fusing item (?P<number>\d+)/(?P<count>\d+): Well(?P<well>\S+) tile (?P<tile>\d+), "
+               r"timepoints (?P<tp_start>\d+)-(?P<tp_end>\d+)"),
+    re.compile(r"--- Starting range fusion for tile (?P<tile>\d+) \((?P<tp_start>\d+)-(?P<tp_end>\d+)\) ---"),
+    re.compile(r"Fusing tile (?P<tile>\d+)\.\.\."),
+]
+_DONE_PATTERN = re.compile(r"--- (Batch Fusion in Fiji Complete|Range fusion complete|Plate fusion batch \d+ complete) ---")
+_ERROR_PATTERN = re.compile(r"(\b[\w.]*(Exception|Error)\b|\bERROR\b)")
+_INT_FIELDS = ("number", "count", "tile", "tp_start", "tp_end")
+
+
+def default_log_path(log_dir: str = "logs") -> str:
+    """One events file per job: the Slurm array task (or job) ID, else host and PID."""
+    if os.environ.get("SLURM_ARRAY_JOB_ID"):
+        job = f"{os.environ['SLURM_ARRAY_JOB_ID']}_{os.environ.get('SLURM_ARRAY_TASK_ID', 0)}"
+    elif os.environ.get("SLURM_JOB_ID"):
+        job = os.environ["SLURM_JOB_ID"]
+    else:
+        job = f"{socket.gethostname()}_{os.getpid()}"
+    return os.path.join(log_dir, f"fiji_events_{job}.jsonl")
+
+
+class EventLog:
+    """Thread-safe JSON-lines appender; `path=None` keeps events in memory only (`events`)."""
+
+    def __init__(self, path: str = None):
+        self.path = path
+        self.events = []
+        self._lock = threading.Lock()
+        if path:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    def write(self, event: str, **fields):
+        record = {"time": datetime.now().isoformat(timespec="milliseconds"), "event": event,
+                  "host": socket.gethostname(), **fields}
+        with self._lock:
+            self.events.append(record)
+            if self.path:
+                with open(self.path, "a") as f:
+                    f.write(json.dumps(record) + "\n")
+
+
+class FijiOutputParser:
+    """
+    Turns the console lines of one Fiji process into events. `start_macro` / `end_macro`
+    bracket each macro; lines in between are attributed to it.
+    """
+
+    def __init__(self, event_log: EventLog, pid: int = None, echo: bool = True):
+        self.log = event_log
+        self.pid = pid
+        self.echo = echo
+        self.label = None
+        self._macro_started = None
+        self._item = None
+        self._item_started = None
+        self._lock = threading.Lock()
+
+    def start_macro(self, label: str = None):
+        with self._lock:
+            self.label = label or "macro"
+            self._macro_started = time.perf_counter()
+            self._write("macro_start")
+
+    def end_macro(self, status: str = "ok"):
+        with self._lock:
+            self._close_item(status)
+            elapsed = time.perf_counter() - self._macro_started if self._macro_started else None
+            self._write("macro_end", status=status, elapsed_s=_round(elapsed))
+            self.label = None
+            self._macro_started = None
+
+    def feed(self, line: str):
+        """Parse one line of Fiji output (thread-safe; called from the reader thread)."""
+        line = line.rstrip("\r\n")
+        if self.echo:
+            print(line, flush=True)
+        if not line.strip():
+            return
+        with self._lock:
+            for pattern in _ITEM_PATTERNS:
+                match = pattern.search(line)
+                if match:
+                    self._close_item("ok")
+                    self._item = {key: int(value) if key in _INT_FIELDS else value
+                                  for key, value in match.groupdict().items()}
+                    self._item_started = time.perf_counter()
+                    self._write("item_start", **self._item)
+                    return
+            if _DONE_PATTERN.search(line):
+                self._close_item("ok")
+            elif _ERROR_PATTERN.search(line) and not line.lstrip().startswith("at "):
+                self._write("error", message=line.strip(), **(self._item or {}))
+
+    def _close_item(self, status: str):
+        if self._item is not None:
+            self._write("item_end", status=status, elapsed_s=_round(time.perf_counter() - self._item_started),
+                        **self._item)
+            self._item = None
+
+    def _write(self, event: str, **fields):
+        self.log.write(event, label=self.label, pid=self.pid, **fields)
+
+
+def pump_output(stream, parser: FijiOutputParser) -> threading.Thread:
+    """Start a daemon thread feeding every line of `stream` to `parser` until EOF."""
+    def pump():
+        for line in iter(stream.readline, ""):
+            parser.feed(line)
+        stream.close()
+
+    thread = threading.Thread(target=pump, name=f"fiji-output-{parser.pid}", daemon=True)
+    thread.start()
+    return thread
+
+
+def _round(seconds):
+    return None if seconds is None else round(seconds, 3)
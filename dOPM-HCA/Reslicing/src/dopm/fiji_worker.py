@@ -0,0 +1,251 @@
+# src/dopm/fiji_worker.py
+
+"""
+Persistent headless Fiji workers.
+
+`FijiBridge.run_macro` starts a new JVM (and loads BigStitcher) for every macro,
+which costs 20-60 s before any work is done. A `FijiWorker` starts Fiji once with a
+small Groovy server script that listens on a loopback TCP port; each macro is then
+written to a temporary .ijm file and its path sent over the socket, Fiji runs it with
+`IJ.runMacroFile` and answers with one status line.
+
+`FijiWorkerPool` keeps a few such workers and hands each macro to an idle one, so
+independent jobs (e.g. the tiles or wells of a plate) run concurrently. Both classes
+have the same `run_macro` signature as `FijiBridge` and can be used in its place.
+"""
+
+import atexit
+import os
+import queue
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from src.dopm.fiji_log import EventLog, FijiOutputParser, pump_output
+
+# Groovy script run inside Fiji: one macro path per line in, one status line out.
+SERVER_SCRIPT = r"""#@ int port
+import ij.IJ
+
+def server = new ServerSocket(port, 1, InetAddress.getLoopbackAddress())
+println("dOPM Fiji worker listening on port " + port)
+def socket = server.accept()
+def reader = new BufferedReader(new InputStreamReader(socket.getInputStream(), "UTF-8"))
+def writer = new PrintWriter(new OutputStreamWriter(socket.getOutputStream(), "UTF-8"), true)
+def line
+while ((line = reader.readLine()) != null) {
+    if (line == "QUIT") {
+        break
+    }
+    def status = "OK"
+    try {
+        def result = IJ.runMacroFile(line)
+        if (result == "[aborted]") {
+            status = "ERROR macro aborted"
+        }
+    } catch (Throwable t) {
+        status = "ERROR " + t.toString().replaceAll("[\\r\\n]+", " ")
+    }
+    writer.println(status)
+}
+writer.println("BYE")
+socket.close()
+server.close()
+System.exit(0)
+"""
+
+# A worker must outlive its macros, so a trailing run("Quit") is dropped before submission
+_QUIT_CALL = re.compile(r'^\s*run\(\s*"Quit"\s*\)\s*;\s*$', re.MULTILINE)
+
+
+def _free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+def _kill_tree(process: subprocess.Popen):
+    """Terminate a Fiji launcher and the JVM it started (only this worker's processes)."""
+    if process.poll() is not None:
+        return
+    if sys.platform == "win32":
+        subprocess.run(['taskkill', '/F', '/T', '/PID', str(process.pid)], capture_output=True)
+    else:
+        process.terminate()
+    try:
+        process.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+class FijiWorker:
+    """One long-lived headless Fiji process accepting macros over a loopback socket."""
+
+    def __init__(self, fiji_path: str, startup_timeout: int = 600, event_log: EventLog = None):
+        if not os.path.exists(fiji_path):
+            raise FileNotFoundError(f"Fiji executable not found at: {fiji_path}")
+        self.fiji_path = fiji_path
+        self.startup_timeout = startup_timeout
+        self.event_log = event_log or EventLog()
+        self.process = None
+        self._parser = None
+        self._socket = None
+        self._reader = None
+        self._script_path = None
+
+    @property
+    def alive(self) -> bool:
+        return self.process is not None and self.process.poll() is None and self._socket is not None
+
+    def start(self):
+        """Launch Fiji with the server script and wait until it accepts a connection."""
+        with tempfile.NamedTemporaryFile(mode='w', suffix='.groovy', delete=False) as script:
+            script.write(SERVER_SCRIPT)
+            self._script_path = script.name
+        port = _free_port()
+        command = [self.fiji_path, '--headless', '--console', '--run', self._script_path, f'port={port}']
+        print(f" Starting persistent Fiji worker on port {port}...")
+        started = time.perf_counter()
+        self.process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                        text=True, bufsize=1, errors="replace")
+        self._parser = FijiOutputParser(self.event_log, pid=self.process.pid)
+        pump_output(self.process.stdout, self._parser)
+
+        deadline = started + self.startup_timeout
+        while True:
+            if self.process.poll() is not None:
+                self._cleanup_script()
+                raise RuntimeError(f"Fiji worker exited during startup (exit code {self.process.returncode})")
+            try:
+                self._socket = socket.create_connection(("127.0.0.1", port), timeout=5)
+                break
+            except OSError:
+                if time.perf_counter() > deadline:
+                    self.stop()
+                    raise TimeoutError(f"Fiji worker did not start within {self.startup_timeout} s")
+                time.sleep(1)
+        self._reader = self._socket.makefile('r', encoding='utf-8')
+        startup = time.perf_counter() - started
+        self.event_log.write("worker_ready", pid=self.process.pid, elapsed_s=round(startup, 3))
+        print(f" Fiji worker ready after {startup:.1f} s (pid {self.process.pid})")
+        return self
+
+    def run_macro(self, macro_code: str, headless: bool = True, timeout_seconds: int = 3600, label: str = None):
+        """Run one macro in this worker; raises RuntimeError if Fiji reports an error."""
+        if not self.alive:
+            self.start()
+        with tempfile.NamedTemporaryFile(mode='w', suffix='.ijm', delete=False) as macro_file:
+            macro_file.write(_QUIT_CALL.sub("", macro_code))
+            macro_path = macro_file.name
+        parser = self._parser
+        parser.start_macro(label)
+        status = ""
+        try:
+            self._socket.settimeout(timeout_seconds)
+            self._socket.sendall((macro_path.replace("\\", "/") + "\n").encode("utf-8"))
+            status = self._reader.readline().strip()
+        except socket.timeout:
+            status = "ERROR timeout"
+            print(f" Macro did not finish within {timeout_seconds} s; stopping Fiji worker.")
+            self.stop()
+            raise TimeoutError(f"Fiji macro timed out after {timeout_seconds} s")
+        except OSError:
+            self.stop()
+            raise
+        finally:
+            parser.end_macro("ok" if status == "OK" else (status[len("ERROR "):] or "worker exited"))
+            if os.path.exists(macro_path):
+                os.remove(macro_path)
+
+        if not status:
+            self.stop()
+            raise RuntimeError("Fiji worker exited while running a macro")
+        if status != "OK":
+            raise RuntimeError(f"Fiji macro failed: {status[len('ERROR '):]}")
+
+    def stop(self):
+        """Ask Fiji to exit, and kill it if it does not."""
+        if self._socket is not None:
+            try:
+                self._socket.settimeout(30)
+                self._socket.sendall(b"QUIT\n")
+                self._reader.readline()
+            except OSError:
+                pass
+            self._reader.close()
+            self._socket.close()
+            self._socket = self._reader = None
+        if self.process is not None:
+            try:
+                self.process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                pass
+            _kill_tree(self.process)
+        self._cleanup_script()
+
+    def _cleanup_script(self):
+        if self._script_path and os.path.exists(self._script_path):
+            os.remove(self._script_path)
+        self._script_path = None
+
+
+class FijiWorkerPool:
+    """
+    A fixed number of persistent Fiji workers. `run_macro` blocks until a worker is idle,
+    so it may be called from several threads; `run_macros` runs a list of macros concurrently.
+    Workers are started lazily, restarted after a crash or timeout, and stopped by `close`
+    (or at interpreter exit).
+    """
+
+    def __init__(self, fiji_path: str, size: int = 1, startup_timeout: int = 600, log_path: str = None):
+        assert size >= 1, "A Fiji worker pool needs at least one worker"
+        self.size = size
+        # all workers append their progress/timing events to the same JSON-lines log
+        self.event_log = EventLog(log_path)
+        self._workers = [FijiWorker(fiji_path, startup_timeout, self.event_log) for _ in range(size)]
+        self._idle = queue.Queue()
+        for worker in self._workers:
+            self._idle.put(worker)
+        self._closed = threading.Event()
+        atexit.register(self.close)
+
+    def run_macro(self, macro_code: str, headless: bool = True, timeout_seconds: int = 3600, label: str = None):
+        assert not self._closed.is_set(), "Fiji worker pool is closed"
+        worker = self._idle.get()
+        try:
+            worker.run_macro(macro_code, headless=headless, timeout_seconds=timeout_seconds, label=label)
+        finally:
+            self._idle.put(worker)
+
+    def run_macros(self, macros: list, timeout_seconds: int = 3600, labels: list = None) -> list:
+        """Run independent macros on all workers. Returns one exception (or None) per macro, in order."""
+        def run(index):
+            try:
+                self.run_macro(macros[index], timeout_seconds=timeout_seconds,
+                               label=labels[index] if labels else None)
+            except Exception as e:
+                print(f" Job {index} on the Fiji worker pool: {e}")
+                return e
+            return None
+
+        with ThreadPoolExecutor(max_workers=self.size, thread_name_prefix="fiji") as pool:
+            return list(pool.map(run, range(len(macros))))
+
+    def close(self):
+        if self._closed.is_set():
+            return
+        self._closed.set()
+        for worker in self._workers:
+            worker.stop()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
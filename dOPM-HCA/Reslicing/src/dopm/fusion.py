@@ -5,18 +5,40 @@ Supports:
  - Standard multi-tile, all-timepoint fusion (default)
  - Per-tile fusion for HPC job arrays
  - Partial fusion over timepoint ranges for requeue/resume
+ - Plate-wide fusion in balanced, resumable macro batches (see fusion_planner.py)
 """
 
 import os
+from concurrent.futures import ThreadPoolExecutor
+
 from src.dopm.fiji_bridge import FijiBridge
+from src.dopm.fiji_worker import FijiWorkerPool
+from src.dopm.fiji_log import default_log_path
+from src.dopm.fusion_planner import (fusion_items, balance_batches, save_plan, load_plan, done_marker,
+                                     pending_items)
 from src.dopm.npy2bdv import BdvEditor
 
 
 class FusionProcessor:
-    def __init__(self, fiji_path: str, fusion_settings: dict):
-        self.bridge = FijiBridge(fiji_path)
+    def __init__(self, fiji_path: str, fusion_settings: dict, bridge=None):
         self.settings = fusion_settings
         self.binning = str(self.settings.get("binning", 1))
+        # fiji_workers > 0 keeps that many Fiji JVMs alive across macros instead of one launch per call;
+        # a shared FijiBridge / FijiWorkerPool may also be passed in
+        fiji_workers = int(self.settings.get("fiji_workers") or 0)
+        # Fiji progress/timing events go to <fiji_log_dir>/fiji_events_<job>.jsonl (null disables the file)
+        log_dir = self.settings.get("fiji_log_dir", "logs")
+        log_path = default_log_path(log_dir) if log_dir else None
+        if bridge is not None:
+            self.bridge = bridge
+        elif fiji_workers > 0:
+            self.bridge = FijiWorkerPool(fiji_path, size=fiji_workers, log_path=log_path)
+        else:
+            self.bridge = FijiBridge(fiji_path, log_path=log_path)
+
+    def close(self):
+        """Stop any persistent Fiji workers owned by this processor."""
+        self.bridge.close()
 
     # --------------------------------------------------------------------------
     # Default fusion (unchanged, but now with safe macro generation)
@@ -55,7 +77,7 @@ class FusionProcessor:
         print(macro_code.strip())
         print("--------------------")
 
-        self.bridge.run_macro(macro_code)
+        self.bridge.run_macro(macro_code, label=f"fuse {os.path.basename(sanitized_xml_path)}")
         print(f" Fusion complete. Output saved in: {fused_output_path}")
 
     # --------------------------------------------------------------------------
@@ -129,7 +151,7 @@ class FusionProcessor:
 
         print(f"--- Launching Fiji fusion for {well_id} tile {tile_id}, timepoints {tp_start}-{tp_end} ---")
         print(macro_code)
-        self.bridge.run_macro(macro_code)
+        self.bridge.run_macro(macro_code, label=f"fuse {well_id} tile {tile_id} tp {tp_start}-{tp_end}")
         print(f" Fusion complete for {well_id} tile {tile_id} ({tp_start}-{tp_end})")
 
     def _generate_fuse_macro_for_tile_and_timepoints(
@@ -140,7 +162,21 @@ class FusionProcessor:
         Builds a macro that fuses one tile for a specific range of timepoints.
         Example: process_timepoint=[Range of Timepoints (Specify by Name)]
         """
-        options = (
+        options = self._range_fuse_options(xml_path, output_path, tile_id, tp_start, tp_end,
+                                           f"{well_id}_tile{tile_id:03d}")
+
+        macro = (
+            f'print("--- Starting range fusion for tile {tile_id} ({tp_start}-{tp_end}) ---");\n'
+            f'run("Fuse", "{options}");\n'
+            'print("--- Range fusion complete ---");\n'
+            'run("Quit");\n'
+        )
+        return macro
+
+    def _range_fuse_options(self, xml_path: str, output_path: str, tile_id: int, tp_start: int, tp_end: int,
+                            filename_addition: str) -> str:
+        """BigStitcher "Fuse" options for one tile and an inclusive range of timepoints."""
+        return (
             f'select=[{xml_path}] '
             f'process_angle=[All angles] '
             f'process_channel=[All channels] '
@@ -158,13 +194,82 @@ class FusionProcessor:
             f'blend produce=[Each timepoint & channel] '
             f'fused_image=[Save as (compressed) TIFF stacks] '
             f'output_file_directory=[{output_path}] '
-            f'filename_addition=[{well_id}_tile{tile_id:03d}]'
+            f'filename_addition=[{filename_addition}]'
         )
 
-        macro = (
-            f'print("--- Starting range fusion for tile {tile_id} ({tp_start}-{tp_end}) ---");\n'
-            f'run("Fuse", "{options}");\n'
-            'print("--- Range fusion complete ---");\n'
-            'run("Quit");\n'
-        )
-        return macro
+    # --------------------------------------------------------------------------
+    # Plate-wide fusion in balanced batches
+    # --------------------------------------------------------------------------
+    def fuse_plate(self, well_xmls: dict, output_path: str, batches: int = None, batch_index: int = None,
+                   tiles: list = None, tp_start: int = None, tp_end: int = None, tp_chunk: int = None,
+                   replan: bool = False) -> list:
+        """
+        Fuse many wells as `batches` balanced macros, one per Fiji worker.
+
+        The plan is created on first use (or with `replan`) and saved in
+        <output_path>/fused_binning_<n>/fusion_plan, so Slurm array tasks can each run one
+        `batch_index` of the same plan. Items that already have a completion marker are skipped.
+
+        Returns:
+        --------
+            The items that are still pending afterwards (empty when everything is fused).
+        """
+        fused_output_path = os.path.join(output_path, f"fused_binning_{self.binning}").replace("\\", "/")
+        os.makedirs(fused_output_path, exist_ok=True)
+        n_batches = batches or max(1, int(self.settings.get("fiji_workers") or 1))
+
+        plan = None if replan else load_plan(fused_output_path)
+        if plan is None:
+            items = fusion_items(well_xmls, tiles, tp_start, tp_end, tp_chunk)
+            plan = balance_batches(items, n_batches)
+            plan_path = save_plan(fused_output_path, plan)
+            print(f" Planned {len(items)} fusion items from {len(well_xmls)} wells into {len(plan)} batches: {plan_path}")
+        else:
+            print(f" Using the saved fusion plan ({len(plan)} batches) in {fused_output_path}")
+
+        selected = range(len(plan)) if batch_index is None else [batch_index]
+        assert all(0 <= index < len(plan) for index in selected), f"Batch index {batch_index} out of range 0..{len(plan) - 1}"
+        jobs, labels = [], []
+        for index in selected:
+            todo = pending_items(fused_output_path, plan[index])
+            print(f"   - Batch {index}: {len(todo)}/{len(plan[index])} items pending")
+            if todo:
+                jobs.append(self._generate_batch_macro(index, todo, fused_output_path))
+                labels.append(f"plate batch {index}")
+
+        if jobs:
+            if isinstance(self.bridge, FijiWorkerPool):
+                self.bridge.run_macros(jobs, labels=labels)
+            else:
+                # one Fiji launch per batch, the batches side by side
+                with ThreadPoolExecutor(max_workers=len(jobs), thread_name_prefix="fiji") as pool:
+                    list(pool.map(self._run_batch_macro, jobs, labels))
+
+        remaining = [item for index in selected for item in pending_items(fused_output_path, plan[index])]
+        if remaining:
+            print(f"️ {len(remaining)} fusion items are still pending; rerun to resume.")
+        else:
+            print(f" Plate fusion complete. Output saved in: {fused_output_path}")
+        return remaining
+
+    def _run_batch_macro(self, macro_code: str, label: str):
+        try:
+            self.bridge.run_macro(macro_code, label=label)
+        except Exception as e:
+            # the completion markers show what is left, so one failed batch does not stop the others
+            print(f" Fusion batch failed: {e}")
+
+    def _generate_batch_macro(self, batch_index: int, items: list, output_path: str) -> str:
+        """One macro fusing `items` in order, writing each item's completion marker after its Fuse."""
+        lines = [f'print("--- Plate fusion batch {batch_index}: {len(items)} items ---");']
+        for number, item in enumerate(items, start=1):
+            label = f'Well{item["well"]} tile {item["tile"]}, timepoints {item["tp_start"]}-{item["tp_end"]}'
+            options = self._range_fuse_options(item["xml"], output_path, item["tile"], item["tp_start"],
+                                               item["tp_end"], f'Well{item["well"]}_tile{item["tile"]:03d}')
+            lines += [
+                f'print("Fusing item {number}/{len(items)}: {label}");',
+                f'run("Fuse", "{options}");',
+                f'File.saveString("{item["id"]}", "{done_marker(output_path, item)}");',
+            ]
+        lines += [f'print("--- Plate fusion batch {batch_index} complete ---");', 'run("Quit");']
+        return "\n".join(lines) + "\n"
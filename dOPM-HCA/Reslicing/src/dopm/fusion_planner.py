@@ -0,0 +1,140 @@
+# src/dopm/fusion_planner.py
+
+"""
+Plate-level planning of Fiji fusion work.
+
+A plate is split into fusion items: one (well, tile, timepoint range) each, with
+a cost estimate of voxels x timepoints taken from the well's BDV XML. The items are
+distributed over a fixed number of batches with the longest-first greedy rule, so
+that batches take about the same time. Each batch then becomes one Fiji macro that
+fuses its items in turn.
+
+The plan is saved as JSON next to the fused output, so all workers (or Slurm array
+tasks) use the same batches. After each item finishes, the macro writes a marker
+file under `done/`. A rerun skips items that already have a marker, so a crash in
+the middle of a batch only redoes the item that was running.
+"""
+
+import glob
+import json
+import os
+import re
+
+from src.dopm.npy2bdv import BdvEditor
+
+PLAN_DIR = "fusion_plan"
+PLAN_FILE = "plan.json"
+
+
+def find_well_xmls(output_path: str, wells: list = None, registered: bool = True) -> dict:
+    """Map well ID -> dataset XML for the given wells, or for every well dataset in `output_path`."""
+    suffix = "_registered" if registered else ""
+    if wells:
+        xmls = {well: os.path.join(output_path, f"dataset_Well{well}{suffix}.xml") for well in wells}
+        missing = [xml for xml in xmls.values() if not os.path.exists(xml)]
+        if missing:
+            raise FileNotFoundError(f"Dataset XML not found: {', '.join(missing)}")
+        return xmls
+    pattern = re.compile(rf"dataset_Well([A-Za-z0-9]+){suffix}\.xml$")
+    xmls = {}
+    for xml in sorted(glob.glob(os.path.join(output_path, f"dataset_Well*{suffix}.xml"))):
+        match = pattern.search(os.path.basename(xml))
+        if match:
+            xmls[match.group(1)] = xml
+    return xmls
+
+
+def fusion_items(well_xmls: dict, tiles: list = None, tp_start: int = None, tp_end: int = None,
+                 tp_chunk: int = None) -> list:
+    """
+    Split the wells into fusion items.
+
+    Parameters:
+    -----------
+        well_xmls: dict
+            Well ID -> registered dataset XML.
+        tiles: list of int, optional
+            Tiles to fuse. Default: all tiles of each well.
+        tp_start, tp_end: int, optional
+            Inclusive timepoint range. Default: all timepoints.
+        tp_chunk: int, optional
+            Timepoints per item; smaller items resume at a finer grain. Default: the whole range.
+
+    Returns:
+    --------
+        List of item dicts with keys id, well, xml, tile, tp_start, tp_end, cost.
+    """
+    items = []
+    for well, xml in well_xmls.items():
+        editor = BdvEditor(xml, mode="r")
+        try:
+            first = 0 if tp_start is None else tp_start
+            last = editor.ntimes - 1 if tp_end is None else min(tp_end, editor.ntimes - 1)
+            chunk = tp_chunk or (last - first + 1)
+            for tile in (tiles if tiles is not None else range(editor.ntiles)):
+                # voxels of all channels/angles of the tile, per timepoint
+                voxels = 0
+                for channel in range(editor.nchannels):
+                    for angle in range(editor.nangles):
+                        nx, ny, nz = editor.get_view_property("view_shape", channel=channel, tile=tile, angle=angle)
+                        voxels += nx * ny * nz
+                for start in range(first, last + 1, chunk):
+                    stop = min(start + chunk - 1, last)
+                    items.append({
+                        "id": f"Well{well}_tile{tile:03d}_tp{start}-{stop}",
+                        "well": well, "xml": xml.replace("\\", "/"), "tile": tile,
+                        "tp_start": start, "tp_end": stop, "cost": voxels * (stop - start + 1),
+                    })
+        finally:
+            editor.finalize()
+    return items
+
+
+def balance_batches(items: list, n_batches: int) -> list:
+    """
+    Assign items to `n_batches` batches of similar total cost (longest item first, to the lightest batch).
+    Each batch keeps its items in well/tile/timepoint order. Empty batches are dropped.
+    """
+    assert n_batches >= 1, "At least one batch is needed"
+    batches = [[] for _ in range(n_batches)]
+    loads = [0] * n_batches
+    for item in sorted(items, key=lambda item: item["cost"], reverse=True):
+        lightest = loads.index(min(loads))
+        batches[lightest].append(item)
+        loads[lightest] += item["cost"]
+    order = {item["id"]: index for index, item in enumerate(items)}
+    return [sorted(batch, key=lambda item: order[item["id"]]) for batch in batches if batch]
+
+
+def plan_dir(fused_output_path: str) -> str:
+    return os.path.join(fused_output_path, PLAN_DIR)
+
+
+def save_plan(fused_output_path: str, batches: list) -> str:
+    """Write the batches to <fused output>/fusion_plan/plan.json (atomically) and return its path."""
+    directory = plan_dir(fused_output_path)
+    os.makedirs(os.path.join(directory, "done"), exist_ok=True)
+    path = os.path.join(directory, PLAN_FILE)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"batches": batches}, f, indent=2)
+    os.replace(tmp_path, path)
+    return path
+
+
+def load_plan(fused_output_path: str) -> list:
+    """Batches of a saved plan, or None if there is none."""
+    path = os.path.join(plan_dir(fused_output_path), PLAN_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as f:
+        return json.load(f)["batches"]
+
+
+def done_marker(fused_output_path: str, item: dict) -> str:
+    return os.path.join(plan_dir(fused_output_path), "done", f"{item['id']}.done").replace("\\", "/")
+
+
+def pending_items(fused_output_path: str, batch: list) -> list:
+    """Items of a batch that have no completion marker yet."""
+    return [item for item in batch if not os.path.exists(done_marker(fused_output_path, item))]
@@ -2,9 +2,9 @@
 
 import nd2
 import numpy as np
-import os
-import re
-from collections import defaultdict
+
+from src.dopm.nd2_index import ND2Index
+from src.dopm.metadata_cache import MetadataCache
 
 class Metadata:
     """
@@ -16,6 +16,7 @@ class Metadata:
             self._experiment_loop = f.experiment
             self.attributes = f.attributes
             self.metadata = f.metadata
+            self.voxel_size = tuple(f.voxel_size())
     
     def get_stack_dimensions(self) -> dict:
         """Returns the image dimensions (X, Y, Z)."""
@@ -51,45 +52,40 @@ class Metadata:
         return {
             "stack_dimensions": self.get_stack_dimensions(),
             "z_step": self.get_z_step(),
-            "channel_names": self.get_channel_names()
+            "channel_names": self.get_channel_names(),
+            "voxel_size": list(self.voxel_size),
         }
 
+    @staticmethod
+    def get_all_metadata_cached(file_path: str, cache_dir: str = None) -> dict:
+        """
+        `get_all_metadata` of an ND2 file, served from the metadata cache in `cache_dir` when the file
+        (path, size, mtime) is unchanged; the header is only opened on a cache miss.
+        """
+        if not cache_dir:
+            return Metadata(file_path).get_all_metadata()
+        cache = MetadataCache(cache_dir)
+        all_meta = cache.get(file_path)
+        if all_meta is None:
+            all_meta = Metadata(file_path).get_all_metadata()
+            cache.put(file_path, all_meta)
+        return all_meta
+
     @staticmethod
     def get_dataset_dimensions_from_filenames(directory: str, well: str) -> dict:
         """
-        Scans a directory to find all unique times, tiles, angles, etc., for a
-        given well based on the filename pattern.
+        Finds all unique times, tiles, angles, etc., for a given well based on
+        the filename pattern, using the shared ND2 index of the directory.
         """
-        pattern = re.compile(r".*?_Time(\d+)_Tile(\d+)_angle(\d+)_{1,2}Well(" + re.escape(well) + r").*\.nd2")
-        dimensions = defaultdict(set)
-        
-        for filename in os.listdir(directory):
-            match = pattern.match(filename)
-            if match:
-                dimensions["times"].add(int(match.group(1)))
-                dimensions["tiles"].add(int(match.group(2)))
-                dimensions["angles"].add(int(match.group(3)))
-        
-        return {key: sorted(list(value)) for key, value in dimensions.items()}
-    
-    # --- ADD THIS NEW METHOD TO THE METADATA CLASS ---
+        return ND2Index.for_directory(directory).dimensions(well)
+
     @staticmethod
     def discover_wells(directory: str) -> list:
         """
-        Scans a directory and finds all unique well IDs from .nd2 filenames.
+        Finds all unique well IDs from .nd2 filenames ('_WellA6' or '__WellA6').
         """
-        # A regex to find the '_WellA6' or '__WellA6' pattern
-        pattern = re.compile(r"_{1,2}Well([A-Z]\d+)")
-        wells = set()
-        for filename in os.listdir(directory):
-            if not filename.endswith(".nd2"):
-                continue
-            
-            match = pattern.search(filename)
-            if match:
-                wells.add(match.group(1))
-        
+        wells = ND2Index.for_directory(directory).wells()
         if not wells:
             print(f" WARNING: No wells discovered in directory: {directory}")
-        
-        return sorted(list(wells))
+
+        return wells
@@ -0,0 +1,55 @@
+# src/dopm/metadata_cache.py
+
+"""
+Persistent cache of ND2 header metadata.
+
+Reading an ND2 header means opening the file on (often network) storage, which every
+run and every Slurm task used to repeat for the same files. Entries are keyed by the
+file's absolute path, size and modification time, so a changed or re-acquired file is
+never served stale metadata.
+
+One small JSON file per entry (written atomically) keeps the cache safe for many
+concurrent readers/writers on shared file systems, where SQLite locking is unreliable.
+"""
+
+import hashlib
+import json
+import os
+
+
+class MetadataCache:
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def file_identity(file_path: str) -> dict:
+        stat = os.stat(file_path)
+        return {"path": os.path.abspath(file_path), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+    def _entry_path(self, identity: dict) -> str:
+        key = hashlib.sha1(f"{identity['path']}|{identity['size']}|{identity['mtime_ns']}".encode()).hexdigest()
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def get(self, file_path: str):
+        """Cached metadata of `file_path` in its current state, or None."""
+        identity = self.file_identity(file_path)
+        try:
+            with open(self._entry_path(identity), "r") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if any(entry.get(key) != value for key, value in identity.items()):
+            return None
+        return entry["metadata"]
+
+    def put(self, file_path: str, metadata: dict):
+        identity = self.file_identity(file_path)
+        path = self._entry_path(identity)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump({**identity, "metadata": metadata}, f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f" WARNING: could not write metadata cache entry {path}: {e}")
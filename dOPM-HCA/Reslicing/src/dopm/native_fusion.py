@@ -0,0 +1,194 @@
+"""
+Native two-view fusion: a Python replacement for BigStitcher "Fuse".
+
+For every tile, timepoint and channel, the registered angle views are read from
+the BDV H5 (through BdvEditor / h5py), resampled with linear interpolation into
+the common bounding box of the tile's views at `binning` x the source pixel size,
+and blended with distance-based (cosine) weights that fall to zero at each
+view's borders over `blending_range` pixels.
+
+The output volume is computed in Z-blocks on a pool of worker processes; each
+worker opens the H5 once and reads only the region of every view a block needs.
+Fused volumes are written as 16-bit zlib-compressed TIFF stacks, one per
+timepoint and channel, next to the Fiji output layout (`fused_binning_<n>`).
+
+Same interface as FusionProcessor, without a JVM.
+"""
+
+import os
+import h5py
+import numpy as np
+import scipy.ndimage as ndi
+import tifffile
+from concurrent.futures import ProcessPoolExecutor
+
+from src.dopm.npy2bdv import BdvEditor
+from src.dopm.deskew import index_mapping, input_region, output_grid
+
+# Per-process H5 handle, opened once by the pool initializer
+_worker_h5 = None
+
+
+def _open_worker_h5(h5_path):
+    global _worker_h5
+    _worker_h5 = h5py.File(h5_path, "r")
+
+
+def blending_weights(coords, view_shape, blending_range):
+    """
+    Cosine blending weight of each input (z, y, x) coordinate: 1 inside the view, falling to 0 over
+    `blending_range` pixels towards the outer edges of its border voxels, and 0 outside it.
+    """
+    weight = np.ones(coords.shape[1], dtype=np.float32)
+    for axis, n in enumerate(view_shape):
+        distance = np.minimum(coords[axis] + 0.5, (n - 0.5) - coords[axis])
+        ramp = min(blending_range, n / 2)
+        axis_weight = np.where(distance <= 0, 0, 0.5 - 0.5 * np.cos(np.pi * np.clip(distance / ramp, 0, 1)))
+        weight *= axis_weight.astype(np.float32)
+    return weight
+
+
+def _fuse_block(views, z_start, z_stop, out_shape, blending_range):
+    """
+    Fuse output planes [z_start, z_stop) of one tile/timepoint/channel.
+    `views` holds (dataset_name, matrix, offset, view_shape) of every view to blend.
+    """
+    block_shape = (z_stop - z_start,) + tuple(out_shape[1:])
+    grid = np.indices(block_shape, dtype=np.float32).reshape(3, -1)
+    grid[0] += z_start
+    fused = np.zeros(grid.shape[1], dtype=np.float32)
+    weight_sum = np.zeros(grid.shape[1], dtype=np.float32)
+
+    for dataset_name, matrix, offset, view_shape in views:
+        region = input_region(matrix, offset, (z_start, 0, 0), (z_stop,) + tuple(out_shape[1:]), view_shape, order=1)
+        if any(s.stop <= s.start for s in region):
+            continue
+        coords = matrix.astype(np.float32) @ grid + offset.astype(np.float32)[:, None]
+        weight = blending_weights(coords, view_shape, blending_range)
+        inside = weight > 0
+        if not inside.any():
+            continue
+        data = _worker_h5[dataset_name][region].astype(np.uint16)  # BDV stores uint16 data as int16
+        local = coords[:, inside] - np.array([s.start for s in region], dtype=np.float32)[:, None]
+        values = ndi.map_coordinates(data, local, order=1, mode="nearest", prefilter=False)
+        fused[inside] += weight[inside] * values
+        weight_sum[inside] += weight[inside]
+
+    np.divide(fused, weight_sum, out=fused, where=weight_sum > 0)
+    return np.rint(fused).astype(np.uint16).reshape(block_shape)
+
+
+class NativeFusionProcessor:
+    def __init__(self, fusion_settings: dict):
+        self.settings = fusion_settings
+        self.binning = str(self.settings.get("binning", 1))
+        self.blending_range = float(self.settings.get("blending_range", 40))
+        self.workers = int(self.settings.get("workers") or os.environ.get("SLURM_CPUS_PER_TASK", os.cpu_count() or 1))
+        # Output voxels per block; bounds worker memory (~30 bytes per voxel)
+        self.block_voxels = int(self.settings.get("block_voxels", 4_000_000))
+
+    # --------------------------------------------------------------------------
+    # Same entry points as FusionProcessor
+    # --------------------------------------------------------------------------
+    def fuse_volumes(self, xml_path: str, output_prefix: str = "fused", single_tile: int = None):
+        """Fuse all tiles (or `single_tile`) for all timepoints and channels."""
+        fused_output_path = os.path.join(os.path.dirname(xml_path), f"fused_binning_{self.binning}")
+        editor = BdvEditor(xml_path, mode="r")
+        tiles = [single_tile] if single_tile is not None else list(range(editor.ntiles))
+        print(f" Native fusion of {len(tiles)} tile(s) from {xml_path} with {self.workers} workers")
+        self._fuse(editor, fused_output_path, tiles, range(editor.ntimes), lambda tile: f"{output_prefix}_tile{tile}")
+        print(f" Fusion complete. Output saved in: {fused_output_path}")
+
+    def fuse_single_tile_range(self, xml_path: str, output_path: str, well_id: str, tile_id: int,
+                               tp_start: int, tp_end: int):
+        """Fuse one tile for timepoints tp_start..tp_end (inclusive)."""
+        fused_output_path = os.path.join(output_path, f"fused_binning_{self.binning}")
+        editor = BdvEditor(xml_path, mode="r")
+        print(f"--- Native fusion for {well_id} tile {tile_id}, timepoints {tp_start}-{tp_end} ---")
+        self._fuse(editor, fused_output_path, [tile_id], range(tp_start, tp_end + 1),
+                   lambda tile: f"{well_id}_tile{tile:03d}")
+        print(f" Fusion complete for {well_id} tile {tile_id} ({tp_start}-{tp_end})")
+
+    def close(self):
+        """Nothing to release; the worker pool lives only for one `_fuse` call."""
+        pass
+
+    # --------------------------------------------------------------------------
+    def _fuse(self, editor: BdvEditor, fused_output_path: str, tiles, times, name_for_tile):
+        os.makedirs(fused_output_path, exist_ok=True)
+        h5_path = str(editor.filename_h5)
+        try:
+            with ProcessPoolExecutor(max_workers=self.workers, initializer=_open_worker_h5,
+                                     initargs=(h5_path,)) as pool:
+                for tile in tiles:
+                    for time in times:
+                        for channel in range(editor.nchannels):
+                            views, origin_xyz, out_shape = self._plan_views(editor, time, tile, channel)
+                            if not views:
+                                print(f"️ No views for tile {tile}, timepoint {time}, channel {channel}; skipping.")
+                                continue
+                            volume = self._fuse_volume(pool, views, out_shape)
+                            file_name = f"{name_for_tile(tile)}_fused_tp_{time}_ch_{channel}.tif"
+                            self._save_tiff(volume, os.path.join(fused_output_path, file_name), editor, channel)
+                            print(f"   - Fused tile {tile}, timepoint {time}, channel {channel}: {out_shape} -> {file_name}")
+        finally:
+            editor.finalize()
+
+    def _view_transform(self, editor: BdvEditor, time: int, tile: int, channel: int, angle: int,
+                        illumination: int = 0) -> np.ndarray:
+        """4x4 (x, y, z) transform from view voxels to the binned world grid: all XML transforms, then binning."""
+        transform = np.identity(4)
+        for affine in editor.read_affine_list(time=time, illumination=illumination, channel=channel,
+                                              tile=tile, angle=angle):
+            transform = transform @ np.vstack([affine, [0, 0, 0, 1]])
+        binning = float(self.binning)
+        return np.diag([1 / binning, 1 / binning, 1 / binning, 1.0]) @ transform
+
+    def _plan_views(self, editor: BdvEditor, time: int, tile: int, channel: int):
+        """
+        Views of one tile/timepoint/channel with their output-to-input index mappings,
+        on the union bounding box of all the tile's views (all channels and angles).
+        """
+        candidates = []
+        for ch in range(editor.nchannels):
+            for angle in range(editor.nangles):
+                for illumination in range(editor.nilluminations):
+                    isetup = editor._determine_setup_id(illumination, ch, tile, angle)
+                    dataset_name = editor._fmt.format(time, isetup, 0) + "/cells"
+                    if dataset_name not in editor._file_object_h5:
+                        continue
+                    view_shape = editor._file_object_h5[dataset_name].shape
+                    transform = self._view_transform(editor, time, tile, ch, angle, illumination)
+                    candidates.append((ch, dataset_name, transform, view_shape))
+        if not candidates:
+            return [], None, None
+
+        boxes = [output_grid(view_shape, transform) for _, _, transform, view_shape in candidates]
+        lower = np.min([origin for origin, _ in boxes], axis=0)
+        upper = np.max([np.add(origin, shape[::-1]) for origin, shape in boxes], axis=0)
+        origin_xyz = tuple(int(v) for v in lower)
+        out_shape = tuple(int(v) for v in (upper - lower)[::-1])
+
+        views = []
+        for ch, dataset_name, transform, view_shape in candidates:
+            if ch == channel:
+                matrix, offset = index_mapping(transform, origin_xyz)
+                views.append((dataset_name, matrix, offset, view_shape))
+        return views, origin_xyz, out_shape
+
+    def _fuse_volume(self, pool: ProcessPoolExecutor, views: list, out_shape: tuple) -> np.ndarray:
+        block_planes = max(1, self.block_voxels // (out_shape[1] * out_shape[2]))
+        starts = list(range(0, out_shape[0], block_planes))
+        futures = [pool.submit(_fuse_block, views, z, min(z + block_planes, out_shape[0]), out_shape,
+                               self.blending_range) for z in starts]
+        volume = np.empty(out_shape, dtype=np.uint16)
+        for z_start, future in zip(starts, futures):
+            block = future.result()
+            volume[z_start:z_start + block.shape[0]] = block
+        return volume
+
+    def _save_tiff(self, volume: np.ndarray, path: str, editor: BdvEditor, channel: int):
+        """Write a 16-bit ImageJ TIFF stack with the fused (binned, isotropic) voxel size."""
+        voxel = editor.get_view_property("voxel_size", channel=channel)[0] * float(self.binning)
+        tifffile.imwrite(path, volume, imagej=True, compression="zlib",
+                         resolution=(1 / voxel, 1 / voxel), metadata={"spacing": voxel, "unit": "um", "axes": "ZYX"})
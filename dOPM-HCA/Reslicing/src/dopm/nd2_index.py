@@ -0,0 +1,150 @@
+# src/dopm/nd2_index.py
+
+"""
+One-shot index of the ND2 files in an acquisition folder.
+
+Every filename is parsed once into (well, time, tile, angle) -> filename, replacing the
+repeated `os.listdir` + regex scans in `Metadata` and `DataConverter` (which ran once per
+view, i.e. quadratic in the number of files on large plates).
+
+The index can be saved as JSON (e.g. in the output folder) and is reused by later runs
+and Slurm tasks for as long as the folder's modification time is unchanged; adding or
+removing files updates the folder mtime and triggers a rescan.
+"""
+
+import json
+import os
+import re
+from collections import defaultdict
+
+# Same naming scheme as before: ..._Time0000_Tile0000_angle0_WellB2....nd2 (one or two '_' before Well)
+VIEW_PATTERN = re.compile(r".*?_Time(\d+)_Tile(\d+)_angle(\d+)_{1,2}Well([A-Z]\d+)(?!\d).*\.nd2$")
+WELL_PATTERN = re.compile(r"_{1,2}Well([A-Z]\d+)")
+INDEX_VERSION = 1
+
+# In-process indexes by directory, so static Metadata lookups share one scan
+_indexes = {}
+
+
+def _directory_mtime(directory: str) -> int:
+    return os.stat(directory).st_mtime_ns
+
+
+class ND2Index:
+    def __init__(self, directory: str, views: dict, wells: list, mtime_ns: int):
+        """
+        Parameters:
+        -----------
+            directory: str
+                Folder holding the ND2 files.
+            views: dict
+                (well, time, tile, angle) -> filename.
+            wells: list
+                All well IDs found in .nd2 filenames (also files outside the view naming scheme).
+            mtime_ns: int
+                Folder modification time when it was scanned.
+        """
+        self.directory = directory
+        self.views = views
+        self._wells = wells
+        self.mtime_ns = mtime_ns
+        self._by_well = defaultdict(dict)
+        for (well, time, tile, angle), filename in views.items():
+            self._by_well[well][(time, tile, angle)] = filename
+
+    # --- Building and persistence ---
+    @classmethod
+    def scan(cls, directory: str) -> "ND2Index":
+        """Parse every .nd2 filename in `directory` once."""
+        mtime_ns = _directory_mtime(directory)
+        views, wells = {}, set()
+        with os.scandir(directory) as entries:
+            filenames = sorted(entry.name for entry in entries if entry.name.endswith(".nd2"))
+        for filename in filenames:
+            well = WELL_PATTERN.search(filename)
+            if well:
+                wells.add(well.group(1))
+            match = VIEW_PATTERN.match(filename)
+            if match:
+                key = (match.group(4), int(match.group(1)), int(match.group(2)), int(match.group(3)))
+                # first in name order wins, as listdir-based lookups mostly did
+                views.setdefault(key, filename)
+        print(f" Indexed {len(views)} ND2 views of {len(wells)} wells in {directory}")
+        return cls(directory, views, sorted(wells), mtime_ns)
+
+    @classmethod
+    def load(cls, cache_path: str, directory: str):
+        """The index saved at `cache_path`, or None if it is missing, unreadable or out of date."""
+        try:
+            with open(cache_path, "r") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if (data.get("version") != INDEX_VERSION
+                or os.path.abspath(data.get("directory", "")) != os.path.abspath(directory)
+                or data.get("mtime_ns") != _directory_mtime(directory)):
+            return None
+        views = {(well, time, tile, angle): filename for well, time, tile, angle, filename in data["views"]}
+        return cls(directory, views, data["wells"], data["mtime_ns"])
+
+    def save(self, cache_path: str):
+        """Write the index as JSON (atomically, so concurrent Slurm tasks never read a partial file)."""
+        os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+        data = {
+            "version": INDEX_VERSION,
+            "directory": os.path.abspath(self.directory),
+            "mtime_ns": self.mtime_ns,
+            "wells": self._wells,
+            "views": [[*key, filename] for key, filename in sorted(self.views.items())],
+        }
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, cache_path)
+
+    @classmethod
+    def for_directory(cls, directory: str, cache_path: str = None) -> "ND2Index":
+        """
+        Shared index of `directory`: the in-process one, else the saved one at `cache_path`
+        if still current, else a fresh scan (saved to `cache_path` when given).
+        """
+        key = os.path.abspath(directory)
+        index = _indexes.get(key)
+        scanned = False
+        if index is None or index.mtime_ns != _directory_mtime(directory):
+            index = cls.load(cache_path, directory) if cache_path else None
+            if index is None:
+                index = cls.scan(directory)
+                scanned = True
+            _indexes[key] = index
+        if cache_path and (scanned or not os.path.exists(cache_path)):
+            try:
+                index.save(cache_path)
+            except OSError as e:
+                print(f" WARNING: could not save the ND2 index to {cache_path}: {e}")
+        return index
+
+    # --- Lookups ---
+    def wells(self) -> list:
+        return list(self._wells)
+
+    def dimensions(self, well: str) -> dict:
+        """Sorted unique times, tiles and angles of a well ({} if it has no views)."""
+        keys = self._by_well.get(well, {})
+        if not keys:
+            return {}
+        return {
+            "times": sorted({time for time, _, _ in keys}),
+            "tiles": sorted({tile for _, tile, _ in keys}),
+            "angles": sorted({angle for _, _, angle in keys}),
+        }
+
+    def find(self, well: str, time: int, tile: int, angle: int) -> str | None:
+        """Full path of one view's ND2 file, or None."""
+        filename = self._by_well.get(well, {}).get((time, tile, angle))
+        return os.path.join(self.directory, filename) if filename else None
+
+    def find_any_angle(self, well: str, time: int, tile: int) -> str | None:
+        """Full path of the lowest-angle ND2 file of a time point and tile, or None."""
+        angles = sorted(angle for t, ti, angle in self._by_well.get(well, {}) if t == time and ti == tile)
+        return self.find(well, time, tile, angles[0]) if angles else None
@@ -8,7 +8,115 @@ from xml.etree import ElementTree as ET
 import skimage.transform
 import shutil
 from pathlib import Path
-from tqdm import trange
+from concurrent.futures import ThreadPoolExecutor
+from tqdm import tqdm
+
+try:  # optional: registers Blosc/Zstd/LZ4/bitshuffle HDF5 filters with h5py
+    import hdf5plugin
+except ImportError:
+    hdf5plugin = None
+
+PLUGIN_COMPRESSIONS = ('blosc-lz4', 'blosc-lz4hc', 'blosc-zstd', 'zstd', 'lz4', 'bitshuffle-lz4', 'bitshuffle-zstd')
+
+
+def h5_compression_kwargs(compression):
+    """Translate a compression spec into h5py `create_dataset` keyword arguments.
+
+    Parameters:
+    -----------
+        compression: None, str or dict
+            None, 'gzip', 'lzf', or one of the hdf5plugin filters in `PLUGIN_COMPRESSIONS`.
+            A dict {'name': 'blosc-zstd', 'level': 5} also sets the compression level.
+            Blosc filters use bit-shuffling, which suits 16-bit microscopy data.
+
+    Returns:
+    --------
+        dict of `compression` / `compression_opts` keywords.
+    """
+    level = None
+    if isinstance(compression, dict):
+        compression, level = compression.get('name'), compression.get('level')
+    if compression is None:
+        return {'compression': None}
+    if compression == 'gzip':
+        return {'compression': 'gzip', 'compression_opts': 4 if level is None else level}
+    if compression == 'lzf':
+        return {'compression': 'lzf'}
+    assert compression in PLUGIN_COMPRESSIONS, f'Unknown compression {compression}, must be one of' \
+                                               f' {(None, "gzip", "lzf") + PLUGIN_COMPRESSIONS}'
+    if hdf5plugin is None:
+        raise ImportError(f"Compression '{compression}' requires the hdf5plugin package (pip install hdf5plugin).")
+    if compression.startswith('blosc-'):
+        filt = hdf5plugin.Blosc(cname=compression.split('-', 1)[1], clevel=5 if level is None else level,
+                                shuffle=hdf5plugin.Blosc.BITSHUFFLE)
+    elif compression == 'zstd':
+        filt = hdf5plugin.Zstd(clevel=3 if level is None else level)
+    elif compression == 'lz4':
+        filt = hdf5plugin.LZ4()
+    elif compression == 'bitshuffle-lz4':
+        filt = hdf5plugin.Bitshuffle(cname='lz4')
+    else:
+        filt = hdf5plugin.Bitshuffle(cname='zstd', clevel=3 if level is None else level)
+    return dict(filt)
+
+
+def block_mean_downsample(arr, factors, out=None):
+    """Integer block-mean downsampling of a 2d or 3d array by integer factors (e.g. powers of two).
+
+    Gives the same result as `skimage.transform.downscale_local_mean(arr, factors).astype(np.uint16)`
+    for unsigned 16-bit data (edges zero-padded, mean truncated), but sums each block in uint32
+    with strided adds instead of going through float64.
+
+    Parameters:
+    -----------
+        arr: numpy array of uint8, uint16 or int16
+            int16 input is interpreted as the uint16 bit pattern, as stored by this module.
+        factors: array-like of ints >= 1, one per dimension of `arr`.
+        out: numpy array, optional
+            Output buffer of the downsampled shape, filled in place and returned.
+
+    Returns:
+    --------
+        down-scaled array, uint16 type (or `out`).
+    """
+    factors = tuple(int(f) for f in factors)
+    assert len(factors) == arr.ndim, f"Need one factor per dimension, got {factors} for shape {arr.shape}."
+    assert all(f >= 1 for f in factors), f"Downsampling factors must be >= 1, got {factors}."
+    if arr.dtype == np.int16:
+        arr = arr.view(np.uint16)
+    assert arr.dtype in (np.uint8, np.uint16), f"Unsupported dtype {arr.dtype} for integer downsampling."
+
+    out_shape = tuple(-(-n // f) for n, f in zip(arr.shape, factors))
+    pad = [(0, n_out * f - n) for n, n_out, f in zip(arr.shape, out_shape, factors)]
+    if any(p[1] for p in pad):
+        arr = np.pad(arr, pad)  # zero-pad the trailing edge, like downscale_local_mean
+
+    block_size = int(np.prod(factors))
+    acc_dtype = np.uint32 if block_size <= 65537 else np.uint64
+    # Reduce one axis at a time, outermost first, by adding strided slices; each pass shrinks the data.
+    acc = arr
+    for axis in range(arr.ndim):
+        f = factors[axis]
+        if f == 1:
+            continue
+        slicer = [slice(None)] * arr.ndim
+        slicer[axis] = slice(0, None, f)
+        reduced = acc[tuple(slicer)].astype(acc_dtype)
+        for offset in range(1, f):
+            slicer[axis] = slice(offset, None, f)
+            reduced += acc[tuple(slicer)]
+        acc = reduced
+    acc = acc.astype(acc_dtype, copy=False) // block_size
+
+    if out is None:
+        return acc.astype(np.uint16)
+    assert out.shape == out_shape, f"Output buffer shape {out.shape} != downsampled shape {out_shape}."
+    np.copyto(out, acc, casting='unsafe')
+    return out
+
+
+def _integer_downsampling_supported(arr):
+    return arr.dtype in (np.uint8, np.uint16, np.int16)
 
 
 class BdvBase:
@@ -35,9 +143,10 @@ class BdvBase:
                     sq = root.find('SequenceDescription')
                     iml = sq.find('ImageLoader')
                     hdf5_ = iml.find('hdf5')
-                    image_file_name = hdf5_.text
-                    image_file = Path(filename).parent.joinpath(image_file_name)
-                    self.filename_h5 = image_file
+                    if hdf5_ is None:  # other image loader (e.g. OME-Zarr), the writer names its own storage
+                        self.filename_h5 = filename[:-3] + 'h5'
+                    else:
+                        self.filename_h5 = Path(filename).parent.joinpath(hdf5_.text)
                     self.filename_xml = filename
                 except Exception as e:
                     raise ValueError(f"Could no parse XML file {filename}")
@@ -48,7 +157,24 @@ class BdvBase:
         self.nlevels = None
         self.ntimes = self.nilluminations = self.nchannels = self.ntiles = self.nangles = self.nsetups = 0
         self.compression = None
-        self.compressions_supported = (None, 'gzip', 'lzf')
+        self.compressions_supported = (None, 'gzip', 'lzf') + PLUGIN_COMPRESSIONS
+
+    def _check_compression(self, compression):
+        """Validate a compression spec: None, a name, a {'name', 'level'} dict, or a list of these per level."""
+        specs = compression if isinstance(compression, (list, tuple)) else [compression]
+        for spec in specs:
+            name = spec.get('name') if isinstance(spec, dict) else spec
+            assert name in self.compressions_supported, f'Unknown compression {name}, must be one of' \
+                                                        f' {self.compressions_supported}'
+            if name in PLUGIN_COMPRESSIONS and hdf5plugin is None:
+                raise ImportError(f"Compression '{name}' requires the hdf5plugin package (pip install hdf5plugin).")
+
+    def _level_compression(self, ilevel):
+        """h5py compression keywords for pyramid level `ilevel`; a per-level list repeats its last entry."""
+        compression = self.compression
+        if isinstance(compression, (list, tuple)):
+            compression = compression[min(ilevel, len(compression) - 1)] if compression else None
+        return h5_compression_kwargs(compression)
 
     def _determine_setup_id(self, illumination=0, channel=0, tile=0, angle=0):
         """Takes the view attributes (illumination, channel, tile, angle) and converts them into unique setup_id.
@@ -218,6 +344,8 @@ class BdvBase:
         """
         if all(subsamp_level[:] == 1):
             stack_sub = stack
+        elif _integer_downsampling_supported(stack):
+            stack_sub = block_mean_downsample(stack, subsamp_level)
         else:
             stack_sub = skimage.transform.downscale_local_mean(stack, tuple(subsamp_level)).astype(np.uint16)
         return stack_sub
@@ -239,8 +367,11 @@ class BdvBase:
             else:
                 raise ValueError(f"Group name {group_name} not found in the H5 file.")
 
-    def create_pyramids(self, subsamp=((4, 8, 8),), blockdim=((8, 128, 128),), compression=None) -> None:
+    def create_pyramids(self, subsamp=((4, 8, 8),), blockdim=((8, 128, 128),), compression=None,
+                        workers=None) -> None:
         """ Compute and write downsampled versions (pyramids) of the existing image dataset.
+        Each level is computed block by block from the closest coarser-or-equal level already written
+        (not from level 0), using a pool of threads, so memory is bounded by a few blocks per worker.
 
         Parameters:
         -----------
@@ -249,8 +380,11 @@ class BdvBase:
         :param blockdim: tuple of tuples
                 Block size for h5 storage, in pixels, in (z,y,x) order. Default ((4,256,256),).
                 Optimal block size ~0.5 MB.
-        :param compression: None or str
-                (None, 'gzip', 'lzf'), HDF5 compression method. Default is None for high-speed writing.
+        :param compression: None, str or dict
+                HDF5 compression of the new levels, see `h5_compression_kwargs`.
+                Default None keeps the writer's compression setting.
+        :param workers: None or int
+                Number of threads computing blocks. Default None uses all CPUs.
         :return: None
         """
         assert len(self.subsamp) == 1, f"Image pyramids already exist, len(self.subsamp) = {len(self.subsamp)}"
@@ -261,25 +395,61 @@ class BdvBase:
                                               f"be == length of block dimensions {len(blockdim)}."
         for isub in range(len(subsamp)):
             assert sum(subsamp[isub]) > 3, f"At least one subsampling factor from {subsamp[isub]} must be > 1."
-        assert compression in self.compressions_supported, f'Unknown compression, must be one of' \
-                                                           f' {self.compressions_supported}'
+        self._check_compression(compression)
 
+        if compression is not None:
+            self.compression = [self.compression if not isinstance(self.compression, (list, tuple))
+                                else self.compression[0]] + [compression] * len(subsamp)
         self.subsamp = np.asarray([self.subsamp[0]] + list(subsamp))
         self.chunks = np.asarray([self.chunks[0]] + list(blockdim))
         self.nlevels = len(self.subsamp)
 
         self._write_pyramids_header()
-        for time in trange(self.ntimes, desc='time points'):
-            for isetup in trange(self.nsetups, desc='views'):
-                for ilevel in range(1, self.nlevels):
-                    full_res_group_name = self._fmt.format(time, isetup, 0)
-                    if full_res_group_name in self._file_object_h5:
-                        raw_data = self._file_object_h5[full_res_group_name]['cells'][()].astype('uint16')
-                        pyramid_group_name = self._fmt.format(time, isetup, ilevel)
-                        grp = self._file_object_h5.create_group(pyramid_group_name)
-                        subdata = self._subsample_stack(raw_data, self.subsamp[ilevel]).astype('int16')
-                        grp.create_dataset('cells', data=subdata, chunks=tuple(self.chunks[ilevel]),
-                                           maxshape=(None, None, None), compression=self.compression, dtype='int16')
+        views = [(time, isetup) for time in range(self.ntimes) for isetup in range(self.nsetups)
+                 if self._fmt.format(time, isetup, 0) in self._file_object_h5]
+        with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+            for ilevel in range(1, self.nlevels):
+                src_level = self._pyramid_source_level(ilevel)
+                factor = self.subsamp[ilevel] // self.subsamp[src_level]
+                block_shape = tuple(int(b) for b in self.chunks[ilevel])
+                tasks = []
+                for time, isetup in views:
+                    src = self._file_object_h5[self._fmt.format(time, isetup, src_level)]['cells']
+                    dst_shape = tuple(int(np.ceil(n / f)) for n, f in zip(src.shape, factor))
+                    group_name = self._fmt.format(time, isetup, ilevel)
+                    if group_name in self._file_object_h5:  # left by an interrupted run that is being resumed
+                        del self._file_object_h5[group_name]
+                    grp = self._file_object_h5.create_group(group_name)
+                    dst = grp.create_dataset('cells', shape=dst_shape, chunks=block_shape,
+                                             maxshape=(None, None, None), dtype='int16',
+                                             **self._level_compression(ilevel))
+                    tasks.extend((src, dst, factor, block) for block in self._iter_blocks(dst_shape, block_shape))
+                for _ in tqdm(pool.map(lambda task: self._downsample_block(*task), tasks),
+                              total=len(tasks), desc=f'pyramid level {ilevel}'):
+                    pass
+
+    def _pyramid_source_level(self, ilevel):
+        """Most recent (i.e. coarsest) earlier level whose subsampling divides that of `ilevel`; level 0 otherwise."""
+        for src_level in range(ilevel - 1, -1, -1):
+            if np.all(self.subsamp[ilevel] % self.subsamp[src_level] == 0):
+                return src_level
+        return 0
+
+    @staticmethod
+    def _iter_blocks(shape, block_shape):
+        """Yield tuples of slices tiling an array of `shape` in blocks of `block_shape`."""
+        for z in range(0, shape[0], block_shape[0]):
+            for y in range(0, shape[1], block_shape[1]):
+                for x in range(0, shape[2], block_shape[2]):
+                    yield (slice(z, min(z + block_shape[0], shape[0])),
+                           slice(y, min(y + block_shape[1], shape[1])),
+                           slice(x, min(x + block_shape[2], shape[2])))
+
+    def _downsample_block(self, src, dst, factor, dst_block):
+        """Read the source region of one destination block, downsample it and write it."""
+        src_block = tuple(slice(s.start * f, min(s.stop * f, n)) for s, f, n in zip(dst_block, factor, src.shape))
+        raw_data = src[src_block].astype('uint16')
+        dst[dst_block] = self._subsample_stack(raw_data, factor).astype('int16')
 
 
 class BdvWriter(BdvBase):
@@ -289,7 +459,7 @@ class BdvWriter(BdvBase):
                  blockdim=((4, 256, 256),),
                  compression=None,
                  nilluminations=1, nchannels=1, ntiles=1, nangles=1,
-                 overwrite=False):
+                 overwrite=False, append=False):
         """Class for writing multiple numpy 3d-arrays into BigDataViewer/BigStitcher HDF5 file.
 
         Parameters:
@@ -300,8 +470,10 @@ class BdvWriter(BdvBase):
                 Subsampling levels in (z,y,x) order. Integers >= 1, default value ((1, 1, 1),) for no subsampling.
             blockdim: tuple of tuples
                 Block size for h5 storage, in pixels, in (z,y,x) order. Default ((4,256,256),), see notes.
-            compression: None or str
-                (None, 'gzip', 'lzf'), HDF5 compression method. Default is None for high-speed writing.
+            compression: None, str, dict, or list of these (one per subsampling level)
+                HDF5 compression: None, 'gzip', 'lzf', or an hdf5plugin filter such as 'blosc-lz4',
+                'blosc-zstd', 'bitshuffle-lz4' (see `h5_compression_kwargs`). Default is None for high-speed writing.
+                Fiji needs the matching HDF5 filter plugins (HDF5_PLUGIN_PATH) to read plugin-compressed files.
             nilluminations: int
             nchannels: int
             ntiles: int
@@ -309,6 +481,9 @@ class BdvWriter(BdvBase):
                 Number of view attributes, >=1.
             overwrite: boolean
                 If True, overwrite existing file. Default False.
+            append: boolean
+                If True, open an existing file and keep its views, e.g. to resume an interrupted conversion.
+                Views written again replace the old ones. Default False.
 
         .. note::
         ------
@@ -323,8 +498,7 @@ class BdvWriter(BdvBase):
         assert nchannels >= 1, "Total number of channels must be at least 1."
         assert ntiles >= 1, "Total number of tiles must be at least 1."
         assert nangles >= 1, "Total number of angles must be at least 1."
-        assert compression in self.compressions_supported, f'Unknown compression, must be one of' \
-                                                           f' {self.compressions_supported}'
+        self._check_compression(compression)
         assert all([isinstance(element, int) for tupl in subsamp for element in
                     tupl]), 'subsamp values should be integers >= 1.'
         if len(blockdim) < len(subsamp):
@@ -350,14 +524,8 @@ class BdvWriter(BdvBase):
         self.exposure_units = {}
         self.attribute_labels = {}
         self.compression = compression
-        if os.path.exists(self.filename_h5):
-            if overwrite:
-                os.remove(self.filename_h5)
-                print("Warning: H5 file already exists, overwriting.")
-            else:
-                raise FileExistsError(f"File {self.filename_h5} already exists.")
-        self._file_object_h5 = h5py.File(self.filename_h5, 'a')
-        self._write_setups_header()
+        self.append = append
+        self._open_storage(overwrite)
         self.virtual_stacks = False
         self.setup_id_present = [[False] * self.nsetups]
 
@@ -381,6 +549,17 @@ class BdvWriter(BdvBase):
                                                    f'match the number of attributes {self.attribute_counts[attribute]}'
         self.attribute_labels[attribute] = labels
 
+    def _open_storage(self, overwrite):
+        """Create the H5 file and write the setup headers."""
+        if os.path.exists(self.filename_h5) and not self.append:
+            if overwrite:
+                os.remove(self.filename_h5)
+                print("Warning: H5 file already exists, overwriting.")
+            else:
+                raise FileExistsError(f"File {self.filename_h5} already exists.")
+        self._file_object_h5 = h5py.File(self.filename_h5, 'a')
+        self._write_setups_header()
+
     def _compute_chunk_size(self, blockdim):
         """Populate the size of h5 chunks (blocks).
         Use first-level chunk size if there are more subsampling levels than chunk size levels.
@@ -475,7 +654,6 @@ class BdvWriter(BdvBase):
             group_name = self._fmt.format(time, isetup, ilevel)
             dataset = self._file_object_h5[group_name]["cells"]
             subdata = self._subsample_stack(substack, self.subsamp[ilevel]).astype('int16')
-            print(dataset.shape, subdata.shape, self.subsamp[ilevel])
             sub_z_start = int(z_start/self.subsamp[ilevel][0])
             sub_y_start = int(y_start/self.subsamp[ilevel][1])
             sub_x_start = int(x_start/self.subsamp[ilevel][2])
@@ -546,11 +724,11 @@ class BdvWriter(BdvBase):
             if stack is not None:
                 subdata = self._subsample_stack(stack, self.subsamp[ilevel]).astype('int16')
                 grp.create_dataset('cells', data=subdata, chunks=self.chunks[ilevel],
-                                   maxshape=(None, None, None), compression=self.compression, dtype='int16')
+                                   maxshape=(None, None, None), dtype='int16', **self._level_compression(ilevel))
             else:  # a virtual stack initialized
                 grp.create_dataset('cells', chunks=self.chunks[ilevel],
-                                   shape=np.ceil(virtual_stack_dim / self.subsamp[ilevel]),
-                                   compression=self.compression, dtype='int16')
+                                   shape=tuple(np.ceil(np.asarray(virtual_stack_dim) / self.subsamp[ilevel]).astype(int)),
+                                   maxshape=(None, None, None), dtype='int16', **self._level_compression(ilevel))
         if m_affine is not None:
             self.affine_matrices[isetup] = m_affine.copy()
             self.affine_names[isetup] = name_affine
@@ -575,6 +753,8 @@ class BdvWriter(BdvBase):
         assert subsamp_level[0] == 1, "z-subsampling must be == 1 for virtual stacks."
         if all(subsamp_level[:] == 1):
             plane_sub = plane
+        elif _integer_downsampling_supported(plane):
+            plane_sub = block_mean_downsample(plane, subsamp_level[1:])
         else:
             plane_sub = skimage.transform.downscale_local_mean(plane, tuple(subsamp_level[1:])).astype(np.uint16)
         return plane_sub
@@ -610,11 +790,7 @@ class BdvWriter(BdvBase):
         # end of new XML data
 
         seqdesc = ET.SubElement(root, 'SequenceDescription')
-        imgload = ET.SubElement(seqdesc, 'ImageLoader')
-        imgload.set('format', 'bdv.hdf5')
-        el = ET.SubElement(imgload, 'hdf5')
-        el.set('type', 'relative')
-        el.text = os.path.basename(self.filename_h5)
+        self._write_image_loader(seqdesc)
         # write ViewSetups
         viewsets = ET.SubElement(seqdesc, 'ViewSetups')
         for iillumination in range(self.nilluminations):
@@ -701,12 +877,24 @@ class BdvWriter(BdvBase):
         tree = ET.ElementTree(root)
         tree.write(self.filename_xml, xml_declaration=True, encoding='utf-8', method="xml")
 
+    def _write_image_loader(self, seqdesc):
+        """Add the ImageLoader element pointing BDV/BigStitcher at the H5 file."""
+        imgload = ET.SubElement(seqdesc, 'ImageLoader')
+        imgload.set('format', 'bdv.hdf5')
+        el = ET.SubElement(imgload, 'hdf5')
+        el.set('type', 'relative')
+        el.text = os.path.basename(self.filename_h5)
+
     def _update_setup_id_present(self, isetup, itime):
         """Update the lookup table (list of lists) for missing setups"""
-        if len(self.setup_id_present) <= itime:
+        while len(self.setup_id_present) <= itime:
             self.setup_id_present.append([False] * self.nsetups)
         self.setup_id_present[itime][isetup] = True
 
+    def flush(self):
+        """Write buffered data and metadata to disk, so the file is readable if the process dies."""
+        self._file_object_h5.flush()
+
     def close(self):
         """Save changes and close the H5 file."""
         self._file_object_h5.flush()
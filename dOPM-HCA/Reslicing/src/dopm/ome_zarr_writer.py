@@ -0,0 +1,315 @@
+# src/dopm/ome_zarr_writer.py
+
+"""
+OME-Zarr (NGFF) output backend with the BdvWriter interface.
+
+Every view (time point, setup) is written as its own OME-Zarr multiscale image
+at `t{time}/s{setup}` inside one `.ome.zarr` store per well, with arrays in
+(t, c, z, y, x) order and singleton t/c axes, the layout BigStitcher uses for
+OME-Zarr. Views are independent chunked arrays, so several threads (or Slurm
+tasks) can write different views of the same well without HDF5's single-writer
+lock, and each chunk is a separate object on a parallel filesystem.
+
+NGFF coordinate transformations only allow scale and translation, so the
+per-view affine and calibration are stored in the image's `dopm` attributes and
+in the BDV XML written next to the store, which points BigStitcher at the views.
+"""
+
+import os
+import threading
+import shutil
+import numpy as np
+from xml.etree import ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+from tqdm import tqdm
+
+from src.dopm.npy2bdv import BdvWriter
+
+try:  # optional: only needed for OME-Zarr output
+    import zarr
+    import numcodecs
+except ImportError:
+    zarr = numcodecs = None
+
+NGFF_VERSIONS = ("0.4", "0.5")  # 0.4 is stored as Zarr v2, 0.5 as Zarr v3
+ZARR_COMPRESSIONS = (None, 'gzip', 'blosc-lz4', 'blosc-lz4hc', 'blosc-zstd', 'zstd')
+NGFF_SPACE_UNITS = {'um': 'micrometer', 'µm': 'micrometer', 'micron': 'micrometer',
+                    'nm': 'nanometer', 'mm': 'millimeter'}
+
+
+def zarr_compressors(compression, zarr_format):
+    """Translate a BdvWriter-style compression spec into a zarr `compressors` argument.
+
+    Parameters:
+    -----------
+        compression: None, str or dict
+            One of `ZARR_COMPRESSIONS`, or a dict {'name': 'blosc-zstd', 'level': 5}.
+            Blosc codecs use bit-shuffling, which suits 16-bit microscopy data.
+        zarr_format: int
+            2 (numcodecs codecs) or 3 (zarr.codecs).
+
+    Returns:
+    --------
+        None or a list with one codec.
+    """
+    level = None
+    if isinstance(compression, dict):
+        compression, level = compression.get('name'), compression.get('level')
+    if compression is None:
+        return None
+    if compression.startswith('blosc-'):
+        cname = compression.split('-', 1)[1]
+        clevel = 5 if level is None else level
+        if zarr_format == 2:
+            return [numcodecs.Blosc(cname=cname, clevel=clevel, shuffle=numcodecs.Blosc.BITSHUFFLE)]
+        return [zarr.codecs.BloscCodec(cname=cname, clevel=clevel, shuffle='bitshuffle', typesize=2)]
+    if compression == 'zstd':
+        zlevel = 3 if level is None else level
+        return [numcodecs.Zstd(level=zlevel)] if zarr_format == 2 else [zarr.codecs.ZstdCodec(level=zlevel)]
+    if compression == 'gzip':
+        glevel = 4 if level is None else level
+        return [numcodecs.GZip(level=glevel)] if zarr_format == 2 else [zarr.codecs.GzipCodec(level=glevel)]
+    raise ValueError(f"Unknown compression {compression}, must be one of {ZARR_COMPRESSIONS}")
+
+
+class _ZYXArray:
+    """(z,y,x) view of a (t,c,z,y,x) zarr array with singleton t and c, for the block-wise pyramid helpers."""
+
+    def __init__(self, array):
+        self.array = array
+        self.shape = tuple(array.shape[2:])
+
+    def __getitem__(self, key):
+        return self.array[(0, 0) + tuple(key)]
+
+    def __setitem__(self, key, value):
+        self.array[(0, 0) + tuple(key)] = value
+
+
+class OmeZarrWriter(BdvWriter):
+    # Views are separate zarr arrays, so append_view/append_substack may be called from several threads
+    concurrent_writes = True
+
+    def __init__(self, filename,
+                 subsamp=((1, 1, 1),),
+                 blockdim=((4, 256, 256),),
+                 compression=None,
+                 nilluminations=1, nchannels=1, ntiles=1, nangles=1,
+                 overwrite=False, ngff_version="0.4"):
+        """Class for writing numpy 3d-arrays as OME-Zarr multiscale images plus a BigStitcher XML.
+
+        Parameters:
+        -----------
+            filename: string
+                XML file name (full path); the store is written next to it as `<name>.ome.zarr`.
+            subsamp, blockdim, nilluminations, nchannels, ntiles, nangles:
+                As for `BdvWriter`; blockdim is the zarr chunk shape in (z,y,x) order.
+            compression: None, str, dict, or list of these (one per subsampling level)
+                One of `ZARR_COMPRESSIONS`, see `zarr_compressors`.
+            overwrite: boolean
+                If True, delete an existing store. If False, an existing store is opened
+                and new views are added to it, so separate processes can fill one well.
+            ngff_version: str
+                '0.4' (Zarr v2 store) or '0.5' (Zarr v3 store).
+
+        .. note::
+        ------
+        Data is stored as uint16, the native ND2 type, rather than the int16 used by BDV HDF5.
+        """
+        if zarr is None:
+            raise ImportError("OME-Zarr output requires the zarr package (pip install 'zarr>=3').")
+        assert ngff_version in NGFF_VERSIONS, f"Unknown NGFF version {ngff_version}, must be one of {NGFF_VERSIONS}"
+        self.ngff_version = ngff_version
+        self.zarr_format = 2 if ngff_version == "0.4" else 3
+        self._lock = threading.Lock()
+        super().__init__(filename, subsamp=subsamp, blockdim=blockdim, compression=compression,
+                         nilluminations=nilluminations, nchannels=nchannels, ntiles=ntiles, nangles=nangles,
+                         overwrite=overwrite)
+
+    def _check_compression(self, compression):
+        """Validate a compression spec against the codecs available for zarr."""
+        specs = compression if isinstance(compression, (list, tuple)) else [compression]
+        for spec in specs:
+            name = spec.get('name') if isinstance(spec, dict) else spec
+            assert name in ZARR_COMPRESSIONS, f'Unknown compression {name}, must be one of {ZARR_COMPRESSIONS}'
+
+    def _level_compressors(self, ilevel):
+        """zarr compressors for pyramid level `ilevel`; a per-level list repeats its last entry."""
+        compression = self.compression
+        if isinstance(compression, (list, tuple)):
+            compression = compression[min(ilevel, len(compression) - 1)] if compression else None
+        return zarr_compressors(compression, self.zarr_format)
+
+    def _open_storage(self, overwrite):
+        """Create (or reopen) the `.ome.zarr` store next to the XML file."""
+        self.filename_zarr = str(self.filename_xml)[:-len('xml')] + 'ome.zarr'
+        if os.path.exists(self.filename_zarr) and overwrite:
+            shutil.rmtree(self.filename_zarr)
+            print("Warning: Zarr store already exists, overwriting.")
+        self._root_group = zarr.open_group(self.filename_zarr, mode='a', zarr_format=self.zarr_format)
+
+    def _view_group(self, time, isetup):
+        return self._root_group.require_group(f't{time:05d}').require_group(f's{isetup:02d}')
+
+    def _create_level(self, grp, ilevel, shape):
+        """Create the (t,c,z,y,x) array of one resolution level."""
+        kwargs = dict(dimension_names=('t', 'c', 'z', 'y', 'x')) if self.zarr_format == 3 \
+            else dict(chunk_key_encoding={'name': 'v2', 'separator': '/'})
+        return grp.create_array(str(ilevel), shape=(1, 1) + tuple(int(n) for n in shape),
+                                chunks=(1, 1) + tuple(int(c) for c in self.chunks[ilevel]),
+                                dtype='uint16', fill_value=0, compressors=self._level_compressors(ilevel),
+                                overwrite=True, **kwargs)
+
+    def append_view(self, stack, virtual_stack_dim=None,
+                    time=0, illumination=0, channel=0, tile=0, angle=0,
+                    m_affine=None, name_affine='manually defined',
+                    voxel_size_xyz=(1, 1, 1), voxel_units='px', calibration=(1, 1, 1),
+                    exposure_time=0, exposure_units='s'):
+        """
+        Write a 3d (z,y,x) stack as an OME-Zarr multiscale image, or allocate an empty one
+        of size `virtual_stack_dim` to be filled by `append_substack`. Parameters as for `BdvWriter.append_view`.
+        """
+        assert len(calibration) == 3, "Calibration must be a tuple of 3 elements (x, y, z)."
+        assert len(voxel_size_xyz) == 3, "Voxel size must be a tuple of 3 elements (x, y, z)."
+        if stack is not None:
+            assert len(stack.shape) == 3, "Stack should be a 3-dimensional numpy array (z,y,x)"
+            shape = stack.shape
+        else:
+            assert len(virtual_stack_dim) == 3, "Stack is virtual, so parameter virtual_stack_dim must be defined."
+            shape = tuple(virtual_stack_dim)
+
+        with self._lock:
+            if time > self.ntimes - 1:
+                self.ntimes = time + 1
+            isetup = self._determine_setup_id(illumination, channel, tile, angle)
+            self._update_setup_id_present(isetup, time)
+            self.stack_shapes[isetup] = shape
+            self.virtual_stacks = self.virtual_stacks or stack is None
+            if m_affine is not None:
+                self.affine_matrices[isetup] = m_affine.copy()
+                self.affine_names[isetup] = name_affine
+            self.calibrations[isetup] = calibration
+            self.voxel_size_xyz[isetup] = voxel_size_xyz
+            self.voxel_units[isetup] = voxel_units
+            self.exposure_time[isetup] = exposure_time
+            self.exposure_units[isetup] = exposure_units
+            grp = self._view_group(time, isetup)
+
+        for ilevel in range(self.nlevels):
+            level_shape = tuple(np.ceil(np.asarray(shape) / self.subsamp[ilevel]).astype(int))
+            array = self._create_level(grp, ilevel, level_shape)
+            if stack is not None:
+                array[0, 0] = self._subsample_stack(stack, self.subsamp[ilevel]).astype('uint16', copy=False)
+        self._write_multiscales(time, isetup)
+
+    def append_substack(self, substack, z_start, y_start=0, x_start=0,
+                        time=0, illumination=0, channel=0, tile=0, angle=0):
+        """Write a (z,y,x) substack into a view allocated with `append_view(stack=None, ...)`."""
+        assert self.virtual_stacks, "Appending substack requires initialization with virtual stack, " \
+                                    "see append_view(stack=None,...)"
+        isetup = self._determine_setup_id(illumination, channel, tile, angle)
+        shape = self.stack_shapes[isetup]
+        for start, n, dim, name in zip((z_start, y_start, x_start), substack.shape, shape, 'zyx'):
+            assert start + n <= dim, f"Substack offset {start} + {name}-dim {n} > virtual stack {name}-dim {dim}."
+        grp = self._view_group(time, isetup)
+        for ilevel in range(self.nlevels):
+            subdata = self._subsample_stack(substack, self.subsamp[ilevel]).astype('uint16', copy=False)
+            starts = [int(s / f) for s, f in zip((z_start, y_start, x_start), self.subsamp[ilevel])]
+            _ZYXArray(grp[str(ilevel)])[tuple(slice(s, s + n) for s, n in zip(starts, subdata.shape))] = subdata
+
+    def append_plane(self, plane, z, time=0, illumination=0, channel=0, tile=0, angle=0):
+        """Write one (y,x) plane into a virtual stack."""
+        self.append_substack(plane[np.newaxis], z, time=time, illumination=illumination,
+                             channel=channel, tile=tile, angle=angle)
+
+    def _write_multiscales(self, time, isetup):
+        """Write the NGFF multiscales metadata and the dOPM affine of one view."""
+        dx, dy, dz = self.voxel_size_xyz[isetup]
+        unit = NGFF_SPACE_UNITS.get(self.voxel_units[isetup])
+        axes = [{'name': 't', 'type': 'time'}, {'name': 'c', 'type': 'channel'}] + \
+               [dict(name=name, type='space', **({'unit': unit} if unit else {})) for name in 'zyx']
+        datasets = [{'path': str(ilevel),
+                     'coordinateTransformations': [{'type': 'scale',
+                                                    'scale': [1.0, 1.0] + [float(v * f) for v, f in
+                                                                           zip((dz, dy, dx), self.subsamp[ilevel])]}]}
+                    for ilevel in range(self.nlevels)]
+        multiscale = {'name': f't{time:05d}/s{isetup:02d}', 'axes': axes, 'datasets': datasets}
+        dopm = {'setup': int(isetup), 'timepoint': int(time),
+                'calibration': [float(c) for c in self.calibrations[isetup]]}
+        if isetup in self.affine_matrices:
+            dopm['affine'] = np.asarray(self.affine_matrices[isetup], dtype=float).tolist()
+            dopm['name_affine'] = self.affine_names[isetup]
+
+        grp = self._view_group(time, isetup)
+        if self.zarr_format == 2:
+            grp.attrs.update({'multiscales': [dict(version=self.ngff_version, **multiscale)], 'dopm': dopm})
+        else:
+            grp.attrs.update({'ome': {'version': self.ngff_version, 'multiscales': [multiscale]}, 'dopm': dopm})
+
+    def create_pyramids(self, subsamp=((4, 8, 8),), blockdim=((8, 128, 128),), compression=None,
+                        workers=None) -> None:
+        """
+        Add downsampled levels to every view, block by block from the closest finer level,
+        as `BdvBase.create_pyramids` does for HDF5. Parameters as for `BdvBase.create_pyramids`.
+        """
+        assert len(self.subsamp) == 1, f"Image pyramids already exist, len(self.subsamp) = {len(self.subsamp)}"
+        for isub in range(len(subsamp)):
+            assert sum(subsamp[isub]) > 3, f"At least one subsampling factor from {subsamp[isub]} must be > 1."
+        self._check_compression(compression)
+
+        if compression is not None:
+            self.compression = [self.compression if not isinstance(self.compression, (list, tuple))
+                                else self.compression[0]] + [compression] * len(subsamp)
+        self.subsamp = np.asarray([self.subsamp[0]] + list(subsamp))
+        self.chunks = np.asarray([self.chunks[0]] + list(blockdim))
+        self.nlevels = len(self.subsamp)
+
+        views = [(time, isetup) for time in range(len(self.setup_id_present))
+                 for isetup in range(self.nsetups) if self.setup_id_present[time][isetup]]
+        with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+            for ilevel in range(1, self.nlevels):
+                src_level = self._pyramid_source_level(ilevel)
+                factor = self.subsamp[ilevel] // self.subsamp[src_level]
+                block_shape = tuple(int(b) for b in self.chunks[ilevel])
+                tasks = []
+                for time, isetup in views:
+                    grp = self._view_group(time, isetup)
+                    src = _ZYXArray(grp[str(src_level)])
+                    dst_shape = tuple(int(np.ceil(n / f)) for n, f in zip(src.shape, factor))
+                    dst = _ZYXArray(self._create_level(grp, ilevel, dst_shape))
+                    tasks.extend((src, dst, factor, block) for block in self._iter_blocks(dst_shape, block_shape))
+                for _ in tqdm(pool.map(lambda task: self._downsample_block(*task), tasks),
+                              total=len(tasks), desc=f'pyramid level {ilevel}'):
+                    pass
+        for time, isetup in views:
+            self._write_multiscales(time, isetup)
+
+    def _downsample_block(self, src, dst, factor, dst_block):
+        """Read the source region of one destination block, downsample it and write it."""
+        src_block = tuple(slice(s.start * f, min(s.stop * f, n)) for s, f, n in zip(dst_block, factor, src.shape))
+        dst[dst_block] = self._subsample_stack(src[src_block], factor).astype('uint16', copy=False)
+
+    def _write_image_loader(self, seqdesc):
+        """Point BigStitcher's multi-image OME-Zarr loader at the per-view groups."""
+        imgload = ET.SubElement(seqdesc, 'ImageLoader')
+        imgload.set('format', 'bdv.multimg.zarr')
+        imgload.set('version', '1.0')
+        el = ET.SubElement(imgload, 'zarr')
+        el.set('type', 'relative')
+        el.text = os.path.basename(self.filename_zarr)
+        zgroups = ET.SubElement(imgload, 'zgroups')
+        for itime in range(len(self.setup_id_present)):
+            for isetup in range(self.nsetups):
+                if self.setup_id_present[itime][isetup]:
+                    zgroup = ET.SubElement(zgroups, 'zgroup')
+                    zgroup.set('setup', str(isetup))
+                    zgroup.set('tp', str(itime))
+                    zgroup.set('path', f't{itime:05d}/s{isetup:02d}')
+                    zgroup.set('indicies', '[]')
+
+    def flush(self):
+        """Nothing to flush: every zarr write is committed to the store immediately."""
+
+    def close(self):
+        """Nothing to flush: every zarr write is committed to the store immediately."""
+        self._root_group = None
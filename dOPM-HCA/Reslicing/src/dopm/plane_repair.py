@@ -0,0 +1,61 @@
+# src/dopm/plane_repair.py
+
+"""
+In-place repair of the corrupted even Z-planes artefact.
+
+On affected acquisitions every second plane (1-based even, i.e. 0-based odd
+indices 1, 3, 5, ...) is corrupt and is replaced by the plane acquired just
+before it. The repair is a single strided assignment on a view of the stack,
+so no copy of the stack is made and it can be applied to a whole view or to
+one chunk of a streamed view.
+"""
+
+import time
+import numpy as np
+
+
+def repair_even_planes(stack: np.ndarray, z_axis: int = 0, z_offset: int = 0) -> dict:
+    """
+    Replace every odd-indexed Z-plane of `stack` with the plane before it, in place.
+
+    Parameters:
+    -----------
+        stack: numpy array
+            Writable array holding a whole view or a chunk of one.
+        z_axis: int
+            Index of the Z axis in `stack`.
+        z_offset: int
+            Global Z index of the first plane in `stack`, used when repairing a chunk.
+            If it is odd, the first plane needs a predecessor from the previous chunk
+            and is reported in `skipped_planes` instead of being repaired.
+
+    Returns:
+    --------
+        dict with
+            'repaired_planes': list of global Z indices that were overwritten,
+            'skipped_planes': list of global Z indices that could not be repaired,
+            'seconds': wall time of the repair.
+    """
+    start = time.perf_counter()
+    planes = np.moveaxis(stack, z_axis, 0)  # view, writes go straight into `stack`
+    nz = planes.shape[0]
+    first = 1 if z_offset % 2 == 0 else 2
+
+    target = planes[first::2]
+    if len(target):
+        target[...] = planes[first - 1::2][:len(target)]
+
+    return {
+        "repaired_planes": list(range(z_offset + first, z_offset + nz, 2)),
+        "skipped_planes": [z_offset] if first == 2 and nz > 0 else [],
+        "seconds": time.perf_counter() - start,
+    }
+
+
+def merge_repair_reports(reports: list) -> dict:
+    """Combine the per-chunk reports of one view into a single report."""
+    return {
+        "repaired_planes": sorted(z for r in reports for z in r["repaired_planes"]),
+        "skipped_planes": sorted(z for r in reports for z in r["skipped_planes"]),
+        "seconds": sum(r["seconds"] for r in reports),
+    }
@@ -0,0 +1,241 @@
+# src/dopm/plate_scheduler.py
+
+"""
+Plate-level scheduling of ND2 -> BDV conversion.
+
+Instead of one array task per well (whose runtime depends on its tile and time
+point counts), the plate is split into work units of one (well, tile, time point
+range) each, taken from the ND2 index. A unit's cost is the size in bytes of its
+ND2 files. Units are packed into tasks of similar total size with the same
+longest-first rule as the fusion planner, and every unit writes its own BDV shard,
+which `DataConverter.assemble_well` links into the well dataset once all units of
+the well are done.
+
+The plan is saved as JSON in `<output_path>/conversion_plan/`, together with a
+submit script for a Slurm array (one array task per planned task, plus an assembly
+job that waits for the array). `run_local` runs the same units in a process pool
+on a workstation, largest first, assembling each well as soon as its units finish.
+A marker file under `done/` is written after each unit, and units resume from their
+progress manifest, so rerunning a task or the local pool only redoes missing work.
+"""
+
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from src.dopm.data_converter import DataConverter
+from src.dopm.fusion_planner import balance_batches
+from src.dopm.nd2_index import ND2Index
+
+PLAN_DIR = "conversion_plan"
+PLAN_FILE = "plan.json"
+SUBMIT_FILE = "submit_slurm.sh"
+
+
+def conversion_units(nd2_index: ND2Index, wells: list = None, tp_chunk: int = None) -> list:
+    """
+    Split the wells of a plate into conversion units.
+
+    Parameters:
+    -----------
+        nd2_index: ND2Index
+            Index of the plate's ND2 folder.
+        wells: list of str, optional
+            Wells to convert. Default: every well in the index.
+        tp_chunk: int, optional
+            Time points per unit. Default: all time points of the well in one unit per tile.
+
+    Returns:
+    --------
+        List of unit dicts with keys id, well, tile, tp_start, tp_end (tile and time indices, as in
+        the BDV dataset) and cost (ND2 bytes).
+    """
+    units = []
+    for well in wells or nd2_index.wells():
+        dims = nd2_index.dimensions(well)
+        if not dims:
+            print(f" WARNING: no ND2 views found for well {well}, skipping it.")
+            continue
+        times = dims["times"]
+        chunk = tp_chunk or len(times)
+        for tile_index, tile in enumerate(dims["tiles"]):
+            for start in range(0, len(times), chunk):
+                stop = min(start + chunk, len(times)) - 1
+                files = [nd2_index.find(well, time, tile, angle) for time in times[start:stop + 1]
+                         for angle in dims["angles"]]
+                files = [file_path for file_path in files if file_path]
+                if files:
+                    cost = sum(os.path.getsize(file_path) for file_path in files)
+                    units.append({
+                        "id": f"Well{well}_tile{tile_index:03d}_tp{start}-{stop}",
+                        "well": well, "tile": tile_index, "tp_start": start, "tp_end": stop, "cost": cost,
+                    })
+    return units
+
+
+def plan_dir(output_path: str) -> str:
+    return os.path.join(output_path, PLAN_DIR)
+
+
+def save_plan(output_path: str, tasks: list) -> str:
+    """Write the tasks to <output_path>/conversion_plan/plan.json (atomically) and return its path."""
+    directory = plan_dir(output_path)
+    os.makedirs(os.path.join(directory, "done"), exist_ok=True)
+    path = os.path.join(directory, PLAN_FILE)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"tasks": tasks}, f, indent=2)
+    os.replace(tmp_path, path)
+    return path
+
+
+def load_plan(output_path: str) -> list:
+    """Tasks of a saved plan, or None if there is none."""
+    path = os.path.join(plan_dir(output_path), PLAN_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as f:
+        return json.load(f)["tasks"]
+
+
+def plan_plate(converter: DataConverter, n_tasks: int, wells: list = None, tp_chunk: int = None,
+               replan: bool = False) -> list:
+    """The saved plan of the plate, or a new one of `n_tasks` balanced tasks (saved for all array tasks)."""
+    tasks = None if replan else load_plan(converter.output_path)
+    if tasks is not None:
+        print(f" Using the saved conversion plan: {len(tasks)} tasks")
+        return tasks
+    units = conversion_units(converter.nd2_index, wells, tp_chunk)
+    if not units:
+        raise FileNotFoundError(f"No ND2 views to convert in {converter.input_path}")
+    tasks = balance_batches(units, n_tasks)
+    path = save_plan(converter.output_path, tasks)
+    print(f" Planned {len(units)} units in {len(tasks)} tasks ({path})")
+    for index, task in enumerate(tasks):
+        print(f"   - Task {index}: {len(task)} units, {sum(unit['cost'] for unit in task) / 1e9:.2f} GB")
+    return tasks
+
+
+def write_slurm_submit(output_path: str, n_tasks: int, config_path: str,
+                       job_script: str = "slurm_convert_plate.sh") -> str:
+    """Write a script submitting the task array and the dependent assembly job; returns its path."""
+    path = os.path.join(plan_dir(output_path), SUBMIT_FILE)
+    with open(path, "w") as f:
+        f.write("#!/bin/bash\n"
+                "# Generated by scripts/schedule_plate.py: one array task per planned task, then well assembly\n"
+                f"JOB=$(sbatch --parsable --array=0-{n_tasks - 1} {job_script} {config_path} task)\n"
+                f"sbatch --dependency=afterok:${{JOB}} {job_script} {config_path} assemble\n")
+    os.chmod(path, 0o755)
+    return path
+
+
+def done_marker(output_path: str, unit: dict) -> str:
+    return os.path.join(plan_dir(output_path), "done", f"{unit['id']}.done")
+
+
+def pending_units(output_path: str, units: list) -> list:
+    """Units without a completion marker yet."""
+    return [unit for unit in units if not os.path.exists(done_marker(output_path, unit))]
+
+
+def run_unit(converter: DataConverter, unit: dict, bead_xml_path: str = None) -> str:
+    """Convert one unit into its shard (resuming a partial one) and mark it done. Returns the shard XML."""
+    convert = dict(well=unit["well"], tile=unit["tile"], time=(unit["tp_start"], unit["tp_end"]), resume=True)
+    if bead_xml_path:
+        xml_path = converter.process_well_with_registration(bead_xml_path=bead_xml_path, **convert)
+    else:
+        xml_path = converter.process_well(**convert)
+    marker = done_marker(converter.output_path, unit)
+    os.makedirs(os.path.dirname(marker), exist_ok=True)
+    with open(marker, "w") as f:
+        f.write(xml_path)
+    return xml_path
+
+
+def run_task(converter: DataConverter, task: list, bead_xml_path: str = None) -> list:
+    """Run the pending units of one task in turn. Returns the IDs of the units that failed."""
+    pending = pending_units(converter.output_path, task)
+    print(f" Task has {len(task)} units, {len(pending)} pending")
+    failed = []
+    for number, unit in enumerate(pending, start=1):
+        print(f"\n Unit {number}/{len(pending)}: {unit['id']}")
+        try:
+            run_unit(converter, unit, bead_xml_path)
+        except Exception as e:
+            print(f" Unit {unit['id']} failed: {e}")
+            failed.append(unit["id"])
+    return failed
+
+
+def assemble_well(converter: DataConverter, well: str, registered: bool) -> bool:
+    """Link the shards of one well, reporting a failure instead of raising. Returns True on success."""
+    try:
+        converter.assemble_well(well, registered=registered)
+        return True
+    except Exception as e:
+        print(f" Assembling well {well} failed: {e}")
+        return False
+
+
+def assemble_wells(converter: DataConverter, tasks: list, registered: bool = True) -> list:
+    """Link the shards of every well whose units are all done. Returns the wells still incomplete or failed."""
+    units = [unit for task in tasks for unit in task]
+    incomplete = sorted({unit["well"] for unit in pending_units(converter.output_path, units)})
+    failed = []
+    for well in sorted({unit["well"] for unit in units}):
+        if well in incomplete:
+            print(f" WARNING: well {well} has unfinished units, not assembling it.")
+            continue
+        if not assemble_well(converter, well, registered):
+            failed.append(well)
+    return incomplete + failed
+
+
+# --- Local execution ---
+_converter = None
+
+
+def _init_worker(data_config: dict):
+    global _converter
+    _converter = DataConverter(data_config)
+
+
+def _run_unit_in_worker(unit: dict, bead_xml_path: str) -> str:
+    return run_unit(_converter, unit, bead_xml_path)
+
+
+def run_local(data_config: dict, tasks: list, processes: int, bead_xml_path: str = None) -> tuple:
+    """
+    Run all pending units of a plan in `processes` worker processes, largest first, and assemble
+    each well once its last unit is done. Returns the IDs of the units that failed and the wells
+    that failed to assemble.
+    """
+    converter = DataConverter(data_config)
+    units = [unit for task in tasks for unit in task]
+    pending = sorted(pending_units(converter.output_path, units), key=lambda unit: unit["cost"], reverse=True)
+    remaining = {}
+    for unit in pending:
+        remaining[unit["well"]] = remaining.get(unit["well"], 0) + 1
+    print(f" Converting {len(pending)} of {len(units)} units with {processes} processes")
+
+    failed, failed_wells, failed_assembly = [], set(), []
+    with ProcessPoolExecutor(max_workers=processes, initializer=_init_worker, initargs=(data_config,)) as pool:
+        futures = {pool.submit(_run_unit_in_worker, unit, bead_xml_path): unit for unit in pending}
+        for future in as_completed(futures):
+            unit = futures[future]
+            try:
+                future.result()
+                print(f" Unit {unit['id']} done")
+            except Exception as e:
+                print(f" Unit {unit['id']} failed: {e}")
+                failed.append(unit["id"])
+                failed_wells.add(unit["well"])
+            remaining[unit["well"]] -= 1
+            if remaining[unit["well"]] == 0 and unit["well"] not in failed_wells:
+                if not assemble_well(converter, unit["well"], registered=bool(bead_xml_path)):
+                    failed_assembly.append(unit["well"])
+    # wells whose units were all done before this run
+    for well in sorted({unit["well"] for unit in units} - set(remaining)):
+        if not assemble_well(converter, well, registered=bool(bead_xml_path)):
+            failed_assembly.append(well)
+    return failed, failed_assembly
@@ -0,0 +1,148 @@
+# src/dopm/shard_assembly.py
+
+"""
+Assembly of per-tile/per-time BDV shards into one BDV XML/H5 dataset.
+
+HDF5 allows one writer per file, so a well written as a single H5 has to be
+converted inside one process. In shard mode every (tile, time) job writes its
+own small BDV XML/H5 pair with the full setup numbering, and this module then
+builds the well's XML/H5:
+
+ - the H5 holds the `sXX` resolution/subdivision headers and, for every view,
+   an HDF5 external link `tXXXXX/sXX -> <shard>.h5:tXXXXX/sXX`, so no image
+   data is copied (the layout of BDV's own partitioned HDF5 export);
+ - the XML is the union of the shard XMLs' ViewSetups and ViewRegistrations,
+   with the time range and MissingViews recomputed for the whole well.
+
+Links are stored relative to the assembled H5, so the dataset folder can be
+moved together with its shards.
+"""
+
+import os
+import glob
+import math
+import h5py
+from pathlib import Path
+from xml.etree import ElementTree as ET
+
+SHARD_DIR = "shards"
+
+
+def shard_xml_path(output_path: str, dataset_name: str, time=None, tile: int = None) -> str:
+    """
+    XML path of one shard of `dataset_name` (e.g. 'dataset_WellB2_registered').
+    `time` and `tile` are indices, `time` may also be an inclusive (first, last) range;
+    None means the shard holds all of them.
+    """
+    if isinstance(time, (tuple, list)):
+        times = [f"t{time[0]:05d}-{time[1]:05d}"]
+    else:
+        times = [f"t{time:05d}"] if time is not None else []
+    parts = times + ([f"tile{tile:04d}"] if tile is not None else [])
+    return os.path.join(output_path, SHARD_DIR, f"{dataset_name}.shard_{'_'.join(parts) or 'all'}.xml")
+
+
+def find_shards(output_path: str, dataset_name: str) -> list:
+    """All shard XMLs written for `dataset_name`, sorted by name."""
+    return sorted(glob.glob(os.path.join(output_path, SHARD_DIR, f"{glob.escape(dataset_name)}.shard_*.xml")))
+
+
+def _shard_h5_path(shard_xml: str) -> Path:
+    hdf5_ = ET.parse(shard_xml).getroot().find("SequenceDescription/ImageLoader/hdf5")
+    assert hdf5_ is not None, f"{shard_xml} is not a BDV HDF5 dataset"
+    return Path(shard_xml).parent.joinpath(hdf5_.text)
+
+
+def _link_shard(master: h5py.File, shard_h5: Path, master_dir: str) -> list:
+    """Copy the setup headers of one shard into `master` and link its views. Returns the linked view names."""
+    relative_path = os.path.relpath(shard_h5, master_dir)
+    linked = []
+    with h5py.File(shard_h5, "r") as shard:
+        for name in shard:
+            if name.startswith("s"):  # resolutions/subdivisions, identical in every shard
+                if name not in master:
+                    shard.copy(shard[name], master, name=name)
+            elif name.startswith("t"):
+                time_group = master.require_group(name)
+                for setup in shard[name]:
+                    view = f"{name}/{setup}"
+                    assert setup not in time_group, f"View {view} found in more than one shard ({shard_h5})"
+                    time_group[setup] = h5py.ExternalLink(relative_path, view)
+                    linked.append(view)
+    return linked
+
+
+def _merge_xml(shard_xmls: list, h5_name: str) -> ET.ElementTree:
+    """Union of the shard XMLs, pointing at the assembled H5."""
+    tree = ET.parse(shard_xmls[0])
+    root = tree.getroot()
+    seqdesc = root.find("SequenceDescription")
+    seqdesc.find("ImageLoader/hdf5").text = h5_name
+
+    view_setups = seqdesc.find("ViewSetups")
+    setups = {int(vs.find("id").text): vs for vs in view_setups.findall("ViewSetup")}
+    registrations = root.find("ViewRegistrations")
+    views = {(int(vr.get("timepoint")), int(vr.get("setup"))): vr for vr in registrations.findall("ViewRegistration")}
+    last_time = int(seqdesc.find("Timepoints/last").text)
+
+    for shard_xml in shard_xmls[1:]:
+        shard_root = ET.parse(shard_xml).getroot()
+        for vs in shard_root.findall("SequenceDescription/ViewSetups/ViewSetup"):
+            setups.setdefault(int(vs.find("id").text), vs)
+        for vr in shard_root.findall("ViewRegistrations/ViewRegistration"):
+            key = (int(vr.get("timepoint")), int(vr.get("setup")))
+            assert key not in views, f"View (timepoint, setup) {key} found in more than one shard ({shard_xml})"
+            views[key] = vr
+        last_time = max(last_time, int(shard_root.find("SequenceDescription/Timepoints/last").text))
+
+    # ViewSetups first, then the Attributes blocks, as written by BdvWriter
+    for vs in view_setups.findall("ViewSetup"):
+        view_setups.remove(vs)
+    for index, isetup in enumerate(sorted(setups)):
+        view_setups.insert(index, setups[isetup])
+    for vr in registrations.findall("ViewRegistration"):
+        registrations.remove(vr)
+    registrations.extend(views[key] for key in sorted(views))
+    seqdesc.find("Timepoints/last").text = str(last_time)
+
+    nsetups = math.prod(len(attrs) for attrs in view_setups.findall("Attributes"))
+    for missing in seqdesc.findall("MissingViews"):
+        seqdesc.remove(missing)
+    missing_views = ET.SubElement(seqdesc, "MissingViews")
+    for itime in range(last_time + 1):
+        for isetup in range(nsetups):
+            if (itime, isetup) not in views:
+                ET.SubElement(missing_views, "MissingView", timepoint=str(itime), setup=str(isetup))
+
+    ET.indent(tree, space="  ")
+    return tree
+
+
+def assemble_shards(xml_path: str, shard_xmls: list) -> str:
+    """
+    Build the BDV XML/H5 pair `xml_path` from shard XMLs without copying image data.
+
+    Parameters:
+    -----------
+        xml_path: str
+            Output XML path; the H5 is written next to it with the same name.
+        shard_xmls: list of str
+            Shard XMLs written by BdvWriter, all with the same setup numbering and pyramid levels.
+
+    Returns:
+    --------
+        xml_path
+    """
+    assert shard_xmls, f"No shards to assemble into {xml_path}"
+    h5_path = xml_path[:-3] + "h5"
+    master_dir = os.path.dirname(os.path.abspath(h5_path))
+
+    nviews = 0
+    with h5py.File(h5_path, "w") as master:
+        for shard_xml in shard_xmls:
+            nviews += len(_link_shard(master, _shard_h5_path(shard_xml), master_dir))
+
+    tree = _merge_xml(shard_xmls, os.path.basename(h5_path))
+    tree.write(xml_path, xml_declaration=True, encoding="utf-8", method="xml")
+    print(f" Assembled {nviews} views from {len(shard_xmls)} shards into {xml_path}")
+    return xml_path
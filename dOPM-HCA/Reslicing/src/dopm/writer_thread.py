@@ -0,0 +1,83 @@
+# src/dopm/writer_thread.py
+
+"""
+Single-writer thread for BdvWriter.
+
+h5py serialises all HDF5 calls behind one lock, so the fastest way to feed a
+BDV file from several decoding threads is to give the h5py handle to exactly
+one thread and let the decoders queue their writes. `BdvWriterThread` exposes
+the same `append_view` / `append_substack` calls as `BdvWriter`, so code that
+writes views does not need to know whether it runs serially or in a pool.
+"""
+
+import queue
+import threading
+
+from src.dopm.npy2bdv import BdvWriter
+
+
+class BdvWriterThread:
+    _STOP = object()
+
+    def __init__(self, bdv_writer: BdvWriter, max_queue: int = 4):
+        """
+        Parameters:
+        -----------
+            bdv_writer: BdvWriter
+                Writer whose H5 file handle is owned by the writer thread from `start()` until `close()`.
+            max_queue: int
+                Maximum number of pending write calls. Producers block once the queue is full,
+                which bounds the number of decoded views held in memory.
+        """
+        self.bdv_writer = bdv_writer
+        self._queue = queue.Queue(maxsize=max(1, max_queue))
+        self._thread = threading.Thread(target=self._run, name="bdv-writer", daemon=True)
+        self._error = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close(raise_error=exc_type is None)
+
+    def start(self):
+        self._thread.start()
+
+    def append_view(self, **kwargs):
+        """Queue a `BdvWriter.append_view` call."""
+        self._put(self.bdv_writer.append_view, (), kwargs)
+
+    def append_substack(self, substack, z_start, **kwargs):
+        """Queue a `BdvWriter.append_substack` call."""
+        self._put(self.bdv_writer.append_substack, (substack, z_start), kwargs)
+
+    def call(self, function, *args, **kwargs):
+        """Queue any other call (e.g. a checkpoint), run on the writer thread after the writes queued before it."""
+        self._put(function, args, kwargs)
+
+    def close(self, raise_error: bool = True):
+        """Wait for all queued writes to finish and stop the writer thread."""
+        self._queue.put(self._STOP)
+        self._thread.join()
+        if raise_error and self._error is not None:
+            raise self._error
+
+    def _put(self, method, args, kwargs):
+        if self._error is not None:
+            raise RuntimeError("BDV writer thread failed, see the original error above.") from self._error
+        self._queue.put((method, args, kwargs))
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is self._STOP:
+                return
+            if self._error is not None:
+                continue  # keep draining so producers never block on a dead writer
+            method, args, kwargs = item
+            try:
+                method(*args, **kwargs)
+            except Exception as e:
+                print(f" BDV writer thread error: {e}")
+                self._error = e
@@ -0,0 +1,34 @@
+from __future__ import annotations
+
+import os
+import threading
+from pathlib import Path
+
+try:  # optional: file-system events instead of polling (pip install watchdog)
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:
+    FileSystemEventHandler = Observer = None
+
+
+def start_file_observer(path: str | Path, changed: threading.Event):
+    """Set ``changed`` whenever ``path`` is written, closed, created or replaced.
+
+    Returns the running watchdog observer (stop and join it when done), or None if
+    watchdog is not installed.
+    """
+    if Observer is None:
+        return None
+    path = Path(path)
+    target = os.path.normcase(os.path.abspath(path))
+
+    class FileChangedHandler(FileSystemEventHandler):
+        def on_any_event(self, event):
+            paths = (event.src_path, getattr(event, "dest_path", ""))
+            if any(p and os.path.normcase(os.path.abspath(p)) == target for p in paths):
+                changed.set()
+
+    observer = Observer()
+    observer.schedule(FileChangedHandler(), str(path.parent), recursive=False)
+    observer.start()
+    return observer
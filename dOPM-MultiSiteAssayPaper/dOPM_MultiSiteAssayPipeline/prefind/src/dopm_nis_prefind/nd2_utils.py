@@ -1,13 +1,24 @@
 from __future__ import annotations
 
+import hashlib
+import json
+import logging
 import os
+import threading
 import time
+from collections import OrderedDict
 from pathlib import Path
 
 import nd2
 import numpy as np
 import pandas as pd
 
+from .file_events import start_file_observer
+
+# NIS-Elements writes the chunk map, and this signature in the last 40 bytes, when it closes an ND2 (v2+) file
+ND2_CHUNKMAP_SIGNATURE = b"ND2 CHUNK MAP SIGNATURE 0000001!"
+JP2_MAGIC = b"\x00\x00\x00\x0cjP  \r\n\x87\n"  # legacy (v1) ND2 files have no chunk map
+
 
 def find_newest_nd2_recursively(base_dir: str | Path) -> Path:
     """Return the newest ND2 file below ``base_dir`` by creation time."""
@@ -38,18 +49,191 @@ def wait_until_file_stable(path: str | Path, stable_seconds: float = 2.0, poll_s
         time.sleep(poll_seconds)
 
 
+def nd2_frame_status(path: str | Path) -> tuple[int, int] | None:
+    """Return (written, expected) frame counts of a finalised ND2 file, or None while it is still being written.
+
+    A file counts as finalised once NIS has appended its chunk map, i.e. the last bytes
+    hold the chunk map signature and the file opens. Expected frames are the product of
+    the experiment loop counts (e.g. the Z steps of a prefind stack).
+    """
+    path = Path(path)
+    try:
+        with path.open("rb") as fh:
+            head = fh.read(len(JP2_MAGIC))
+            if head != JP2_MAGIC:
+                fh.seek(-40, os.SEEK_END)
+                if fh.read(len(ND2_CHUNKMAP_SIGNATURE)) != ND2_CHUNKMAP_SIGNATURE:
+                    return None
+        with nd2.ND2File(str(path)) as ndfile:
+            written = ndfile.attributes.sequenceCount
+            expected = int(np.prod([loop.count for loop in ndfile.experiment])) if ndfile.experiment else 1
+    except (OSError, ValueError):
+        return None
+    return written, expected
+
+
+def wait_until_nd2_complete(path: str | Path, timeout_seconds: float = 300.0, poll_seconds: float = 0.05) -> None:
+    """Wait until NIS has finished writing an ND2 file, and warn if it holds fewer frames than expected.
+
+    The file is checked whenever it changes (file-system events, if watchdog is installed)
+    and at least every ``poll_seconds`` either way, so processing starts as soon as the file is closed
+    instead of after a fixed period without size changes.
+    """
+    path = Path(path)
+    changed = threading.Event()
+    observer = start_file_observer(path, changed)
+    deadline = time.monotonic() + timeout_seconds
+    try:
+        while True:
+            changed.clear()
+            status = nd2_frame_status(path)
+            if status is not None:
+                written, expected = status
+                if written < expected:
+                    logging.warning("ND2 file %s holds %d of %d expected frames (acquisition stopped early?)",
+                                    path, written, expected)
+                return
+            if time.monotonic() >= deadline:
+                raise TimeoutError(f"ND2 file {path} was not finalised within {timeout_seconds} s")
+            changed.wait(poll_seconds)  # events wake it early; the poll covers shares that drop notifications
+    finally:
+        if observer is not None:
+            observer.stop()
+            observer.join()
+
+
 def read_nd2_z_stack(nd2_file: str | Path) -> np.ndarray:
     """Read the ND2 stack exactly as in the original workflow."""
     return np.asarray(nd2.imread(str(nd2_file)))
 
 
-def get_nd2_metadata(nd2_file_path: str | Path) -> dict:
-    """Extract ND2 sizes, voxel calibration and event table using the original method."""
+class ND2ZStackStream:
+    """Plane-by-plane access to an ND2 z-stack without reading the whole stack into memory.
+
+    ``read_projection`` streams the planes once and returns the raw MIP and the MIP of the
+    offset-corrected planes (values <= 0 replaced by ``offset``, as in the original method).
+    Iterating streams the offset-corrected planes again, e.g. for the per-region focus
+    profiles, and ``stack[z, y0:y1, x0:x1]`` reads crops from raw planes. At most
+    ``ring_size`` raw planes are kept, in a least-recently-used ring.
+    """
+
+    def __init__(self, nd2_file: str | Path, offset: float = 0, ring_size: int = 8):
+        self._file = nd2.ND2File(str(nd2_file))
+        self.shape = tuple(self._file.shape)
+        if len(self.shape) != 3:
+            self.close()
+            raise ValueError(f"ND2 file must contain a 3D z-stack, got shape {self.shape}.")
+        self.offset = offset
+        self.ring_size = max(1, int(ring_size))
+        self._ring: OrderedDict[int, np.ndarray] = OrderedDict()
+
+    def __enter__(self) -> ND2ZStackStream:
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self._ring.clear()
+        self._file.close()
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    def __iter__(self):
+        for z in range(len(self)):
+            yield self._corrected(self._file.read_frame(z))
+
+    def __getitem__(self, index):
+        z, *rest = index if isinstance(index, tuple) else (index,)
+        return self.raw_plane(int(z))[tuple(rest)]
+
+    def raw_plane(self, z: int) -> np.ndarray:
+        plane = self._ring.get(z)
+        if plane is None:
+            plane = np.asarray(self._file.read_frame(z))
+            self._ring[z] = plane
+            if len(self._ring) > self.ring_size:
+                self._ring.popitem(last=False)
+        else:
+            self._ring.move_to_end(z)
+        return plane
+
+    def read_projection(self) -> tuple[np.ndarray, np.ndarray]:
+        """Stream all planes once; return the (raw, offset-corrected) maximum-intensity projections."""
+        raw_mip = mip = None
+        for z in range(len(self)):
+            plane = np.asarray(self._file.read_frame(z))
+            corrected = self._corrected(plane)
+            if raw_mip is None:
+                raw_mip, mip = plane.copy(), corrected.copy()
+            else:
+                np.maximum(raw_mip, plane, out=raw_mip)
+                np.maximum(mip, corrected, out=mip)
+        return raw_mip, mip
+
+    def _corrected(self, plane: np.ndarray) -> np.ndarray:
+        return np.where(plane <= 0, self.offset, plane)
+
+
+def _read_nd2_header(nd2_file_path: str | Path) -> dict:
+    """Read ND2 sizes, voxel calibration and raw event records using the original method."""
     with nd2.ND2File(str(nd2_file_path)) as ndfile:
         sizes = dict(ndfile.sizes)
         sizes.setdefault("C", 1)
         sizes.setdefault("T", 1)
         sizes.setdefault("Z", 1)
         voxel_sizes = getattr(getattr(ndfile.frame_metadata(0).channels[0], "volume"), "axesCalibration")
-        events = pd.DataFrame(ndfile.events())
-    return {"sizes": sizes, "voxel_sizes": voxel_sizes, "events": events}
+        events = list(ndfile.events())
+    return {"sizes": sizes, "voxel_sizes": tuple(voxel_sizes), "events": events}
+
+
+def _json_default(value):
+    """Serialise NumPy scalars found in ND2 event records."""
+    if isinstance(value, np.generic):
+        return value.item()
+    return str(value)
+
+
+def _metadata_cache_entry(cache_dir: Path, nd2_file_path: Path) -> tuple[Path, dict]:
+    """Cache file and identity (absolute path, size, mtime) of an ND2 file."""
+    stat = nd2_file_path.stat()
+    identity = {"path": str(nd2_file_path.resolve()), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+    key = hashlib.sha1(f"{identity['path']}|{identity['size']}|{identity['mtime_ns']}".encode()).hexdigest()
+    return cache_dir / f"{key}.json", identity
+
+
+def get_nd2_metadata(nd2_file_path: str | Path, cache_dir: str | Path | None = None) -> dict:
+    """
+    Extract ND2 sizes, voxel calibration and event table using the original method.
+
+    With ``cache_dir``, the header is read once per file state: entries are keyed on the
+    file's path, size and mtime, so repeated passes over the same ND2 skip re-parsing it.
+    """
+    nd2_file_path = Path(nd2_file_path)
+    header = None
+    if cache_dir is not None:
+        cache_dir = Path(cache_dir)
+        entry_path, identity = _metadata_cache_entry(cache_dir, nd2_file_path)
+        try:
+            entry = json.loads(entry_path.read_text(encoding="utf-8"))
+            if all(entry.get(key) == value for key, value in identity.items()):
+                header = entry["metadata"]
+                header["voxel_sizes"] = tuple(header["voxel_sizes"])
+                logging.debug("ND2 metadata cache hit: %s", nd2_file_path)
+        except (OSError, ValueError, KeyError):
+            header = None
+
+    if header is None:
+        header = _read_nd2_header(nd2_file_path)
+        if cache_dir is not None:
+            try:
+                cache_dir.mkdir(parents=True, exist_ok=True)
+                tmp_path = entry_path.with_suffix(f".{os.getpid()}.tmp")
+                tmp_path.write_text(json.dumps({**identity, "metadata": header}, default=_json_default),
+                                    encoding="utf-8")
+                os.replace(tmp_path, entry_path)
+            except OSError as exc:
+                logging.warning("Could not write ND2 metadata cache entry %s: %s", entry_path, exc)
+
+    return {"sizes": header["sizes"], "voxel_sizes": header["voxel_sizes"], "events": pd.DataFrame(header["events"])}
@@ -51,7 +51,7 @@ def write_positions_xml(filepath, points):
 
 
 def extract_cropped_planes(z_stack, locations, crop_size):
-    """Extract 2D crops from a 3D z-stack at each blob's z-plane."""
+    """Extract 2D crops from a 3D z-stack (or an ``ND2ZStackStream``) at each blob's z-plane."""
     crops = []
     dy, dx = crop_size
     for loc in locations:
@@ -86,12 +86,14 @@ def display_original_and_filtered_output(
     save_folder=None,
     save_name=None,
     show_plots=False,
+    mip_raw=None,
 ):
-    """Original three-panel diagnostic output."""
+    """Original three-panel diagnostic output. Pass ``mip_raw`` instead of ``z_stack`` if the MIP is already known."""
     try:
         fig, axs = plt.subplots(1, 3, figsize=(18, 6))
 
-        mip_raw = np.max(z_stack, axis=0)
+        if mip_raw is None:
+            mip_raw = np.max(z_stack, axis=0)
         axs[0].imshow(mip_raw, cmap="gray")
         axs[0].set_title(f"Raw Output - {file_name}")
         axs[0].axis("off")
@@ -6,7 +6,13 @@ from pathlib import Path
 from typing import Any
 
 from .config import load_config, setup_logging
-from .nd2_utils import find_newest_nd2_recursively, get_nd2_metadata, read_nd2_z_stack, wait_until_file_stable
+from .nd2_utils import (
+    ND2ZStackStream,
+    find_newest_nd2_recursively,
+    get_nd2_metadata,
+    wait_until_file_stable,
+    wait_until_nd2_complete,
+)
 from .outputs import (
     display_original_and_filtered_output,
     extract_cropped_planes,
@@ -15,7 +21,7 @@ from .outputs import (
     write_positions_to_file,
     write_positions_xml,
 )
-from .processing import filter_locations, segment_blobs_and_find_focus
+from .processing import camera_offset, filter_locations, segment_blobs_in_mip
 
 
 def run_prefind_pipeline(config: dict[str, Any], nd2_file: str | Path | None = None) -> dict[str, Path | int]:
@@ -25,21 +31,40 @@ def run_prefind_pipeline(config: dict[str, Any], nd2_file: str | Path | None = N
     if nd2_file is None:
         nd2_file = find_newest_nd2_recursively(directories["nd2_files_directory"])
     nd2_file = Path(nd2_file)
-    nd2_folder = nd2_file.parent
-    basename = nd2_file.stem
     logging.info("Processing ND2 file: %s", nd2_file)
 
-    stable_seconds = float(config.get("sync", {}).get("stable_file_seconds", 0))
-    if stable_seconds > 0:
-        wait_until_file_stable(nd2_file, stable_seconds=stable_seconds)
-
-    z_stack = read_nd2_z_stack(nd2_file)
-    if z_stack.ndim != 3:
-        raise ValueError(f"ND2 file must contain a 3D z-stack, got shape {z_stack.shape}.")
+    sync_cfg = config.get("sync", {})
+    nd2_ready = sync_cfg.get("nd2_ready", "complete")
+    if nd2_ready == "complete":
+        wait_until_nd2_complete(nd2_file, timeout_seconds=float(sync_cfg.get("nd2_complete_timeout_seconds", 300)))
+    elif nd2_ready == "stable":
+        stable_seconds = float(sync_cfg.get("stable_file_seconds", 0))
+        if stable_seconds > 0:
+            wait_until_file_stable(nd2_file, stable_seconds=stable_seconds)
+    elif nd2_ready != "none":
+        raise ValueError(f"sync.nd2_ready must be 'complete', 'stable' or 'none', got {nd2_ready!r}")
+
+    # Planes are streamed from the file: one pass for the MIP, one for the focus profiles of the
+    # regions found in it, and single planes for the montage crops. The stack is never held whole.
+    ring_size = config["image_processing"].get("plane_ring_size", 8)
+    with ND2ZStackStream(nd2_file, offset=camera_offset(config), ring_size=ring_size) as z_stack:
+        raw_mip, mip = z_stack.read_projection()
+        return _find_and_write_positions(config, nd2_file, z_stack, raw_mip, mip)
+
+
+def _find_and_write_positions(config, nd2_file, z_stack, raw_mip, mip) -> dict[str, Path | int]:
+    """Segment the MIP, pick positions, and write the position lists, montage and summary."""
+    directories = config["directories"]
+    nd2_folder = nd2_file.parent
+    basename = nd2_file.stem
 
-    metadata = get_nd2_metadata(nd2_file)
+    cache_folder = directories.get("metadata_cache_folder")
+    if cache_folder is None:
+        cache_folder = Path(directories.get("output_folder") or nd2_folder) / "nd2_metadata_cache"
+    metadata = get_nd2_metadata(nd2_file, cache_dir=cache_folder or None)
 
-    binary_mask, labeled_regions, blob_binary, blob_data = segment_blobs_and_find_focus(
+    binary_mask, labeled_regions, blob_binary, blob_data = segment_blobs_in_mip(
+        mip,
         z_stack,
         metadata,
         config,
@@ -51,7 +76,7 @@ def run_prefind_pipeline(config: dict[str, Any], nd2_file: str | Path | None = N
         blob_data,
         config.get("filtering", {}).get("min_distance", 10),
         config.get("filtering", {}).get("n_largest", 10),
-        max_z=blob_data[0]["z_planes"] if blob_data else z_stack.shape[0],
+        max_z=blob_data[0]["z_planes"] if blob_data else len(z_stack),
         voxel_sizes=metadata["voxel_sizes"],
         border_margin_um=config.get("filtering", {}).get("border_margin_um", 0),
         enforce_border=config.get("filtering", {}).get("enforce_border", True),
@@ -90,7 +115,8 @@ def run_prefind_pipeline(config: dict[str, Any], nd2_file: str | Path | None = N
     save_montage(montage_png, montage)
 
     display_original_and_filtered_output(
-        z_stack=z_stack,
+        z_stack=None,
+        mip_raw=raw_mip,
         mip_all=binary_mask,
         mip_filtered=blob_binary,
         filtered_locations=filtered,
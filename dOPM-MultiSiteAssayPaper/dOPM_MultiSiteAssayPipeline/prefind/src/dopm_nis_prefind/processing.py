@@ -12,6 +12,34 @@ from skimage.segmentation import clear_border
 from .coordinates import compute_physical_coordinates, get_stage_coordinates
 
 
+def camera_offset(config):
+    """Camera offset in DN of the binned image, substituted for non-positive pixel values."""
+    return config["image_processing"]["camera_offset"] * config["image_processing"]["binning"] ** 2
+
+
+def mean_profiles_by_label(z_stack, labeled, labels):
+    """Mean z-profile of each 2D region in ``labels``, as an array of shape (len(labels), n_z).
+
+    Equivalent to averaging ``z_stack[:, y, x]`` over the pixels of each region, but all
+    regions are reduced together with one ``bincount`` per plane over the labelled pixels.
+    ``z_stack`` may be any sized iterable of 2D planes, so a streamed stack is read only once.
+    """
+    labels = np.asarray(labels, dtype=np.intp)
+    if labels.size == 0:
+        return np.zeros((0, len(z_stack)))
+    lookup = np.zeros(int(labeled.max()) + 1, dtype=np.intp)
+    lookup[labels] = np.arange(1, labels.size + 1)
+    compact = lookup[labeled].ravel()
+    pixels = np.flatnonzero(compact)
+    pixel_labels = compact[pixels]
+    counts = np.bincount(pixel_labels, minlength=labels.size + 1)[1:]
+
+    sums = np.empty((labels.size, len(z_stack)))
+    for z, plane in enumerate(z_stack):
+        sums[:, z] = np.bincount(pixel_labels, weights=plane.ravel()[pixels], minlength=labels.size + 1)[1:]
+    return sums / counts[:, None]
+
+
 def segment_blobs_and_find_focus(z_stack, metadata, config, allow_large=False):
     """Original 2D-MIP spheroid detection and focus-finding method.
 
@@ -21,12 +49,21 @@ def segment_blobs_and_find_focus(z_stack, metadata, config, allow_large=False):
     filtering, focus-plane estimation from the mean raw-intensity profile, and
     stage-coordinate conversion from NIS event metadata.
     """
-    offset = config["image_processing"]["camera_offset"] * config["image_processing"]["binning"] ** 2
-    z_stack = np.where(z_stack <= 0, offset, z_stack)
+    z_stack = np.where(z_stack <= 0, camera_offset(config), z_stack)
+    return segment_blobs_in_mip(np.max(z_stack, axis=0), z_stack, metadata, config, allow_large)
+
+
+def segment_blobs_in_mip(mip, z_stack, metadata, config, allow_large=False):
+    """``segment_blobs_and_find_focus`` for an already computed MIP of the offset-corrected stack.
+
+    ``z_stack`` is the offset-corrected stack or any sized iterable of its planes, such as an
+    ``ND2ZStackStream``; it is only read for the focus profiles of the regions that pass the
+    area filter.
+    """
     voxel_sizes = metadata["voxel_sizes"]
     image_shape = (metadata["sizes"]["Y"], metadata["sizes"]["X"])
 
-    mip = np.max(z_stack, axis=0).astype(np.float32)
+    mip = mip.astype(np.float32)
     uniform_mip = uniform_filter(mip, size=config["image_processing"]["uniform_window_size"])
     dog_mip = mip - uniform_mip
     threshold = max(threshold_otsu(dog_mip), 100)
@@ -43,17 +80,13 @@ def segment_blobs_and_find_focus(z_stack, metadata, config, allow_large=False):
     max_area = np.pi * (max_radius / voxel_sizes[1]) ** 2
 
     results = []
-    filtered_binary = np.zeros_like(binary_mip, dtype=bool)
-
-    for region in regionprops(labeled, intensity_image=dog_mip):
-        if not (min_area <= region.area <= max_area):
-            continue
-
-        filtered_binary[labeled == region.label] = True
+    regions = [region for region in regionprops(labeled, intensity_image=dog_mip)
+               if min_area <= region.area <= max_area]
+    kept_labels = [region.label for region in regions]
+    filtered_binary = np.isin(labeled, kept_labels)
+    mean_profiles = mean_profiles_by_label(z_stack, labeled, kept_labels)
 
-        coords_2d = region.coords
-        profiles = np.array([z_stack[:, y, x] for y, x in coords_2d])
-        mean_profile = profiles.mean(axis=0)
+    for region, mean_profile in zip(regions, mean_profiles):
         z_focus = np.argmax(mean_profile)
 
         stage_coords = get_stage_coordinates(metadata["events"], z_focus)
@@ -72,7 +105,7 @@ def segment_blobs_and_find_focus(z_stack, metadata, config, allow_large=False):
                 "pixel_count": region.area,
                 "coordinates_phys": (x, y, z),
                 "mean_intensity_profile": mean_profile,
-                "z_planes": z_stack.shape[0],
+                "z_planes": len(z_stack),
             }
         )
 
@@ -105,14 +138,33 @@ def filter_locations(
             )
         ]
 
-    selected = []
-    for loc in sorted(valid, key=lambda x: x["pixel_count"], reverse=True):
-        if all(
-            np.linalg.norm(np.array(loc["coordinates_phys"]) - np.array(other["coordinates_phys"])) >= min_distance
-            for other in selected
-        ):
-            selected.append(loc)
-        if len(selected) >= n_keep:
-            break
-
-    return selected
+    ranked = sorted(valid, key=lambda x: x["pixel_count"], reverse=True)
+    points = np.array([loc["coordinates_phys"] for loc in ranked], dtype=float)
+    return [ranked[i] for i in select_separated(points, min_distance, n_keep)]
+
+
+def select_separated(points, min_distance, n_keep):
+    """Greedily keep points in order while each is at least ``min_distance`` from all kept so far.
+
+    Kept points are hashed into a grid of ``min_distance``-sized cells, so a candidate is only
+    compared with the kept points in its neighbouring cells rather than with all of them.
+    Returns the indices of the kept points.
+    """
+    if n_keep <= 0 or len(points) == 0:
+        return []
+    if min_distance <= 0:
+        return list(range(min(n_keep, len(points))))
+
+    ndim = points.shape[1]
+    offsets = np.stack(np.meshgrid(*[(-1, 0, 1)] * ndim, indexing="ij"), axis=-1).reshape(-1, ndim)
+    cells = np.floor(points / min_distance).astype(np.int64)
+    grid: dict[tuple, list[int]] = {}
+    kept = []
+    for i, point in enumerate(points):
+        neighbours = [j for offset in offsets for j in grid.get(tuple(cells[i] + offset), ())]
+        if not neighbours or np.all(np.linalg.norm(points[neighbours] - point, axis=1) >= min_distance):
+            kept.append(i)
+            grid.setdefault(tuple(cells[i]), []).append(i)
+            if len(kept) >= n_keep:
+                break
+    return kept
@@ -4,11 +4,13 @@ import argparse
 import logging
 import subprocess
 import sys
-import time
+import threading
 from pathlib import Path
 from typing import Sequence
 
 from .config import load_config, setup_logging
+from .file_events import start_file_observer
+from .worker import PrefindWorker
 
 
 def read_sync_value(sync_file: Path) -> str:
@@ -66,30 +68,61 @@ def run_prefind_subprocess(config_path: str | Path, nd2_file: str | Path | None
 
 
 def watch_sync_file(config: dict, config_path: str | Path) -> None:
-    """Poll a text file and launch a prefind subprocess when NIS writes the trigger value."""
+    """Watch a text file and run a prefind pass when NIS writes the trigger value.
+
+    With watchdog installed, the file is re-read as soon as it changes, with a slower
+    fallback poll for file systems that do not deliver events (e.g. some network shares);
+    otherwise it is polled every ``poll_seconds``. Passes run in a pre-warmed worker
+    process (``sync.warm_worker``) or in a fresh one-shot subprocess each.
+    """
     sync_cfg = config.get("sync", {})
     sync_file = Path(sync_cfg.get("file_path", "sync.txt"))
     trigger_value = str(sync_cfg.get("trigger_value", "1"))
     complete_value = str(sync_cfg.get("complete_value", "0"))
     error_value = str(sync_cfg.get("error_value", "E"))
     poll_seconds = float(sync_cfg.get("poll_seconds", 1.0))
-
-    logging.info("Watching sync file: %s", sync_file)
+    watch_mode = str(sync_cfg.get("watch_mode", "auto"))
+    if watch_mode not in ("auto", "events", "poll"):
+        raise ValueError(f"sync.watch_mode must be 'auto', 'events' or 'poll', got {watch_mode!r}")
+
+    read_sync_value(sync_file)  # creates the file (and its folder) before watching it
+    changed = threading.Event()
+    observer = start_file_observer(sync_file, changed) if watch_mode != "poll" else None
+    if watch_mode == "events" and observer is None:
+        raise ImportError("sync.watch_mode 'events' requires the watchdog package (pip install watchdog)")
+    wait_seconds = float(sync_cfg.get("fallback_poll_seconds", 5.0)) if observer is not None else poll_seconds
+
+    worker = PrefindWorker(config_path, max_jobs=sync_cfg.get("worker_max_jobs", 20)) \
+        if sync_cfg.get("warm_worker", True) else None
+    if worker is not None:
+        worker.start()
+
+    logging.info("Watching sync file: %s (%s)", sync_file,
+                 "file-system events" if observer is not None else f"polling every {poll_seconds} s")
     logging.info("Protocol: NIS writes %r; Python writes %r when complete", trigger_value, complete_value)
-    logging.info("Each trigger launches a fresh child process for the one-shot prefind command")
+    if worker is not None:
+        logging.info("Triggers run in a pre-warmed worker process, recycled after %d jobs or a failure",
+                     worker.max_jobs)
+    else:
+        logging.info("Each trigger launches a fresh child process for the one-shot prefind command")
 
     last_value = None
     while True:
         try:
+            changed.clear()
             value = read_sync_value(sync_file)
             if value != last_value:
                 logging.info("Sync value is now %r", value)
                 last_value = value
 
             if value == trigger_value:
-                logging.info("Trigger detected. Starting one-shot prefind subprocess.")
                 try:
-                    return_code = run_prefind_subprocess(config_path=config_path)
+                    if worker is not None:
+                        logging.info("Trigger detected. Running prefind in the worker process.")
+                        return_code = worker.run()
+                    else:
+                        logging.info("Trigger detected. Starting one-shot prefind subprocess.")
+                        return_code = run_prefind_subprocess(config_path=config_path)
                     if return_code == 0:
                         write_sync_value(sync_file, complete_value)
                         logging.info("Pipeline complete. Sync value reset to %r", complete_value)
@@ -103,9 +136,14 @@ def watch_sync_file(config: dict, config_path: str | Path) -> None:
                     write_sync_value(sync_file, error_value)
                     last_value = error_value
 
-            time.sleep(poll_seconds)
+            changed.wait(wait_seconds)
         except KeyboardInterrupt:
             logging.info("Stopping sync watcher")
+            if observer is not None:
+                observer.stop()
+                observer.join()
+            if worker is not None:
+                worker.stop()
             return
 
 
@@ -0,0 +1,117 @@
+from __future__ import annotations
+
+import logging
+import multiprocessing as mp
+import queue
+import traceback
+from pathlib import Path
+
+
+def _worker_main(config_path: str, jobs, results) -> None:
+    """Child process: import the image-processing stack once, then run prefind jobs until told to stop."""
+    from .config import load_config, setup_logging
+    from .pipeline import run_prefind_pipeline  # imports nd2, scikit-image, OpenCV, matplotlib, pandas
+
+    setup_logging(load_config(config_path))
+    results.put(("ready", None))
+    while True:
+        nd2_file = jobs.get()
+        if nd2_file is None:
+            return
+        try:
+            # Re-read the config for every job, as the one-shot subprocess did, so edits apply to the next trigger
+            config = load_config(config_path)
+            setup_logging(config)
+            run_prefind_pipeline(config, nd2_file=nd2_file or None)
+            results.put(("ok", None))
+        except Exception:
+            logging.exception("Prefind job failed")
+            results.put(("error", traceback.format_exc()))
+
+
+class PrefindWorker:
+    """A pre-warmed child process that runs prefind passes for the watcher.
+
+    The child imports the pipeline and its heavy dependencies when it starts, i.e.
+    between triggers, so a trigger only waits for the actual computation. Failures stay
+    isolated as with the one-shot subprocess: a job that raises, or a child that dies,
+    makes ``run`` return a non-zero code, and the child is replaced by a fresh one. The
+    child is also replaced after ``max_jobs`` jobs to bound memory growth in native code.
+    """
+
+    def __init__(self, config_path: str | Path, max_jobs: int = 20):
+        self.config_path = str(config_path)
+        self.max_jobs = max(1, int(max_jobs))
+        self._context = mp.get_context("spawn")  # the same start method on Windows and elsewhere
+        self._process = None
+        self._jobs = None
+        self._results = None
+        self._jobs_done = 0
+
+    @property
+    def alive(self) -> bool:
+        return self._process is not None and self._process.is_alive()
+
+    def start(self) -> None:
+        """Start a fresh child; it warms up in the background."""
+        self._jobs = self._context.Queue()
+        self._results = self._context.Queue()
+        self._process = self._context.Process(
+            target=_worker_main,
+            args=(self.config_path, self._jobs, self._results),
+            name="prefind-worker",
+            daemon=True,
+        )
+        self._process.start()
+        self._jobs_done = 0
+        logging.info("Started prefind worker process (pid %d)", self._process.pid)
+
+    def stop(self, timeout: float = 10.0) -> None:
+        if self._process is None:
+            return
+        if self._process.is_alive():
+            self._jobs.put(None)
+            self._process.join(timeout)
+            if self._process.is_alive():
+                self._process.terminate()
+                self._process.join()
+        self._process = None
+
+    def recycle(self) -> None:
+        self.stop()
+        self.start()
+
+    def run(self, nd2_file: str | Path | None = None) -> int:
+        """Run one prefind pass in the worker; returns 0 on success like the one-shot subprocess."""
+        if not self.alive:
+            self.start()
+        self._jobs.put(str(nd2_file) if nd2_file is not None else "")
+        return_code = 1
+        while True:
+            message = self._get_result()
+            if message is None:
+                logging.error("Prefind worker exited unexpectedly (exit code %s)", self._process.exitcode)
+                break
+            status, _ = message
+            if status == "ready":  # warm-up finished; the result of this job follows
+                continue
+            return_code = 0 if status == "ok" else 1
+            self._jobs_done += 1
+            break
+
+        if return_code != 0 or self._jobs_done >= self.max_jobs:
+            logging.info("Recycling prefind worker after %d job(s)", self._jobs_done)
+            self.recycle()
+        return return_code
+
+    def _get_result(self):
+        """Next message from the child, or None if it died before sending one."""
+        while True:
+            try:
+                return self._results.get(timeout=0.5)
+            except queue.Empty:
+                if not self._process.is_alive():
+                    try:
+                        return self._results.get_nowait()
+                    except queue.Empty:
+                        return None